@@ -0,0 +1,11 @@
+import os
+
+# benchmarks only exercise CPU-bound parsing code,
+# so the app is imported without connecting to databases
+os.environ.setdefault("BACKEND_OFFLINE", "1")
+
+from benchmarks.tokenizer import ensure_encoding
+from utils import CONFIG
+
+# the encoding the chunker runs with, a local stand-in on machines which can not download it
+TOKENIZER = ensure_encoding(CONFIG["handlers"]["tokenizer_name"])
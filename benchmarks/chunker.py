@@ -0,0 +1,79 @@
+"""
+Compares doc_to_chunks against the previous implementation, which re-tokenized
+the growing chunk for every line. Checks that both produce the same chunks.
+
+    python -m benchmarks.chunker --size-kb 256 1024
+"""
+import time
+from argparse import ArgumentParser
+from collections import deque
+from typing import List
+
+import nltk
+
+from benchmarks.corpora import markdown_text, pdf_text
+from utils import CONFIG
+from utils.tokenize_ import doc_to_chunks, get_tokenizer
+
+
+def legacy_doc_to_chunks(
+    content: str,
+    tokenizer_name: str = CONFIG["handlers"]["tokenizer_name"],
+    chunk_size: int = int(CONFIG["handlers"]["chunk_size"]),
+    overlapping_lines: int = 5,
+    splitter="\n",
+) -> List[str]:
+    chunks = []
+    encoder = get_tokenizer(tokenizer_name)
+    olap = deque([], overlapping_lines)
+
+    current_content = ""
+    maxlen = int(CONFIG["milvus"]["chunk_max_symbols"])
+    for line in content.split(splitter):
+        if len(encoder.encode(current_content + line + "\n")) > chunk_size and current_content.strip() != "":
+            chunks.append(current_content.strip()[:maxlen])
+            current_content = f"{' '.join(olap)}\n"
+
+        if len(encoder.encode(line)) > chunk_size:
+            sentences = nltk.tokenize.sent_tokenize(line)
+            for sent in sentences:
+                if len(encoder.encode(current_content + f" {sent}")) > chunk_size and current_content.strip() != "":
+                    chunks.append(current_content.strip()[:maxlen])
+                    current_content = f"{'. '.join(olap)}\n{sent}"
+                else:
+                    current_content += f" {sent}"
+                olap.append(sent)
+            current_content += "\n"
+        else:
+            current_content += line + "\n"
+            sentences = nltk.tokenize.sent_tokenize(line)
+            olap.extend(sentences[-overlapping_lines:])
+
+    if current_content.strip() != "":
+        chunks.append(current_content.strip()[:maxlen])
+    return chunks
+
+
+def measure(func, text: str):
+    start = time.perf_counter()
+    chunks = func(text)
+    return chunks, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--size-kb", type=int, nargs="+", default=[64, 256, 1024])
+    parser.add_argument("--chunk-size", type=int, default=int(CONFIG["handlers"]["chunk_size"]))
+    args = parser.parse_args()
+
+    for corpus_name, make_corpus in [("markdown", markdown_text), ("pdf", pdf_text)]:
+        for size_kb in args.size_kb:
+            text = make_corpus(size_kb * 1024)
+            mb = len(text.encode()) / 2**20
+            old_chunks, old_time = measure(lambda t: legacy_doc_to_chunks(t, chunk_size=args.chunk_size), text)
+            new_chunks, new_time = measure(lambda t: doc_to_chunks(t, chunk_size=args.chunk_size), text)
+            assert old_chunks == new_chunks, f"Chunks differ on {corpus_name} {size_kb}KB"
+            print(
+                f"{corpus_name:>8} {size_kb:>6}KB {len(new_chunks):>6} chunks | "
+                f"legacy {mb / old_time:7.2f} MB/s | linear {mb / new_time:7.2f} MB/s | x{old_time / new_time:.1f}"
+            )
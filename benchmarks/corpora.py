@@ -0,0 +1,242 @@
+import io
+import random
+from typing import List
+
+import docx
+import fitz
+import openpyxl
+
+WORDS = (
+    "account agent answer billing browser cache chat client collection configure customer dashboard data "
+    "document email error export feature file group guide import install integration invoice key license "
+    "login mail message mobile notification order password payment permission plan profile report request "
+    "reset search security server setting subscription support team ticket token update upload user widget"
+).split()
+
+
+def _sentence(rnd: random.Random) -> str:
+    words = [rnd.choice(WORDS) for _ in range(rnd.randint(6, 24))]
+    return " ".join(words).capitalize() + rnd.choice([".", ".", ".", "?", "!"])
+
+
+def _paragraph(rnd: random.Random) -> str:
+    return " ".join(_sentence(rnd) for _ in range(rnd.randint(2, 8)))
+
+
+SENTENCE_EXTRAS = [
+    "See Fig. 3 for the {w} settings.",
+    "Ask Dr. Smith about the {w} plan, e.g. the yearly one.",
+    "Version 2.4.1 fixed the {w} error.",
+    "The {w} costs approx. 5 USD per user.",
+    "It was built by J. R. Doe at Acme Inc. in the U.S. last year.",
+    "Did you reset the {w}?",
+    'Open the "{w}" tab.',
+    "Contact us (mon. to fri.) about the {w}!",
+]
+
+
+def gold_sentences(size: int, seed: int = 0) -> List[str]:
+    # sentences with abbreviations, initials and numbers between plain ones, to be joined by spaces
+    rnd = random.Random(seed)
+    sentences, length = [], 0
+    while length < size:
+        if rnd.random() < 0.3:
+            sentence = rnd.choice(SENTENCE_EXTRAS).format(w=rnd.choice(WORDS))
+        else:
+            sentence = _sentence(rnd)
+        sentences.append(sentence)
+        length += len(sentence) + 1
+    return sentences
+
+
+def markdown_text(size: int, seed: int = 0) -> str:
+    rnd = random.Random(seed)
+    parts, length = [], 0
+    while length < size:
+        kind = rnd.random()
+        if kind < 0.1:
+            part = f"{'#' * rnd.randint(1, 3)} {_sentence(rnd)[:-1]}\n"
+        elif kind < 0.25:
+            part = "\n".join(f"{i}. {_sentence(rnd)}" for i in range(1, rnd.randint(2, 7))) + "\n"
+        elif kind < 0.3:
+            part = "```\n" + "\n".join(f"    {rnd.choice(WORDS)}({i})" for i in range(rnd.randint(2, 8))) + "\n```\n"
+        else:
+            part = _paragraph(rnd) + "\n"
+        parts.append(part + "\n")
+        length += len(part) + 1
+    return "".join(parts)[:size]
+
+
+def hugo_markdown_text(size: int, seed: int = 0) -> str:
+    # page of a Hugo docs site: front matter, shortcodes, heading anchors and thematic breaks
+    rnd = random.Random(seed)
+    front_matter = f"---\ntitle: {_sentence(rnd)[:-1]}\nweight: {rnd.randint(1, 100)}\ndraft: false\n---\n"
+    parts, length = [front_matter], len(front_matter)
+    while length < size:
+        kind = rnd.random()
+        if kind < 0.1:
+            part = f"## {_sentence(rnd)[:-1]} {{#{rnd.choice(WORDS)}-{rnd.choice(WORDS)}}}\n"
+        elif kind < 0.2:
+            start = rnd.randint(1, 9)
+            part = "\n".join(
+                f'{{{{% ol start="{i}" %}}}}{_sentence(rnd)}' for i in range(start, start + rnd.randint(2, 5))
+            )
+        elif kind < 0.3:
+            part = f"{{{{% note %}}}}{_sentence(rnd)}{{{{% /note %}}}}\n"
+        elif kind < 0.35:
+            part = f'{{{{< img src="/images/{rnd.choice(WORDS)}.png" >}}}}\n'
+        elif kind < 0.4:
+            part = "---\n"
+        else:
+            part = _paragraph(rnd) + "\n"
+        parts.append(part + "\n")
+        length += len(part) + 1
+    return "".join(parts)[:size]
+
+
+def chats_lines(size: int, seed: int = 0) -> List[List[str]]:
+    # support chats of a few to a few dozen messages, rarely a very long one
+    rnd = random.Random(seed)
+    chats, length = [], 0
+    while length < size:
+        lines = []
+        for i in range(rnd.randint(2, 40)):
+            n_sentences = rnd.randint(1, 6) if rnd.random() > 0.02 else rnd.randint(60, 120)
+            lines.append(f"{['user', 'assistant'][i % 2]}: {' '.join(_sentence(rnd) for _ in range(n_sentences))}")
+            length += len(lines[-1]) + 1
+        chats.append(lines)
+    return chats
+
+
+def pdf_bytes(size: int, seed: int = 0) -> bytes:
+    # text is laid out on A4 pages, so that extraction sees real line wraps and page breaks
+    rnd = random.Random(seed)
+    doc = fitz.open()
+    length = 0
+    while length < size:
+        page_text: List[str] = []
+        while sum(len(p) for p in page_text) < 2500 and length < size:
+            paragraph = _paragraph(rnd)
+            page_text.append(paragraph)
+            length += len(paragraph)
+        page = doc.new_page()
+        page.insert_textbox(fitz.Rect(50, 50, 545, 800), "\n\n".join(page_text), fontsize=9)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def pdf_text(size: int, seed: int = 0) -> str:
+    with fitz.open(stream=pdf_bytes(size, seed), filetype="pdf") as doc:
+        return "".join(page.get_text() for page in doc)
+
+
+def html_body(size: int, seed: int = 0) -> str:
+    # knowledge-base article markup as exported by Groove or Vivantio
+    rnd = random.Random(seed)
+    parts, length = [], 0
+    while length < size:
+        kind = rnd.random()
+        if kind < 0.1:
+            level = rnd.randint(1, 2)
+            part = f"<h{level}>{_sentence(rnd)[:-1]}</h{level}>"
+        elif kind < 0.15:
+            part = f"<h3>{_sentence(rnd)[:-1]}</h3>"
+        elif kind < 0.3:
+            tag = rnd.choice(["ul", "ol"])
+            items = "".join(f"<li>{_sentence(rnd)}</li>" for _ in range(rnd.randint(2, 6)))
+            part = f"<{tag}>{items}</{tag}>"
+        elif kind < 0.35:
+            part = f"<pre>{_paragraph(rnd)}</pre>"
+        elif kind < 0.45:
+            part = (
+                f"<div><p>{_sentence(rnd)} <a href='https://example.com/{rnd.choice(WORDS)}'>{rnd.choice(WORDS)}</a> "
+                f"<strong>{_sentence(rnd)}</strong><br/><em>{_sentence(rnd)}</em></p></div>"
+            )
+        else:
+            part = f"<p>{_paragraph(rnd)} <span>{_sentence(rnd)}</span></p>"
+        parts.append(part)
+        length += len(part)
+    return "".join(parts)
+
+
+def groove_article(size: int, seed: int = 0) -> dict:
+    rnd = random.Random(seed)
+    return {
+        "title": _sentence(rnd)[:-1],
+        "tags": rnd.sample(WORDS, 3),
+        "related_titles": [_sentence(rnd)[:-1] for _ in range(2)],
+        "slug": "-".join(rnd.sample(WORDS, 3)),
+        "id": str(seed),
+        "body": html_body(size, seed),
+    }
+
+
+def vivantio_article(size: int, seed: int = 0) -> dict:
+    rnd = random.Random(seed)
+    return {
+        "Title": _sentence(rnd)[:-1],
+        "CategoryName": rnd.choice(WORDS),
+        "ThemeName": rnd.choice(WORDS),
+        "Keywords": rnd.sample(WORDS, 3),
+        "Id": seed,
+        "Text": html_body(size, seed),
+    }
+
+
+def html_page(size: int, seed: int = 0) -> str:
+    # crawled help center page, navigation in header and footer links to other pages
+    rnd = random.Random(seed)
+    nav = "".join(f"<a href='/docs/{rnd.choice(WORDS)}/{rnd.choice(WORDS)}'>{rnd.choice(WORDS)}</a>" for _ in range(30))
+    return (
+        f"<!DOCTYPE html><html><head><title>{_sentence(rnd)[:-1]}</title></head><body>"
+        f"<header><nav>{nav}</nav></header><main>{html_body(size, seed)}</main>"
+        f"<footer>{nav}</footer><div class='kb-footer'>{_sentence(rnd)}</div></body></html>"
+    )
+
+
+def html_pages(size: int, page_size: int = 20 * 2**10) -> List[str]:
+    return [html_page(page_size, seed) for seed in range(max(1, size // page_size))]
+
+
+def docx_bytes(size: int, seed: int = 0) -> bytes:
+    rnd = random.Random(seed)
+    document = docx.Document()
+    length = 0
+    while length < size:
+        kind = rnd.random()
+        if kind < 0.1:
+            text = _sentence(rnd)[:-1]
+            document.add_heading(text, level=rnd.randint(1, 2))
+            length += len(text)
+        elif kind < 0.3:
+            style = rnd.choice(["List Number", "List Bullet"])
+            for _ in range(rnd.randint(2, 6)):
+                text = _sentence(rnd)
+                document.add_paragraph(text, style=style)
+                length += len(text)
+        else:
+            text = _paragraph(rnd)
+            document.add_paragraph(text)
+            length += len(text)
+    stream = io.BytesIO()
+    document.save(stream)
+    return stream.getvalue()
+
+
+def xlsx_bytes(size: int, seed: int = 0) -> bytes:
+    # a parts catalog, a row per part with a sentence or two of notes
+    rnd = random.Random(seed)
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet("Parts")
+    sheet.append(["Part", "Name", "Category", "Price", "Notes"])
+    length, i = 0, 0
+    while length < size:
+        notes = " ".join(_sentence(rnd) for _ in range(rnd.randint(0, 2)))
+        row = [f"P-{i:06d}", " ".join(rnd.choice(WORDS) for _ in range(3)), rnd.choice(WORDS), i % 997 / 10, notes]
+        sheet.append(row)
+        length += sum(len(str(value)) for value in row)
+        i += 1
+    stream = io.BytesIO()
+    workbook.save(stream)
+    return stream.getvalue()
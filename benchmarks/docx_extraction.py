@@ -0,0 +1,62 @@
+"""
+Compares DocxParser.stream2text against the previous implementation, which loaded the whole
+document with python-docx and converted it to a json tree with simplify_docx before reading
+its paragraphs. Checks that both produce the same text. Needs simplify-docx, which the
+backend no longer depends on.
+
+    python -m benchmarks.docx_extraction --size-kb 256 1024
+"""
+import io
+import time
+from argparse import ArgumentParser
+
+import docx
+from simplify_docx import simplify
+
+from benchmarks.corpora import docx_bytes
+from parsers.docx_parser_ import DocxParser, ListingDispatcher
+
+
+def legacy(data: bytes) -> str:
+    structure = simplify(docx.Document(io.BytesIO(data)))
+    body = next(ent["VALUE"] for ent in structure["VALUE"] if ent["TYPE"] == "body")
+    contents, ld = [], None
+    for paragraph in body:
+        if paragraph["TYPE"] != "paragraph":
+            continue
+        text = "".join(item["VALUE"] for item in paragraph["VALUE"] if item["TYPE"] == "text")
+        if "numPr" in paragraph.get("style", {}):
+            if ld is None:
+                ld = ListingDispatcher(numbered=(paragraph["style"]["numPr"]["numId"] in [0, 2]))
+            text = f"{ld.get_prefix(paragraph['style']['numPr']['ilvl'])}{text}"
+        else:
+            ld = None
+        contents.append(text)
+    return "\n".join(contents)
+
+
+def streaming(data: bytes) -> str:
+    return DocxParser(1024).stream2text(io.BytesIO(data))
+
+
+def measure(func, data: bytes):
+    start = time.perf_counter()
+    text = func(data)
+    return text, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--size-kb", type=int, nargs="+", default=[64, 256, 1024])
+    args = parser.parse_args()
+
+    for size_kb in args.size_kb:
+        data = docx_bytes(size_kb * 1024)
+        mb = len(data) / 2**20
+        old_text, old_time = measure(legacy, data)
+        new_text, new_time = measure(streaming, data)
+        assert old_text == new_text, f"Text differs on {size_kb}KB"
+        print(
+            f"{size_kb:>6}KB of text, {mb:6.2f}MB docx | "
+            f"legacy {mb / old_time:7.2f} MB/s | streaming {mb / new_time:7.2f} MB/s | x{old_time / new_time:.1f}"
+        )
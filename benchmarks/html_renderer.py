@@ -0,0 +1,263 @@
+"""
+Compares html rendering of HTMLParser against the previous implementation, which recursed
+through render_text, render_tag and render_list and marked h1 and h2 inside of other tags with
+%%%%% sentinels, cut out of the rendered text afterwards. Both feed the same ChunksManager,
+checks that they produce the same chunks.
+
+    python -m benchmarks.html_renderer --size-kb 64 256
+"""
+import re
+import time
+from argparse import ArgumentParser
+from collections import deque
+from typing import List
+
+from bs4 import BeautifulSoup
+from bs4.element import NavigableString, Tag
+
+from benchmarks.corpora import groove_article, vivantio_article
+from parsers.html_parser import ChunksManager, GrooveHTMLParser, VivantioHTMLParser
+
+SENTINEL = "%%%%%"
+
+
+class LegacyRenderer:
+    """
+    Rendering methods of the previous HTMLParser, they take precedence over those of the
+    parser they are mixed into.
+    """
+
+    def render_list(self, elem: Tag, depth=0):
+        ordered = elem.name == "ol"
+        items = []
+        cnter = 1
+        for ch in elem.children:
+            if isinstance(ch, NavigableString):
+                continue
+            if ch.name in ["ol", "ul"]:
+                items.append(self.render_list(ch, depth=depth + 1))
+                continue
+            elif ch.name == "br":
+                continue
+            elif ch.name in ["p", "h1", "h2", "h3", "h4", "h5", "h6", "div"]:
+                items.append(self.render_text(ch))
+                continue
+            elif ch.name in ["img"]:
+                continue
+            assert ch.name in ["li", "option"], (ch.name, type(ch))
+            pref = " " * (2 * depth) + (f"{cnter}. " if ordered else "* ")
+            text_within = self.render_text(ch, list_depth=depth + 1)
+            items.append(f"{pref}{text_within}")
+            cnter += 1
+        return "\n".join(items)
+
+    def render_link(self, elem: Tag) -> str:
+        if "href" not in elem.attrs:
+            return self.render_text(elem)
+        link = elem.attrs["href"]
+        if link.startswith("#"):
+            return self.render_text(elem)
+        else:
+            return f"{self.render_text(elem)} (link:{elem.attrs['href']})"
+
+    def render_code(self, elem: Tag) -> str:
+        return f"\n{self.render_text(elem)}\n"
+
+    def render_text(self, elem: Tag, list_depth=0):
+        parts = []
+        for ch in elem.children:
+            if ch.name is None:
+                rendered = ch
+            elif ch.name in ["ul", "ol"]:
+                rendered = self.render_list(ch, depth=list_depth)
+            elif ch.name == "pre":
+                rendered = "".join(ch.strings) + "\n"
+            elif ch.name == "a":
+                rendered = self.render_link(ch)
+            elif ch.name in [
+                "span",
+                "code",
+                "em",
+                "strong",
+                "p",
+                "small",
+                "div",
+                "sub",
+                "sup",
+                "label",
+                "time",
+                "u",
+                "b",
+                "span2.",
+                "i",
+                "center",
+                "var",
+                "font",
+                "option",
+            ]:
+                rendered = self.render_text(ch)
+            elif ch.name.startswith("st1:") or ch.name.startswith("mailto") or ch.name.startswith("http"):
+                rendered = self.render_text(ch)
+            elif ch.name in ["br", "hr"]:
+                rendered = "\n"
+            elif ch.name in ["img", "iframe", "style"]:
+                continue
+            elif ch.name == "table":
+                rendered = ""
+            elif ch.name in ["script"]:
+                rendered = self.render_code(ch)
+            elif ch.name in ["h1", "h2"]:
+                rendered = f"{SENTINEL}{self.render_text(ch)}{SENTINEL}"
+            elif ch.name in ["h3", "h4", "h5", "h6"]:
+                rendered = f"\n{self.render_text(ch)}"
+            elif ch.name in ["li"]:
+                rendered = f"\n* {self.render_text(ch)}"
+            elif ch.name in [
+                "o:p",
+                'br=""',
+                "source",
+                "audio",
+                "video",
+                "input",
+                "picture",
+                "w:wrap",
+                "o:o:p",
+                "noscript",
+                "table",
+            ]:
+                continue
+            elif ch.name.startswith("v:"):
+                continue
+            else:
+                assert False, f"Unknown tag parsing text: {ch.name}: {self.render_text(ch)}"
+            parts.append(rendered)
+        return "".join(parts).strip()
+
+    def render_tag(self, elem: Tag) -> str:
+        if elem.name in ["ul", "ol", "select"]:
+            return self.render_list(elem)
+        elif elem.name == "a":
+            return self.render_link(elem)
+        elif elem.name in ["p"]:
+            return self.render_text(elem)
+        elif elem.name in [
+            "div",
+            "blockquote",
+            "strong",
+            "br",
+            "hr",
+            "span",
+            "b",
+            "font",
+            "u",
+            "i",
+            "center",
+            "em",
+            "option",
+            "sup",
+        ]:
+            return self.render_text(elem)
+        elif elem.name == "pre":
+            return "".join(elem.strings)
+        elif elem.name == "table":
+            return ""
+        elif elem.name == "li":
+            return f"\n*{self.render_text(elem)}"
+        elif elem.name in [
+            "style",
+            "meta",
+            "noscript",
+            "title",
+            "link",
+            "form",
+            "button",
+            "figure",
+            "header",
+            "video",
+            "script",
+            "database",
+        ]:
+            return ""
+        elif elem.name in ["code"]:
+            return self.render_code(elem)
+        elif elem.name.startswith("mailto"):
+            return self.render_text(elem)
+        elif elem.name.startswith("w:") or elem.name.startswith("http"):
+            return ""
+        else:
+            print(f"Unknown tag with name {elem.name}!: {''.join(elem.strings)}")
+            return "".join(elem.strings)
+
+    def _extract_headers(self, text: str) -> List[List[str]]:
+        regex = re.compile(rf"{SENTINEL}(.+?){SENTINEL}")
+        parts, start = [], 0
+        for m in regex.finditer(text):
+            if m.start() > start:
+                parts.append([text[start : m.start()], "text"])
+            parts.append([m.group(1), "header"])
+            start = m.end()
+        if start < len(text) or len(parts) == 0:
+            parts.append([text[start:], "text"])
+        return parts
+
+    def process_document(self, article: dict, debug=False):
+        meta, body, meta_info = self.preprocess_document(article)
+
+        parsed = BeautifulSoup(body, features="html.parser")
+        queue = deque(parsed.children)
+        chunks_manager = ChunksManager(meta)
+        while len(queue) > 0:
+            ch = queue.popleft()
+            if isinstance(ch, Tag):
+                if ch.name in ["div", "html", "body"]:
+                    queue.extendleft(list(ch.children)[::-1])
+                elif ch.name in ["h1", "h2"]:
+                    chunks_manager.update([[self.render_text(ch), "header"]])
+                elif ch.name in ["h3", "h4", "h5", "h6"]:
+                    chunks_manager.update([[f"\n\n{self.render_text(ch)}", "text"]])
+                elif ch.name in ["iframe", "img", "head"]:
+                    continue
+                else:
+                    chunks_manager.update(self._extract_headers(self.render_tag(ch)))
+
+        chunks = chunks_manager.digest()
+
+        if len(chunks) == 0:
+            return [], None
+        return ["\n".join([ch["title"], ch["text"]]).strip() for ch in chunks], meta_info
+
+
+class LegacyGrooveHTMLParser(LegacyRenderer, GrooveHTMLParser):
+    pass
+
+
+class LegacyVivantioHTMLParser(LegacyRenderer, VivantioHTMLParser):
+    pass
+
+
+def measure(parser, article: dict):
+    start = time.perf_counter()
+    chunks, _ = parser.process_document(article)
+    return chunks, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--size-kb", type=int, nargs="+", default=[64, 256, 1024])
+    args = parser.parse_args()
+
+    corpora = [
+        ("groove", groove_article, "body", LegacyGrooveHTMLParser(), GrooveHTMLParser()),
+        ("vivantio", vivantio_article, "Text", LegacyVivantioHTMLParser(), VivantioHTMLParser()),
+    ]
+    for corpus_name, make_article, body_key, legacy, iterative in corpora:
+        for size_kb in args.size_kb:
+            article = make_article(size_kb * 1024)
+            mb = len(article[body_key].encode()) / 2**20
+            old_chunks, old_time = measure(legacy, article)
+            new_chunks, new_time = measure(iterative, article)
+            assert old_chunks == new_chunks, f"Chunks differ on {corpus_name} {size_kb}KB"
+            print(
+                f"{corpus_name:>8} {size_kb:>6}KB {len(new_chunks):>6} chunks | "
+                f"legacy {mb / old_time:7.2f} MB/s | iterative {mb / new_time:7.2f} MB/s | x{old_time / new_time:.1f}"
+            )
@@ -0,0 +1,132 @@
+"""
+Compares the per-collection Milvus layout with the shared one on synthetic collections, reporting
+memory of loaded segments, p50/p95 latency of searches of one collection and time to load
+everything. Every collection gets the index `choose_index` picks for its size, in the shared
+layout it is the one of all rows together. Needs a running Milvus 2.2.9 or newer, set by
+`[milvus]` in config.ini and MILVUS_USERNAME/MILVUS_PASSWORD, its collections are dropped after.
+
+    python -m benchmarks.milvus_layout --tenants 10 100 --chunks 1000
+"""
+import os
+import time
+from argparse import ArgumentParser
+from typing import Callable, List
+
+import numpy as np
+from pymilvus import Collection, CollectionSchema, DataType, FieldSchema, connections, utility
+
+from utils import CONFIG
+from utils.vector_index import choose_index
+
+PREFIX = "bench_layout_"
+DIM = 1536
+
+
+def create(name: str, n_entities: int, tenant_key: bool) -> Collection:
+    fields = [
+        FieldSchema(name="pk", dtype=DataType.INT64, is_primary=True, auto_id=True),
+        FieldSchema(name="chunk", dtype=DataType.VARCHAR, max_length=int(CONFIG["milvus"]["chunk_max_symbols"])),
+        FieldSchema(name="emb_v1", dtype=DataType.FLOAT_VECTOR, dim=DIM),
+    ]
+    if tenant_key:
+        fields.append(FieldSchema(name="tenant", dtype=DataType.VARCHAR, max_length=1024, is_partition_key=True))
+    collection = Collection(name, CollectionSchema(fields))
+    collection.create_index(field_name="emb_v1", index_params=choose_index(n_entities)[0])
+    return collection
+
+
+def vectors(rng: np.random.Generator, n: int) -> List[List[float]]:
+    # embeddings are normalized, like those of the embeddings model
+    vecs = rng.standard_normal((n, DIM), dtype=np.float32)
+    return (vecs / np.linalg.norm(vecs, axis=1, keepdims=True)).tolist()
+
+
+def insert(collection: Collection, rng: np.random.Generator, n: int, tenant: str = None, batch_size: int = 1000):
+    for start in range(0, n, batch_size):
+        size = min(batch_size, n - start)
+        data = [[f"chunk {start + i} of {tenant}" for i in range(size)], vectors(rng, size)]
+        if tenant is not None:
+            data.append([tenant] * size)
+        collection.insert(data)
+
+
+def load(collections: List[Collection]) -> float:
+    start = time.perf_counter()
+    for collection in collections:
+        collection.flush()
+        utility.wait_for_index_building_complete(collection.name)
+        collection.load()
+    return time.perf_counter() - start
+
+
+def memory_mb(collections: List[Collection]) -> float:
+    return sum(segment.mem_size for c in collections for segment in utility.get_query_segment_info(c.name)) / 2**20
+
+
+def latencies_ms(search: Callable[[int, List[float]], None], rng: np.random.Generator, n_tenants: int, n: int):
+    times = []
+    for vec, tenant in zip(vectors(rng, n), rng.integers(0, n_tenants, n)):
+        start = time.perf_counter()
+        search(int(tenant), vec)
+        times.append((time.perf_counter() - start) * 1000)
+    return np.percentile(times, 50), np.percentile(times, 95)
+
+
+def drop():
+    for name in utility.list_collections():
+        if name.startswith(PREFIX):
+            utility.drop_collection(name)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--tenants", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--chunks", type=int, default=1000, help="Chunks of every collection")
+    parser.add_argument("--searches", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=int(CONFIG["misc"]["collections_search_limit"]))
+    args = parser.parse_args()
+
+    connections.connect(
+        "default",
+        host=CONFIG["milvus"]["host"],
+        port=CONFIG["milvus"]["port"],
+        user=os.environ["MILVUS_USERNAME"],
+        password=os.environ["MILVUS_PASSWORD"],
+    )
+    rng = np.random.default_rng(0)
+    drop()
+    try:
+        for n_tenants in args.tenants:
+            _, own_params = choose_index(args.chunks)
+            own = [create(f"{PREFIX}{i}", args.chunks, tenant_key=False) for i in range(n_tenants)]
+            for collection in own:
+                insert(collection, rng, args.chunks)
+            _, shared_params = choose_index(n_tenants * args.chunks)
+            shared = create(f"{PREFIX}shared", n_tenants * args.chunks, tenant_key=True)
+            for i in range(n_tenants):
+                insert(shared, rng, args.chunks, tenant=f"{PREFIX}{i}")
+
+            layouts = {
+                "per_collection": (
+                    own,
+                    lambda i, vec: own[i].search([vec], "emb_v1", own_params, args.top_k),
+                ),
+                "shared": (
+                    [shared],
+                    lambda i, vec: shared.search(
+                        [vec], "emb_v1", shared_params, args.top_k, f'tenant == "{PREFIX}{i}"'
+                    ),
+                ),
+            }
+            for layout, (collections, search) in layouts.items():
+                seconds = load(collections)
+                p50, p95 = latencies_ms(search, rng, n_tenants, args.searches)
+                print(
+                    f"{n_tenants:>5} x {args.chunks} {layout:>14} | {memory_mb(collections):9.1f} MB | "
+                    f"search p50 {p50:6.2f} ms p95 {p95:6.2f} ms | load {seconds:6.2f} s"
+                )
+                for collection in collections:
+                    collection.release()
+            drop()
+    finally:
+        drop()
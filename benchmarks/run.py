@@ -0,0 +1,277 @@
+"""
+Throughput benchmarks of the CPU-bound ingestion paths on deterministic synthetic corpora.
+
+    python -m benchmarks.run                                   # print results
+    python -m benchmarks.run --save benchmarks/baseline.json   # record a baseline
+    python -m benchmarks.run --compare benchmarks/baseline.json --threshold 0.2
+
+A comparison run exits with code 1 if any case got slower than the baseline by more
+than `threshold` (in MB/s). Runs offline: if the tiktoken encoding can not be downloaded, the
+chunker runs with a local stand-in (see benchmarks/tokenizer.py) and results are stored with the
+encoding used, cases are only compared with a baseline of the same encoding. nltk punkt data is
+still needed unless `sentence_splitter` is regex.
+"""
+import asyncio
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from typing import Any, Callable, Dict, List, Tuple
+
+import fitz
+
+from benchmarks import TOKENIZER, corpora
+from parsers.chunk_splitter import merge_texts, split_text
+from parsers.docx_parser_ import DocxParser
+from parsers.general_parser import GeneralParser
+from parsers.html_parser import GrooveHTMLParser, VivantioHTMLParser
+from parsers.markdown_parser import MarkdownParser
+from parsers.page_parser import parse_html, run_parser
+from parsers.pdf_parser import PdfParser, extract_page_range
+from parsers.spreadsheet_parser import SpreadsheetParser
+from utils import CONFIG
+from utils.tokenize_ import chats_to_chunks, doc_to_chunks, docs_to_chunks
+
+SIZES = {"1k": 2**10, "10k": 10 * 2**10, "100k": 100 * 2**10, "1m": 2**20, "10m": 10 * 2**20}
+CHUNK_SIZE = int(CONFIG["handlers"]["chunk_size"])
+# files the parsers read from, removed at exit
+FILES_DIR = tempfile.TemporaryDirectory(prefix="benchmarks-")
+
+
+class Case:
+    """
+    `setup` builds the input of a given size once and returns it together with its size in bytes,
+    `run` processes the input and returns the number of chunks (or pages) produced.
+    """
+
+    def __init__(self, name: str, setup: Callable[[int], Tuple[Any, int]], run: Callable[[Any], int]):
+        self.name = name
+        self.setup = setup
+        self.run = run
+
+
+def _text_input(make_text: Callable[[int], str]) -> Callable[[int], Tuple[str, int]]:
+    def setup(size: int) -> Tuple[str, int]:
+        text = make_text(size)
+        return text, len(text.encode())
+
+    return setup
+
+
+def _markdown_file(size: int) -> Tuple[str, int]:
+    text = corpora.markdown_text(size)
+    path = os.path.join(FILES_DIR.name, f"document-{size}.md")
+    with open(path, "wt") as f:
+        f.write(text)
+    return path, len(text.encode())
+
+
+def _sentences(size: int) -> Tuple[List[str], int]:
+    text = corpora.pdf_text(size)
+    return GeneralParser.text_to_sentences(text), len(text.encode())
+
+
+def _chats(size: int) -> Tuple[List[List[str]], int]:
+    chats = corpora.chats_lines(size)
+    return chats, sum(len(line.encode()) + 1 for lines in chats for line in lines)
+
+
+def _chats_as_docs(chats: List[List[str]]) -> int:
+    # the previous chat chunking, a chat joined into one document with a message per line
+    chunks = docs_to_chunks(["---***---".join(lines) for lines in chats], splitter="---***---", overlapping_lines=10)
+    return sum(map(len, chunks))
+
+
+def _article(make_article: Callable[[int], dict], body_key: str) -> Callable[[int], Tuple[dict, int]]:
+    def setup(size: int) -> Tuple[dict, int]:
+        article = make_article(size)
+        return article, len(article[body_key].encode())
+
+    return setup
+
+
+def _binary(make_bytes: Callable[[int], bytes]) -> Callable[[int], Tuple[bytes, int]]:
+    def setup(size: int) -> Tuple[bytes, int]:
+        data = make_bytes(size)
+        return data, len(data)
+
+    return setup
+
+
+def _html_pages(size: int) -> Tuple[List[str], int]:
+    pages = corpora.html_pages(size)
+    return pages, sum(len(page.encode()) for page in pages)
+
+
+def _parse_pages(parser: str) -> Callable[[List[str]], int]:
+    # one page per "chunk", so chunks/s is pages/s
+    def run(pages: List[str]) -> int:
+        for page in pages:
+            parse_html("https://example.com/docs/", page, True, parser)
+        return len(pages)
+
+    return run
+
+
+def _parse_pages_in_pool(pages: List[str]) -> int:
+    async def parse_all():
+        await asyncio.gather(*[run_parser(parse_html, "https://example.com/docs/", page, True) for page in pages])
+
+    asyncio.run(parse_all())
+    return len(pages)
+
+
+def _pdf_pages(data: bytes) -> int:
+    # stream2text returns plain text, so the number of extracted lines stands in for chunks
+    return PdfParser(CHUNK_SIZE).stream2text(data).count("\n")
+
+
+def _pdf_extract_inline(data: bytes) -> int:
+    # one page per "chunk", so chunks/s is pages/s
+    with fitz.open(stream=data, filetype="pdf") as doc:
+        n_pages = len(doc)
+    return len(extract_page_range(data, 0, n_pages))
+
+
+def _pdf_extract_in_pool(data: bytes) -> int:
+    return len(PdfParser(CHUNK_SIZE).extract_pages(data))
+
+
+def _docx_lines(data: bytes) -> int:
+    return DocxParser(CHUNK_SIZE).stream2text(io.BytesIO(data)).count("\n")
+
+
+def _xlsx_rows(data: bytes) -> int:
+    # a line per row, so chunks/s is rows/s
+    return SpreadsheetParser(CHUNK_SIZE).stream2text(io.BytesIO(data), ".xlsx").count("\n") + 1
+
+
+CASES = [
+    Case("split_text", _text_input(corpora.markdown_text), lambda text: len(merge_texts(split_text(text), 1024))),
+    Case("doc_to_chunks/markdown", _text_input(corpora.markdown_text), lambda text: len(doc_to_chunks(text))),
+    Case("doc_to_chunks/pdf", _text_input(corpora.pdf_text), lambda text: len(doc_to_chunks(text))),
+    Case("docs_to_chunks/chats", _chats, _chats_as_docs),
+    Case("chats_to_chunks", _chats, lambda chats: sum(map(len, chats_to_chunks(chats)))),
+    Case(
+        "GeneralParser.chunkise_sentences",
+        _sentences,
+        lambda sentences: len(GeneralParser.chunkise_sentences(sentences, CHUNK_SIZE)),
+    ),
+    Case(
+        "MarkdownParser.process_file",
+        _markdown_file,
+        lambda path: len(MarkdownParser(CHUNK_SIZE).process_file(path)[0]),
+    ),
+    Case(
+        "MarkdownParser.preprocess_text",
+        _text_input(corpora.hugo_markdown_text),
+        # preprocessing returns plain text, so the number of lines stands in for chunks
+        lambda text: MarkdownParser(CHUNK_SIZE).preprocess_text(text)[0].count("\n"),
+    ),
+    Case(
+        "GrooveHTMLParser.process_document",
+        _article(corpora.groove_article, "body"),
+        lambda article: len(GrooveHTMLParser().process_document(article)[0]),
+    ),
+    Case(
+        "VivantioHTMLParser.process_document",
+        _article(corpora.vivantio_article, "Text"),
+        lambda article: len(VivantioHTMLParser().process_document(article)[0]),
+    ),
+    Case("parse_html/html.parser", _html_pages, _parse_pages("html.parser")),
+    Case("parse_html/lxml", _html_pages, _parse_pages("lxml")),
+    Case(f"parse_html/pool of {CONFIG['crawler']['parse_workers']}", _html_pages, _parse_pages_in_pool),
+    Case("PdfParser.stream2text", _binary(corpora.pdf_bytes), _pdf_pages),
+    Case("DocxParser.stream2text", _binary(corpora.docx_bytes), _docx_lines),
+    Case("SpreadsheetParser.stream2text", _binary(corpora.xlsx_bytes), _xlsx_rows),
+    Case("extract_pages/inline", _binary(corpora.pdf_bytes), _pdf_extract_inline),
+    Case(
+        f"extract_pages/pool of {CONFIG['crawler']['parse_workers']}", _binary(corpora.pdf_bytes), _pdf_extract_in_pool
+    ),
+]
+
+
+def measure(case: Case, size: int, repeats: int) -> Dict[str, float]:
+    data, n_bytes = case.setup(size)
+    best, n_chunks = float("inf"), 0
+    for _ in range(repeats):
+        start = time.perf_counter()
+        n_chunks = case.run(data)
+        best = min(best, time.perf_counter() - start)
+
+    # separate run, tracemalloc slows everything down
+    tracemalloc.start()
+    case.run(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "bytes": n_bytes,
+        "seconds": best,
+        "mb_per_s": n_bytes / 2**20 / best,
+        "chunks_per_s": n_chunks / best,
+        "peak_mb": peak / 2**20,
+        "tokenizer": TOKENIZER,
+    }
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float) -> List[str]:
+    regressions = []
+    for key, result in results.items():
+        # results of another encoding differ in the number of tokens, they are not comparable
+        if key not in baseline or baseline[key].get("tokenizer", CONFIG["handlers"]["tokenizer_name"]) != TOKENIZER:
+            continue
+        ratio = result["mb_per_s"] / baseline[key]["mb_per_s"]
+        if ratio < 1 - threshold:
+            regressions.append(
+                f"{key}: {result['mb_per_s']:.2f} MB/s vs {baseline[key]['mb_per_s']:.2f} MB/s in baseline ({ratio:.0%})"
+            )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=["1k", "100k", "1m", "10m"])
+    parser.add_argument("--cases", nargs="+", default=None, help="Substrings of case names to run")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--save", type=str, default=None, help="Path to write results to as a baseline")
+    parser.add_argument("--compare", type=str, default=None, help="Path to a baseline to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed relative slowdown vs baseline")
+    args = parser.parse_args()
+
+    results = {}
+    if TOKENIZER != CONFIG["handlers"]["tokenizer_name"]:
+        print(f"Running with {TOKENIZER}, only baselines recorded with it are compared")
+    for case in CASES:
+        if args.cases and not any(pattern in case.name for pattern in args.cases):
+            continue
+        for size_name in args.sizes:
+            # large inputs are run once, they are slow enough to be stable
+            repeats = args.repeats if SIZES[size_name] < 2**20 else 1
+            result = measure(case, SIZES[size_name], repeats)
+            key = f"{case.name}@{size_name}"
+            results[key] = result
+            print(
+                f"{key:<45} {result['mb_per_s']:>9.2f} MB/s {result['chunks_per_s']:>11.1f} chunks/s "
+                f"{result['peak_mb']:>9.1f} MB peak",
+                flush=True,
+            )
+
+    if args.save:
+        with open(args.save, "wt") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.save}")
+
+    if args.compare:
+        with open(args.compare, "rt") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"Regressions beyond {args.threshold:.0%}:")
+            print("\n".join(regressions))
+            sys.exit(1)
+        print(f"No regressions beyond {args.threshold:.0%}")
@@ -0,0 +1,45 @@
+"""
+Compares sentence splitters on sentences with abbreviations, initials and version numbers
+between plain ones, reporting throughput and how many of the true sentence boundaries each
+of them finds (recall) and how many of the boundaries it finds are true (precision).
+The punkt splitter needs nltk punkt data.
+
+    python -m benchmarks.sentences --size-kb 64 1024 --splitters regex punkt
+"""
+import time
+from argparse import ArgumentParser
+from itertools import accumulate
+from typing import List, Set
+
+from benchmarks.corpora import gold_sentences
+from utils.sentences import SENTENCE_SPLITTERS, get_sentence_splitter
+
+
+def boundaries(sentences: List[str]) -> Set[int]:
+    # offsets of sentence ends in the text made of the sentences joined by spaces
+    return set(accumulate(len(sentence) + 1 for sentence in sentences[:-1]))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--size-kb", type=int, nargs="+", default=[64, 1024])
+    parser.add_argument("--splitters", nargs="+", choices=list(SENTENCE_SPLITTERS), default=list(SENTENCE_SPLITTERS))
+    args = parser.parse_args()
+
+    for size_kb in args.size_kb:
+        gold = gold_sentences(size_kb * 1024)
+        text = " ".join(gold)
+        mb = len(text.encode()) / 2**20
+        expected = boundaries(gold)
+        for name in args.splitters:
+            split = get_sentence_splitter(name)
+            split("Warming up. Loading models.")
+            start = time.perf_counter()
+            sentences = split(text)
+            seconds = time.perf_counter() - start
+            found = boundaries(sentences)
+            true_positives = len(found & expected)
+            print(
+                f"{size_kb:>6}KB {name:>6} | {mb / seconds:7.2f} MB/s | {len(sentences):>7} sentences | "
+                f"precision {true_positives / max(1, len(found)):.3f} | recall {true_positives / len(expected):.3f}"
+            )
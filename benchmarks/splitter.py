@@ -0,0 +1,86 @@
+"""
+Compares split_text and merge_texts against the previous implementation, which collected
+newlines of every part with a per-character loop, recursed on the halves and deep-copied
+every merged chunk. Checks that both produce the same chunks.
+
+    python -m benchmarks.splitter --size-kb 256 1024
+"""
+import sys
+import time
+from argparse import ArgumentParser
+from copy import deepcopy
+from typing import List
+
+from benchmarks.corpora import markdown_text, pdf_text
+from parsers.chunk_splitter import SECTION_MAX_LENGTH, merge_texts, split_text
+
+
+def legacy_split(chunk: dict) -> List[dict]:
+    if len(chunk["text"]) < SECTION_MAX_LENGTH:
+        return [chunk]
+    txt = chunk["text"]
+    n_ids = []
+    for i in range(len(txt)):
+        if txt[i] == "\n":
+            n_ids.append(i)
+    if len(n_ids) == 0:
+        part = {"title": chunk["title"], "text": chunk["text"][:SECTION_MAX_LENGTH]}
+        remaining = {"title": chunk["title"], "text": chunk["text"][SECTION_MAX_LENGTH:]}
+        return [part] + legacy_split(remaining)
+    split_id = n_ids[len(n_ids) // 2]
+    part = {"title": chunk["title"], "text": chunk["text"][:split_id]}
+    remaining = {"title": chunk["title"], "text": chunk["text"][split_id + 1 :]}
+    return legacy_split(part) + legacy_split(remaining)
+
+
+def legacy_compress(chunks: List[dict], max_length: int) -> List[dict]:
+    new_chunks = []
+    cur_chunk = chunks[0]
+    for chunk in chunks[1:]:
+        if len(cur_chunk["text"]) + len(chunk["text"]) < max_length:
+            cur_chunk["text"] += f"\n{chunk['text']}"
+        else:
+            new_chunks.append(deepcopy(cur_chunk))
+            cur_chunk = chunk
+    new_chunks.append(cur_chunk)
+    return new_chunks
+
+
+def legacy(text: str, max_length: int) -> List[str]:
+    return [chunk["text"] for chunk in legacy_compress(legacy_split({"title": "", "text": text}), max_length)]
+
+
+def linear(text: str, max_length: int) -> List[str]:
+    return merge_texts(split_text(text), max_length)
+
+
+def measure(func, text: str, max_length: int):
+    start = time.perf_counter()
+    chunks = func(text, max_length)
+    return chunks, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--size-kb", type=int, nargs="+", default=[64, 256, 1024])
+    parser.add_argument("--max-length", type=int, default=1024, help="Length of merged chunks, 1024 in markdown")
+    args = parser.parse_args()
+    # long sections without breaks recurse once per cut in the legacy splitter
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), max(args.size_kb) * 1024 // SECTION_MAX_LENGTH + 1000))
+
+    corpora = [
+        ("markdown", markdown_text),
+        ("pdf", pdf_text),
+        ("one line", lambda size: markdown_text(size).replace("\n", " ")),
+    ]
+    for corpus_name, make_corpus in corpora:
+        for size_kb in args.size_kb:
+            text = make_corpus(size_kb * 1024)
+            mb = len(text.encode()) / 2**20
+            old_chunks, old_time = measure(legacy, text, args.max_length)
+            new_chunks, new_time = measure(linear, text, args.max_length)
+            assert old_chunks == new_chunks, f"Chunks differ on {corpus_name} {size_kb}KB"
+            print(
+                f"{corpus_name:>8} {size_kb:>6}KB {len(new_chunks):>6} chunks | "
+                f"legacy {mb / old_time:7.2f} MB/s | linear {mb / new_time:7.2f} MB/s | x{old_time / new_time:.1f}"
+            )
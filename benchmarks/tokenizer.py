@@ -0,0 +1,53 @@
+"""
+A stand-in for the tiktoken encoding of the chunker on machines which can not download it. It splits
+text with the pretokenization pattern of cl100k_base and has a vocabulary of frequent pieces of the
+benchmark corpora, so it gives a similar number of tokens per byte on them, but not the same tokens.
+"""
+from collections import Counter
+
+import regex
+import tiktoken
+from loguru import logger
+
+from benchmarks.corpora import markdown_text, pdf_text
+
+CL100K_PATTERN = (
+    r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}++|\p{N}{1,3}+| ?[^\s\p{L}\p{N}]++[\r\n]*+|\s++$|\s*[\r\n]|"""
+    r"""\s+(?!\S)|\s"""
+)
+VOCABULARY_SIZE = 20000
+MAX_PIECE_BYTES = 16
+
+
+def local_encoding(name: str) -> tiktoken.Encoding:
+    counts = Counter(regex.findall(CL100K_PATTERN, markdown_text(2**18) + pdf_text(2**18)))
+    ranks = {bytes([byte]): byte for byte in range(256)}
+    pieces = [piece.encode() for piece, _ in counts.most_common(VOCABULARY_SIZE)]
+    # BPE reaches a token only through merges of its parts, so every part of a piece is a token as well,
+    # shorter parts get lower ranks and are merged first
+    parts = {
+        piece[i:j]
+        for piece in pieces
+        if len(piece) <= MAX_PIECE_BYTES
+        for i in range(len(piece))
+        for j in range(i + 2, len(piece) + 1)
+    }
+    for part in sorted(parts, key=lambda part: (len(part), part)):
+        ranks[part] = len(ranks)
+    return tiktoken.Encoding(
+        name=name, pat_str=CL100K_PATTERN, mergeable_ranks=ranks, special_tokens={"<|endoftext|>": len(ranks)}
+    )
+
+
+def ensure_encoding(name: str) -> str:
+    """
+    Makes `name` load with tiktoken.get_encoding, with the local stand-in if the encoding can not be
+    downloaded. Returns the name of the encoding in use, which benchmark results are stored with.
+    """
+    try:
+        tiktoken.get_encoding(name)
+        return name
+    except Exception as e:
+        logger.warning(f"Can not load tiktoken encoding {name} ({type(e).__name__}), using a local stand-in")
+    tiktoken.registry.ENCODINGS[name] = local_encoding(name)
+    return f"local:{name}"
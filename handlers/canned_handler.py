@@ -28,6 +28,7 @@ class CannedHandler:
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail=f"Requested canned answer creation for collection '{collection}', but it does not exist in vendor '{vendor}' and organization '{organization}'!",
             )
+        MILVUS_DB.check_writable(collection_name)
         collection = MILVUS_DB.get_or_create_collection(collection_name, schema=MilvusSchema.CANNED_V0)
         # TODO: do translation!!!
         if project_to_en:
@@ -87,6 +88,7 @@ class CannedHandler:
 
         collection_name = full_collection_name(vendor, organization, collection, is_canned=True)
         collection = MILVUS_DB[collection_name]
+        MILVUS_DB.check_writable(collection_name)
         collection.delete(f"pk in [{existing_canned.id}]")
 
         return {"status": "ok"}
@@ -108,6 +110,7 @@ class CannedHandler:
 
         collection_name = full_collection_name(vendor, organization, collection, is_canned=True)
         m_collection = MILVUS_DB[collection_name]
+        MILVUS_DB.check_writable(collection_name)
         m_collection.delete(f"pk in [{existing_canned.id}]")
 
         question = question if question is not None else existing_canned.question
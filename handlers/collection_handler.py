@@ -1,3 +1,4 @@
+import asyncio
 from collections import defaultdict
 from typing import List
 
@@ -6,7 +7,7 @@ import tiktoken
 from fastapi import HTTPException, status
 from loguru import logger
 
-from utils import AWS_TRANSLATE_CLIENT, MILVUS_DB, full_collection_name, ml_requests
+from utils import AWS_TRANSLATE_CLIENT, MILVUS_DB, file_doc_id, full_collection_name, ml_requests
 from utils.errors import DatabaseError, DocumentAccessRestricted, InvalidDocumentIdError
 from utils.misc import AsyncIterator, int_list_encode
 from utils.schemas import (
@@ -61,14 +62,19 @@ class CollectionHandler:
 
         query_embedding = (await ml_requests.get_embeddings(query, api_version.value))[0]
 
-        canned = MILVUS_DB.search_canned_collections(
-            vendor=vendor, organization=organization, collections=collections, vec=query_embedding
+        canned = await asyncio.to_thread(
+            MILVUS_DB.search_canned_collections,
+            vendor=vendor,
+            organization=organization,
+            collections=collections,
+            vec=query_embedding,
         )
 
         # In case of chat as input, search in canned not only by concatenated user messages
         # but also by last user message as well, because topic might change heavily
         if not canned and not query:
-            canned = MILVUS_DB.search_canned_collections(
+            canned = await asyncio.to_thread(
+                MILVUS_DB.search_canned_collections,
                 vendor=vendor,
                 organization=organization,
                 collections=collections,
@@ -97,7 +103,8 @@ class CollectionHandler:
 
         security_code = int_list_encode(user_security_groups)
 
-        similarities, chunks, titles, doc_ids, doc_summaries, doc_collections = MILVUS_DB.search_collections_set(
+        similarities, chunks, titles, doc_ids, doc_summaries, doc_collections = await asyncio.to_thread(
+            MILVUS_DB.search_collections_set,
             vendor,
             organization,
             collections,
@@ -243,7 +250,7 @@ class CollectionHandler:
         document_titles = {}
         for chunk in chunks:
             if chunk["security_groups"] & security_code:
-                doc_id, timestamp, doc_title = chunk["doc_id"], chunk["timestamp"], chunk["doc_title"]
+                doc_id, timestamp, doc_title = file_doc_id(chunk["doc_id"]), chunk["timestamp"], chunk["doc_title"]
                 documents[doc_id] = max(documents[doc_id], timestamp)
                 document_titles[doc_id] = doc_title
 
@@ -285,7 +292,8 @@ class CollectionHandler:
         # extracting more than top_k chunks because each
         # document might be represented by several chunks
         # collections_search = [f"{vendor}_{organization_hash}_{collection}" for collection in collections]
-        similarities, _, titles, doc_ids, doc_summaries, doc_collections = MILVUS_DB.search_collections_set(
+        similarities, _, titles, doc_ids, doc_summaries, doc_collections = await asyncio.to_thread(
+            MILVUS_DB.search_collections_set,
             vendor,
             organization,
             collections,
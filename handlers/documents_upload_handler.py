@@ -1,21 +1,55 @@
-from typing import List
+import asyncio
+from typing import AsyncIterator, List, Tuple
 
 from fastapi import HTTPException, UploadFile, status
 from loguru import logger
-from pymilvus.exceptions import DataNotMatchException
+from pymilvus import Collection
 from starlette.datastructures import UploadFile as StarletteUploadFile
 from tqdm import tqdm
 
 from parsers import DocumentsParser
-from utils import AWS_TRANSLATE_CLIENT, GRIDFS, MILVUS_DB, full_collection_name, hash_string, ml_requests
+from utils import (
+    CONFIG,
+    GRIDFS,
+    MILVUS_DB,
+    ROWS_DOC_SEPARATOR,
+    file_doc_id,
+    full_collection_name,
+    hash_string,
+    ml_requests,
+    rows_doc_id,
+)
+from utils.crawl_reports import save_crawl_report
+from utils.crawl_state import CrawlState, forget_pages
+from utils.crawler import CrawlStats
+from utils.document_locks import document_locks
 from utils.errors import DatabaseError
+from utils.frontier import Frontier, forget_urls
 from utils.schemas import Chat, CollectionDocumentsResponse, Doc, DocumentMetadata
+from utils.summaries import get_summaries
+
+CHUNK_COLUMNS = [
+    "chunk_hash",
+    "doc_id",
+    "chunk",
+    "emb_v1",
+    "doc_title",
+    "doc_summary",
+    "timestamp",
+    "security_groups",
+    "url",
+    "page_start",
+    "page_end",
+]
 
 
 class DocumentsUploadHandler:
     def __init__(self, parser: DocumentsParser):
         self.parser = parser
         self.insert_chunk_size = 500
+        self.backfill_tasks = set()
+        # one running index update per collection, inserts meanwhile are counted by it or by the next one
+        self.index_tasks = {}
 
     async def handle_request(
         self,
@@ -26,28 +60,170 @@ class DocumentsUploadHandler:
         documents: List[Doc] | List[Chat] | List[str] | List[UploadFile],
         ignore_urls: bool = True,
         metadata: List[DocumentMetadata] = None,
+        defer_summaries: bool = False,
     ) -> CollectionDocumentsResponse:
         if isinstance(documents[0], str):
-            # traversing each link, extracting all pages from each link,
-            # representing them as docs and flatten the list
-            documents_tmp, metadata_tmp = [], []
-            for link in documents:
-                link_documents, link_documents_metadata = await self.parser.link_to_docs(
-                    link, vendor=vendor, organization=organization, collection=collection, ignore_urls=ignore_urls
-                )
-                documents_tmp.extend(link_documents)
-                metadata_tmp.extend(link_documents_metadata)
-            documents = documents_tmp
-            metadata = metadata_tmp
+            n_chunks, crawl_id = await self.index_links(
+                api_version, vendor, organization, collection, documents, ignore_urls, defer_summaries
+            )
+            return CollectionDocumentsResponse(n_chunks=n_chunks, crawl_id=crawl_id)
 
         elif isinstance(documents[0], StarletteUploadFile):
-            documents = [
-                (await self.parser.raw_to_doc(pair[0], vendor, organization, collection, doc_id=pair[1].id))
-                for pair in zip(documents, metadata)
-            ]
+            parsed = await self.parser.raw_to_docs(
+                documents, vendor, organization, collection, doc_ids=[meta.id for meta in metadata]
+            )
+            collection = MILVUS_DB.get_or_create_collection(full_collection_name(vendor, organization, collection))
+            docs = [(doc, meta) for doc, meta in zip(parsed, metadata) if isinstance(doc, Doc)]
+            n_chunks = 0
+            if len(docs) > 0:
+                n_chunks += await self.index_documents(
+                    api_version, collection, [doc for doc, _ in docs], [meta for _, meta in docs], defer_summaries
+                )
+            for groups, meta in zip(parsed, metadata):
+                if not isinstance(groups, Doc):
+                    n_chunks += await self.index_row_groups(api_version, collection, groups, meta, defer_summaries)
+            return CollectionDocumentsResponse(n_chunks=n_chunks)
 
         collection = MILVUS_DB.get_or_create_collection(full_collection_name(vendor, organization, collection))
+        n_chunks = await self.index_documents(api_version, collection, documents, metadata, defer_summaries)
+        return CollectionDocumentsResponse(n_chunks=n_chunks)
+
+    async def index_row_groups(
+        self,
+        api_version: str,
+        collection: Collection,
+        groups: AsyncIterator[Doc],
+        metadata: DocumentMetadata,
+        defer_summaries: bool = False,
+    ) -> int:
+        """
+        Indexes a spreadsheet one group of rows at a time, as documents with ids of the file and
+        number of the group, so text of the whole file is never in memory. Chunks of groups the
+        file no longer has, or of the file indexed as one document before, are deleted afterwards.
+        """
+        n_chunks, doc_ids = 0, set()
+        async for doc in groups:
+            group_metadata = metadata.copy(update={"id": rows_doc_id(metadata.id, len(doc_ids))})
+            doc_ids.add(group_metadata.id)
+            n_chunks += await self.index_documents(api_version, collection, [doc], [group_metadata], defer_summaries)
+        stale = collection.query(
+            expr=f'doc_id == "{metadata.id}" || doc_id like "{metadata.id}{ROWS_DOC_SEPARATOR}%"',
+            output_fields=["pk", "doc_id"],
+            consistency_level="Strong",
+        )
+        stale_pks = [str(hit["pk"]) for hit in stale if hit["doc_id"] not in doc_ids]
+        if len(stale_pks) > 0:
+            MILVUS_DB.check_writable(collection.name)
+            collection.delete(f"pk in [{','.join(stale_pks)}]")
+        return n_chunks
+
+    async def index_links(
+        self,
+        api_version: str,
+        vendor: str,
+        organization: str,
+        collection: str,
+        links: List[str],
+        ignore_urls: bool = True,
+        defer_summaries: bool = False,
+    ) -> Tuple[int, str]:
+        """
+        Crawls links and indexes pages while the crawl goes on, in batches of `index_batch_size`
+        or whatever has arrived in `index_flush_interval` seconds. The queue between the crawler
+        and indexing is bounded, so a crawl which is faster than indexing waits instead of
+        piling pages up in memory.
+        Returns the number of chunks and id of the crawl report, which is stored even if the crawl fails.
+        """
+        # validators of all pages of the collection are read, off the event loop
+        crawl_state = await asyncio.to_thread(CrawlState, full_collection_name(vendor, organization, collection))
+        # one frontier for all the links, so pages reachable from several of them are crawled once
+        frontier = Frontier(full_collection_name(vendor, organization, collection))
+        milvus_collection = MILVUS_DB.get_or_create_collection(full_collection_name(vendor, organization, collection))
+        queue = asyncio.Queue(maxsize=int(CONFIG["crawler"]["index_queue_size"]))
+        batch_size = int(CONFIG["crawler"]["index_batch_size"])
+        flush_interval = float(CONFIG["crawler"]["index_flush_interval"])
+        stats = [CrawlStats(link) for link in links]
+
+        async def crawl():
+            try:
+                for link, link_stats in zip(links, stats):
+                    await self.parser.crawl_link(
+                        link,
+                        vendor=vendor,
+                        organization=organization,
+                        collection=collection,
+                        emit=lambda doc, metadata: queue.put((doc, metadata)),
+                        ignore_urls=ignore_urls,
+                        state=crawl_state,
+                        frontier=frontier,
+                        stats=link_stats,
+                    )
+            except Exception as e:
+                await queue.put(e)
+                return
+            await queue.put(None)
+
+        crawl_task = asyncio.create_task(crawl())
+        n_chunks, n_docs, crawl_status = 0, 0, "failed"
+        try:
+            batch, done = [], False
+            while not done:
+                timed_out = False
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout=flush_interval)
+                except asyncio.TimeoutError:
+                    # pages come slowly, indexing those which are already here
+                    item, timed_out = None, True
+                if isinstance(item, Exception):
+                    raise item
+                if item is not None:
+                    batch.append(item)
+                done = item is None and not timed_out
+                if len(batch) > 0 and (done or timed_out or len(batch) >= batch_size):
+                    n_chunks += await self.index_documents(
+                        api_version,
+                        milvus_collection,
+                        [doc for doc, _ in batch],
+                        [metadata for _, metadata in batch],
+                        defer_summaries,
+                    )
+                    n_docs += len(batch)
+                    batch = []
+            crawl_status = "completed"
+        except BaseException:
+            crawl_task.cancel()
+            raise
+        finally:
+            crawl_id = save_crawl_report(
+                full_collection_name(vendor, organization, collection), links, stats, crawl_status, n_docs, n_chunks
+            )
 
+        logger.info(f"Crawl {crawl_id} of {len(links)} links indexed {n_docs} docs in {n_chunks} chunks")
+        # only now crawled pages are indexed and can be skipped by the next crawl, if unchanged or crawled recently
+        await asyncio.to_thread(crawl_state.save)
+        await asyncio.to_thread(frontier.save)
+        return n_chunks, crawl_id
+
+    async def index_documents(
+        self,
+        api_version: str,
+        collection: Collection,
+        documents: List[Doc] | List[Chat],
+        metadata: List[DocumentMetadata],
+        defer_summaries: bool = False,
+    ) -> int:
+        # chunks of a document are read and then replaced, summary backfills of it must not run in between
+        async with document_locks(collection.name, [meta.id for meta in metadata]):
+            return await self._index_documents(api_version, collection, documents, metadata, defer_summaries)
+
+    async def _index_documents(
+        self,
+        api_version: str,
+        collection: Collection,
+        documents: List[Doc] | List[Chat],
+        metadata: List[DocumentMetadata],
+        defer_summaries: bool,
+    ) -> int:
         all_chunks = []
         all_chunk_hashes = []
         all_doc_ids = []
@@ -56,10 +232,13 @@ class DocumentsUploadHandler:
         all_timestamps = []
         all_security_groups = []
         all_urls = []
+        all_page_starts = []
+        all_page_ends = []
+        processed_documents = self.parser.process_documents(documents, metadata)
+        new_documents = []
         for i in tqdm(range(len(documents))):
-            doc = documents[i]
             meta = metadata[i]
-            chunks, meta_info, content = self.parser.process_document(doc, meta)
+            chunks, meta_info, content = processed_documents[i]
             if chunks is None:
                 continue
             doc_id = meta_info["doc_id"]
@@ -76,7 +255,10 @@ class DocumentsUploadHandler:
             # determining which chunks are new
             new_chunks_hashes = []
             new_chunks = []
-            for chunk in chunks:
+            new_chunks_pages = []
+            # chunks of documents without pages are on page 0
+            page_spans = meta_info.get("page_spans") or [(0, 0)] * len(chunks)
+            for chunk, pages in zip(chunks, page_spans):
                 text_hash = hash_string(chunk)
                 if (
                     text_hash in existing_chunks
@@ -87,22 +269,38 @@ class DocumentsUploadHandler:
                 else:
                     new_chunks.append(chunk)
                     new_chunks_hashes.append(text_hash)
+                    new_chunks_pages.append(pages)
             # dropping outdated chunks
             existing_chunks_pks = list(map(lambda val: str(val[0]), existing_chunks.values()))
+            MILVUS_DB.check_writable(collection.name)
             collection.delete(f"pk in [{','.join(existing_chunks_pks)}]")
 
             if len(new_chunks) == 0:
                 # everyting is already in the database
                 continue
-            if meta.summary_length > 0:
-                summary = await ml_requests.get_summary(
-                    info=content, max_tokens=meta.summary_length, api_version=api_version
-                )
-                if meta_info["source_language"] is not None and meta_info["source_language"] != "en":
-                    translation = AWS_TRANSLATE_CLIENT.translate_text(
-                        text=summary, source_language=meta_info["source_language"], target_language="en"
-                    )
-                    summary = translation["translation"]
+            new_documents.append((new_chunks, new_chunks_hashes, new_chunks_pages, meta, meta_info, content))
+
+        # summarizing all changed documents at once, so that coreml calls run concurrently
+        to_summarize = [
+            (meta_info, content, meta)
+            for _, _, _, meta, meta_info, content in new_documents
+            if meta.summary_length > 0 and not defer_summaries
+        ]
+        summaries = await get_summaries(
+            contents=[content for _, content, _ in to_summarize],
+            source_languages=[meta_info["source_language"] for meta_info, _, _ in to_summarize],
+            summary_lengths=[meta.summary_length for _, _, meta in to_summarize],
+            api_version=api_version,
+        )
+        summaries = iter(summaries)
+        deferred = []
+        for new_chunks, new_chunks_hashes, new_chunks_pages, meta, meta_info, content in new_documents:
+            if meta.summary_length > 0 and defer_summaries:
+                # chunks go in with the provided summary and get the generated one later
+                deferred.append((len(all_chunks), len(all_chunks) + len(new_chunks), meta, meta_info, content))
+                summary = meta_info["doc_summary"]
+            elif meta.summary_length > 0:
+                summary = next(summaries)
             else:
                 summary = meta_info["doc_summary"]
 
@@ -114,16 +312,20 @@ class DocumentsUploadHandler:
             all_timestamps.extend([meta_info["timestamp"]] * len(new_chunks))
             all_security_groups.extend([meta_info["security_groups"]] * len(new_chunks))
             all_urls.extend([meta_info["url"]] * len(new_chunks))
+            all_page_starts.extend(start for start, _ in new_chunks_pages)
+            all_page_ends.extend(end for _, end in new_chunks_pages)
         if len(all_chunks) != 0:
             all_embeddings = []
+            all_pks = []
             for i in tqdm(range(0, len(all_chunks), self.insert_chunk_size)):
                 all_embeddings.extend(
                     await ml_requests.get_embeddings(
                         all_chunks[i : i + self.insert_chunk_size], api_version=api_version
                     )
                 )
-                try:
-                    collection.insert(
+                all_pks.extend(
+                    self.insert_rows(
+                        collection,
                         [
                             all_chunk_hashes[i : i + self.insert_chunk_size],
                             all_doc_ids[i : i + self.insert_chunk_size],
@@ -134,26 +336,102 @@ class DocumentsUploadHandler:
                             all_timestamps[i : i + self.insert_chunk_size],
                             all_security_groups[i : i + self.insert_chunk_size],
                             all_urls[i : i + self.insert_chunk_size],
-                        ]
-                    )
-                except DataNotMatchException:
-                    logger.warning("Inserting in the old version of schema, ommiting urls")
-                    collection.insert(
-                        [
-                            all_chunk_hashes[i : i + self.insert_chunk_size],
-                            all_doc_ids[i : i + self.insert_chunk_size],
-                            all_chunks[i : i + self.insert_chunk_size],
-                            all_embeddings[i : i + self.insert_chunk_size],
-                            all_doc_titles[i : i + self.insert_chunk_size],
-                            all_summaries[i : i + self.insert_chunk_size],
-                            all_timestamps[i : i + self.insert_chunk_size],
-                            all_security_groups[i : i + self.insert_chunk_size],
-                        ]
+                            all_page_starts[i : i + self.insert_chunk_size],
+                            all_page_ends[i : i + self.insert_chunk_size],
+                        ],
                     )
+                )
 
             logger.info(f"Request of {len(documents)} docs inserted in database in {len(all_chunks)} chunks")
+            self.schedule_index_update(collection)
+
+            if len(deferred) > 0:
+                rows = [
+                    all_chunk_hashes,
+                    all_doc_ids,
+                    all_chunks,
+                    all_embeddings,
+                    all_doc_titles,
+                    all_summaries,
+                    all_timestamps,
+                    all_security_groups,
+                    all_urls,
+                    all_page_starts,
+                    all_page_ends,
+                ]
+                backfill = [
+                    (all_pks[start:end], [column[start:end] for column in rows], meta, meta_info, content)
+                    for start, end, meta, meta_info, content in deferred
+                ]
+                # keeping a reference, otherwise the task may be garbage collected before it is done
+                task = asyncio.create_task(self.backfill_summaries(api_version, collection, backfill))
+                self.backfill_tasks.add(task)
+                task.add_done_callback(self.backfill_tasks.discard)
 
-        return CollectionDocumentsResponse(n_chunks=len(all_chunks))
+        return len(all_chunks)
+
+    def schedule_index_update(self, collection: Collection):
+        # the index is rebuilt in the background if the collection outgrew it, see CollectionsManager.update_index
+        if collection.name in self.index_tasks:
+            return
+        task = asyncio.create_task(asyncio.to_thread(MILVUS_DB.update_index, collection))
+        self.index_tasks[collection.name] = task
+        task.add_done_callback(lambda task: self.index_update_done(collection.name, task))
+
+    def index_update_done(self, collection_name: str, task: asyncio.Task):
+        del self.index_tasks[collection_name]
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Updating index of {collection_name} failed: {task.exception()}")
+
+    def insert_rows(self, collection: Collection, rows: List[list]) -> List[int]:
+        MILVUS_DB.check_writable(collection.name)
+        fields = {field.name for field in collection.schema.fields}
+        if "url" not in fields:
+            logger.warning("Inserting in the old version of schema, ommiting urls")
+        # rows have the columns of the latest schema, collections of earlier ones lack the last of them
+        rows = [column for name, column in zip(CHUNK_COLUMNS, rows) if name in fields]
+        return collection.insert(rows).primary_keys
+
+    async def backfill_summaries(
+        self,
+        api_version: str,
+        collection: Collection,
+        backfill: List[Tuple[List[int], List[list], DocumentMetadata, dict, str]],
+    ):
+        """
+        Generates summaries of documents which were inserted with `defer_summaries`
+        and rewrites their chunks with them. Milvus can not update rows, so chunks
+        are inserted again and the old ones are deleted afterwards, under the lock
+        of the document which uploads and deletes of it take as well.
+        """
+        try:
+            summaries = await get_summaries(
+                contents=[content for _, _, _, _, content in backfill],
+                source_languages=[meta_info["source_language"] for _, _, _, meta_info, _ in backfill],
+                summary_lengths=[meta.summary_length for _, _, meta, _, _ in backfill],
+                api_version=api_version,
+            )
+            n_chunks = 0
+            for (pks, rows, meta, _, _), summary in zip(backfill, summaries):
+                async with document_locks(collection.name, [meta.id]):
+                    # chunks could have been replaced by another upload of the same document meanwhile
+                    existing = collection.query(
+                        expr=f"pk in [{','.join(map(str, pks))}]",
+                        output_fields=["pk"],
+                        consistency_level="Strong",
+                    )
+                    existing = {hit["pk"] for hit in existing}
+                    keep = [i for i, pk in enumerate(pks) if pk in existing]
+                    if len(keep) == 0:
+                        continue
+                    rows = [[column[i] for i in keep] for column in rows]
+                    rows[5] = [summary] * len(keep)
+                    self.insert_rows(collection, rows)
+                    collection.delete(f"pk in [{','.join(str(pks[i]) for i in keep)}]")
+                    n_chunks += len(keep)
+            logger.info(f"Backfilled summaries of {len(backfill)} docs in {n_chunks} chunks of {collection.name}")
+        except Exception as e:
+            logger.error(f"Summaries backfill in {collection.name} failed: {e.__class__.__name__}: {e}")
 
     async def delete_collection(self, api_version: str, vendor: str, organization: str, collection: str):
         try:
@@ -167,13 +445,16 @@ class DocumentsUploadHandler:
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail=msg,
             )
+        MILVUS_DB.check_writable(milvus_collection.name)
         # deleting documents in gridfs
         data = milvus_collection.query(
             expr=f"pk>=0",
             output_fields=["doc_id"],
             consistency_level="Strong",
         )
-        all_files = {full_collection_name(vendor, organization, collection) + "_" + hit["doc_id"] for hit in data}
+        all_files = {
+            full_collection_name(vendor, organization, collection) + "_" + file_doc_id(hit["doc_id"]) for hit in data
+        }
         for filename in all_files:
             res = GRIDFS.find_one({"filename": filename})
             if res:
@@ -181,6 +462,8 @@ class DocumentsUploadHandler:
                 logger.info(f"Deleted file {filename} from GridFS")
             else:
                 logger.warning(f"File {filename} not found in GridFS for deletion")
+        forget_pages(full_collection_name(vendor, organization, collection))
+        forget_urls(full_collection_name(vendor, organization, collection))
         # deleting collection itself
         milvus_collection.release()
         MILVUS_DB.delete_collection(full_collection_name(vendor, organization, collection))
@@ -214,16 +497,23 @@ class DocumentsUploadHandler:
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail=msg,
             )
+        MILVUS_DB.check_writable(collection.name)
         documents_ticks = [f"'{doc}'" for doc in documents]
-        existing_chunks = collection.query(
-            expr=f'doc_id in [{",".join(documents_ticks)}]',
-            offset=0,
-            limit=16384,
-            output_fields=["pk"],
-            consistency_level="Strong",
-        )
-        existing_chunks_pks = [str(hit["pk"]) for hit in existing_chunks]
-        collection.delete(f"pk in [{','.join(existing_chunks_pks)}]")
+        # chunks of spreadsheets are in documents of groups of their rows
+        groups = [f"doc_id like '{doc}{ROWS_DOC_SEPARATOR}%'" for doc in documents]
+        # a summary backfill of a document deleted meanwhile would insert its chunks again
+        async with document_locks(collection.name, documents):
+            existing_chunks = collection.query(
+                expr=" || ".join([f'doc_id in [{",".join(documents_ticks)}]'] + groups),
+                offset=0,
+                limit=16384,
+                output_fields=["pk"],
+                consistency_level="Strong",
+            )
+            existing_chunks_pks = [str(hit["pk"]) for hit in existing_chunks]
+            collection.delete(f"pk in [{','.join(existing_chunks_pks)}]")
+        forget_pages(full_collection_name(vendor, organization, collection_name), urls=documents)
+        forget_urls(full_collection_name(vendor, organization, collection_name), urls=documents)
         for doc_id in documents:
             filename = full_collection_name(vendor, organization, collection_name) + "_" + doc_id
             res = GRIDFS.find_one({"filename": filename})
@@ -1,3 +1,4 @@
+import asyncio
 import datetime
 import io
 import json
@@ -36,9 +37,11 @@ from handlers import (
     TextHandler,
 )
 from parsers import DocumentParser, DocumentsParser, LinkParser, TextParser
+from parsers.page_parser import shutdown_parse_pool
 from utils import CLIENT_SESSION_WRAPPER, CONFIG, DB, GRIDFS, full_collection_name, ml_requests
 from utils.api import catch_errors, log_get_answer, log_get_ranking, stream_and_log
 from utils.auth import decode_token, get_livechat_token, get_organization_token, oauth2_scheme
+from utils.crawl_reports import get_crawl_report
 from utils.filter_rules import archive_filter_rule, create_filter_rule, get_filters, update_filter_rule
 from utils.gunicorn_logging import RequestLoggerMiddleware, run_gunicorn_loguru
 from utils.misc import romanize_hindi
@@ -58,6 +61,7 @@ from utils.schemas import (
     GetCollectionRankingResponse,
     GetCollectionResponse,
     GetCollectionsResponse,
+    GetCrawlReportResponse,
     GetFiltersResponse,
     GetReactionsResponse,
     GetTranscriptionResponse,
@@ -70,9 +74,12 @@ from utils.schemas import (
     TextRequest,
     UploadDocumentResponse,
 )
+from utils.uploads import RequestSizeLimitMiddleware, check_upload_sizes, save_to_gridfs
 
 app = FastAPI()
 
+# innermost, so that its 413 responses get CORS headers
+app.add_middleware(RequestSizeLimitMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -120,6 +127,12 @@ async def init_handlers():
     canned_handler = CannedHandler()
 
 
+@app.on_event("shutdown")
+async def close_parse_pool():
+    # running parses are waited for, the worker does not leave orphaned processes behind
+    await asyncio.to_thread(shutdown_parse_pool)
+
+
 @app.get("/", include_in_schema=False)
 async def docs_redirect():
     return RedirectResponse(url="/docs")
@@ -430,6 +443,10 @@ async def upload_collection_documents(
     metadata: List[DocumentMetadata] = Body(
         description="List of DocumentMetadata objects for each of the documents/chats provided"
     ),
+    defer_summaries: bool = Body(
+        False,
+        description="Insert chunks right away and generate summaries (for `summary_length` > 0) in the background",
+    ),
 ):
     if len(documents) != len(metadata):
         raise HTTPException(
@@ -439,17 +456,16 @@ async def upload_collection_documents(
 
     token_data = decode_token(token)
 
-    for doc_metadata, document in zip(metadata, documents):
-        filename = f"{token_data['vendor']}_{token_data['organization']}_{collection}_{doc_metadata.id}"
-        res = GRIDFS.find_one({"filename": filename})
-        if res:
-            GRIDFS.delete(res._id)
-            logger.info(f"Deleted file {filename} from GridFS")
-        GRIDFS.put(
-            document.content.encode(),
-            filename=filename,
-            content_type="text/plain",
-        )
+    await save_to_gridfs(
+        [
+            (
+                f"{token_data['vendor']}_{token_data['organization']}_{collection}_{doc_metadata.id}",
+                document.content.encode(),
+                "text/plain",
+            )
+            for doc_metadata, document in zip(metadata, documents)
+        ]
+    )
 
     return await documents_upload_handler.handle_request(
         api_version=api_version,
@@ -458,6 +474,7 @@ async def upload_collection_documents(
         collection=collection,
         documents=documents,
         metadata=metadata,
+        defer_summaries=defer_summaries,
     )
 
 
@@ -474,9 +491,15 @@ async def upload_collection_files(
     token: str = Depends(oauth2_scheme),
     collection: str = Path(description="Collection within organization"),
     files: List[UploadFile] = File(
-        description="A file or a list of files to be processed. Allowed types: .pdf, .docx and .md"
+        description="A file or a list of files to be processed. Allowed types: .pdf, .docx, .md, .xlsx and .csv. "
+        "Rows of all sheets of a .xlsx or .csv file are read and indexed a group of rows at a time, so "
+        "spreadsheets of any size are indexed in constant memory, sources found in them have the id of the file"
     ),
     metadata: str = Form(description="Metadata for each of the files in `files`. Must be a json-dumped string"),
+    defer_summaries: bool = Form(
+        False,
+        description="Insert chunks right away and generate summaries (for `summary_length` > 0) in the background",
+    ),
 ):
     token_data = decode_token(token)
     try:
@@ -503,6 +526,7 @@ async def upload_collection_files(
                 status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
                 detail=msg,
             )
+    check_upload_sizes(files)
     return await documents_upload_handler.handle_request(
         api_version=api_version,
         vendor=token_data["vendor"],
@@ -510,6 +534,7 @@ async def upload_collection_files(
         collection=collection,
         documents=files,
         metadata=processed_metadata,
+        defer_summaries=defer_summaries,
     )
 
 
@@ -527,6 +552,10 @@ async def upload_collection_links(
     collection: str = Path(description="Collection within organization"),
     links: List[str] = Body(description="Each link will be recursively crawled and uploaded"),
     ignore_urls: bool = Body(True, description="Whether to ignore urls when parsing Links"),
+    defer_summaries: bool = Body(
+        False,
+        description="Insert chunks right away and generate summaries (for `summary_length` > 0) in the background",
+    ),
 ):
     token_data = decode_token(token)
     return await documents_upload_handler.handle_request(
@@ -536,6 +565,7 @@ async def upload_collection_links(
         collection=collection,
         documents=links,
         ignore_urls=ignore_urls,
+        defer_summaries=defer_summaries,
     )
 
 
@@ -556,6 +586,10 @@ async def upload_collection_chats(
     metadata: List[DocumentMetadata] = Body(
         description="List of DocumentMetadata objects for each of the documents/chats provided"
     ),
+    defer_summaries: bool = Body(
+        False,
+        description="Insert chunks right away and generate summaries (for `summary_length` > 0) in the background",
+    ),
 ):
     if len(chats) != len(metadata):
         raise HTTPException(
@@ -570,6 +604,7 @@ async def upload_collection_chats(
         collection=collection,
         documents=chats,
         metadata=metadata,
+        defer_summaries=defer_summaries,
     )
 
 
@@ -745,6 +780,31 @@ async def get_collection_canned(
     )
 
 
+@app.get(
+    "/{api_version}/collections/{collection}/crawls/{crawl_id}",
+    response_model=GetCrawlReportResponse,
+    responses=CollectionResponses | {status.HTTP_404_NOT_FOUND: {"model": NotFoundResponse}},
+    tags=["collections"],
+)
+@catch_errors
+async def get_collection_crawl_report(
+    request: Request,
+    api_version: ApiVersion,
+    token: str = Depends(oauth2_scheme),
+    collection: str = Path(description="Collection within organization"),
+    crawl_id: str = Path(description="Crawl ID, returned by `POST /{api_version}/collections/{collection}/links`"),
+):
+    token_data = decode_token(token)
+    report = get_crawl_report(
+        full_collection_name(token_data["vendor"], token_data["organization"], collection), crawl_id
+    )
+    if report is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail=f"Crawl {crawl_id} not found in collection {collection}"
+        )
+    return GetCrawlReportResponse(id=str(report.pop("_id")), **report)
+
+
 ######################################################
 #                   DOC RETRIEVAL                    #
 ######################################################
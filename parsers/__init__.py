@@ -3,4 +3,5 @@ from parsers.documents_parser import DocumentsParser
 from parsers.docx_parser_ import DocxParser
 from parsers.link_parser import LinkParser
 from parsers.pdf_parser import PdfParser
+from parsers.spreadsheet_parser import SpreadsheetParser
 from parsers.text_parser import TextParser
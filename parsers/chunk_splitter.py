@@ -0,0 +1,63 @@
+from bisect import bisect_left
+from typing import List
+
+# sections of html and markdown documents are split until every part is shorter than this
+SECTION_MAX_LENGTH = 2000
+
+
+def split_text(text: str, max_length: int = SECTION_MAX_LENGTH) -> List[str]:
+    """
+    Splits text into parts shorter than `max_length` characters. A part that is too
+    long is split at its middle newline, dropping the newline, and both halves are
+    split further. Parts without newlines are cut every `max_length` characters.
+
+    Parts are kept as (start, end) offsets into the text and newlines are found once,
+    so the whole split is linear in the length of the text, and only the resulting
+    parts are sliced out of it.
+    """
+    if len(text) < max_length:
+        return [text]
+    newlines, position = [], text.find("\n")
+    while position != -1:
+        newlines.append(position)
+        position = text.find("\n", position + 1)
+
+    parts = []
+    # ranges are taken from the end of the stack, so the right half is pushed first
+    stack = [(0, len(text))]
+    while len(stack) > 0:
+        start, end = stack.pop()
+        if end - start < max_length:
+            parts.append(text[start:end])
+            continue
+        first, last = bisect_left(newlines, start), bisect_left(newlines, end)
+        if first == last:
+            # no breaks at all
+            print("Hard split!")
+            stack.append((start + max_length, end))
+            parts.append(text[start : start + max_length])
+            continue
+        split = newlines[first + (last - first) // 2]
+        stack.append((split + 1, end))
+        stack.append((start, split))
+    return parts
+
+
+def merge_texts(texts: List[str], max_length: int) -> List[str]:
+    """
+    Joins consecutive texts with newlines while the merged text and the next one
+    together are shorter than `max_length` characters.
+    """
+    if len(texts) == 0:
+        return []
+    merged = []
+    current, current_length = [texts[0]], len(texts[0])
+    for text in texts[1:]:
+        if current_length + len(text) < max_length:
+            current.append(text)
+            current_length += len(text) + 1
+        else:
+            merged.append("\n".join(current))
+            current, current_length = [text], len(text)
+    merged.append("\n".join(current))
+    return merged
@@ -1,15 +1,10 @@
-import fitz
-
 from parsers.general_parser import GeneralParser
+from parsers.pdf_parser import PdfParser
 
 
 class DocumentParser(GeneralParser):
     def get_text(self, filepath: str) -> str:
-        with fitz.open(filepath) as doc:
-            text = ""
-            for page in doc:
-                text += page.get_text()
-        return text
+        return "".join(PdfParser(self.chunk_size).extract_pages(filepath))
 
 
 # def parse_document(path: Union[str, Path], chunk_size: int) -> List[str]:
@@ -1,32 +1,42 @@
 import asyncio
 import os.path as osp
 import re
-from collections import deque
+import time
+import zlib
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack
 from datetime import datetime
-from typing import List, Tuple
-from urllib.parse import urljoin
+from itertools import accumulate
+from typing import AsyncIterator, Awaitable, Callable, Iterator, List, Tuple
+from xml.etree import ElementTree
 
 import html2text
 import tiktoken
-from aiohttp import ClientSession
-from bs4 import BeautifulSoup
+from aiohttp import ClientResponse
 from fastapi import HTTPException, status
 from loguru import logger
 from starlette.datastructures import UploadFile as StarletteUploadFile
 
 from parsers.docx_parser_ import DocxParser
 from parsers.markdown_parser import MarkdownParser
+from parsers.page_parser import is_sitemap, parse_html, parse_sitemap, run_parser
 from parsers.pdf_parser import PdfParser
-from utils import AWS_TRANSLATE_CLIENT, GRIDFS, full_collection_name
+from parsers.sitemap_parser import SitemapParser
+from parsers.spreadsheet_parser import SpreadsheetParser
+from utils import AWS_TRANSLATE_CLIENT, CONFIG, full_collection_name, hash_string
+from utils.crawl_state import CrawlState
+from utils.crawler import Crawler, CrawlStats, Page
+from utils.errors import FileProcessingError, PageParsingError
+from utils.frontier import Frontier, normalize_url, priority
 from utils.misc import int_list_encode
 from utils.schemas import Chat, Doc, DocumentMetadata
-from utils.tokenize_ import doc_to_chunks
+from utils.tokenize_ import chats_to_chunks, docs_to_chunks, spans_to_pages
+from utils.uploads import check_file_size, save_to_gridfs, upload_buffer
 
-# from cache import AsyncTTL
-
-DOCX_PARSER = DocxParser(1024)
+DOCX_PARSER = DocxParser(1024, render_tables=CONFIG.getboolean("uploads", "docx_render_tables"))
 PDF_PARSER = PdfParser(1024)
 MD_PARSER = MarkdownParser(1024)
+SPREADSHEET_PARSER = SpreadsheetParser(1024)
 
 
 class DocumentsParser:
@@ -37,239 +47,477 @@ class DocumentsParser:
         self.converter.ignore_images = True
         self.sitemap_pattern = r"sitemap.*\.xml"
 
-    # @AsyncTTL(time_to_live=60, maxsize=4096)
-    async def get_page_content(self, session: ClientSession, link: str, allow_redirects: bool = True) -> str:
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36"
-        }
-        link_clickhelp_adjusted = link.replace("articles/#!", "article/")
-        try:
-            async with session.get(
-                link_clickhelp_adjusted, headers=headers, allow_redirects=allow_redirects, timeout=600
-            ) as response:
-                page_content = await response.text()
-        except Exception as e:
-            logger.error(f"Error while downloading {link_clickhelp_adjusted}: {e}")
-            return None
-
-        return page_content
-
-    async def extract_urls(
+    async def get_page_content(
         self,
-        session: ClientSession,
+        crawler: Crawler,
         link: str,
         allow_redirects: bool = True,
-        root_url: str = "",
-        visited: set = set(),
-    ) -> List[str]:
-        page_content = await self.get_page_content(session=session, link=link, allow_redirects=allow_redirects)
-
-        if "<html" in page_content:
-            soup = BeautifulSoup(page_content, "html.parser")
-            link_candidates = [
-                urljoin(link, a["href"]).split("#")[0].split("?")[0].split(" ")[0] for a in soup.find_all(href=True)
-            ]
-        elif "<?xml" in page_content:
-            soup = BeautifulSoup(page_content, "xml")
-            link_candidates = [a.text.strip() for a in soup.find_all("loc")]
-        else:
-            logger.warning(f"Unknown content format on link: {link}")
-            return []
+        headers: dict = None,
+        read: Callable[[ClientResponse], Awaitable[str | None]] = None,
+    ) -> Page | None:
+        link_clickhelp_adjusted = link.replace("articles/#!", "article/")
+        return await crawler.fetch_page(
+            link_clickhelp_adjusted, allow_redirects=allow_redirects, headers=headers, read=read
+        )
+
+    def is_sitemap_url(self, link: str) -> bool:
+        return re.search(self.sitemap_pattern, link) is not None or link.endswith((".xml", ".xml.gz"))
 
+    async def filter_urls(
+        self, urls: List[str], frontier: Frontier, root_url: str = "", stats: CrawlStats = None
+    ) -> List[str]:
         links_found = []
-        for url in link_candidates:
+        for url in urls:
             is_file = url.split("/")[-1].count(".") > 0
             if (
-                url not in visited
-                and url.startswith(root_url)
+                url.startswith(root_url)
                 and "wp-json" not in url
-                and (not is_file or url.endswith(".html") or url.endswith(".htm") or url.endswith(".xml"))
-                and url + "/" not in visited
-                and url[:-1] not in visited
+                and (
+                    not is_file
+                    or url.endswith(".html")
+                    or url.endswith(".htm")
+                    or url.endswith(".xml")
+                    or url.endswith(".xml.gz")
+                )
                 and "<" not in url
                 # and "/de" not in url
                 # and "/de-ch" not in url
                 # and "/fr" not in url
             ):
-                visited.add(url)
                 links_found.append(url)
 
-        return links_found
-
-    async def process_link(
-        self,
-        session: ClientSession,
-        link: str,
-        allow_redirects: bool = True,
-    ) -> Tuple[Doc, DocumentMetadata]:
-        page_content = await self.get_page_content(session=session, link=link, allow_redirects=allow_redirects)
-        soup = BeautifulSoup(page_content, "html.parser")
-
-        for each in ["header", "footer"]:
-            s = soup.find(each)
-            if s:
-                s.extract()
-        div_to_remove = soup.find_all("div", class_="kb-footer")
-        if div_to_remove:
-            div_to_remove[0].extract()
-
-        page_content = str(soup)
-
-        title = soup.find("title").text if (soup.find("title") and soup.find("title").text) else link
-        content = self.converter.handle(page_content)
+        if stats is not None:
+            stats.dropped["filtered"] += len(urls) - len(links_found)
+        return await frontier.add(links_found)
+
+    async def parse_page(
+        self, link: str, page_content: str, lastmods: dict = None, stats: CrawlStats = None
+    ) -> Tuple[Doc, DocumentMetadata, str, List[str]]:
+        """
+        Parses a downloaded page once into the document, its metadata,
+        the cleaned html and all the links found on the page.
+        <lastmod> of sitemap entries are put into `lastmods`.
+        Parsing runs in the pool of parsing processes, off the event loop.
+        Pages which fail to parse raise PageParsingError, the crawl goes on without them.
+        """
+        started = time.perf_counter()
+        try:
+            return await self._parse_page(link, page_content, lastmods, stats)
+        except BrokenProcessPool:
+            # not the page's fault, no other page would parse either
+            raise
+        except Exception as e:
+            if stats is not None:
+                stats.fail(link, e.__class__.__name__)
+            raise PageParsingError(f"{link}: {e.__class__.__name__}: {e}") from e
+        finally:
+            # waiting for a busy pool counts too, it is what a parse-bound crawl looks like
+            if stats is not None:
+                stats.parse_times.append(time.perf_counter() - started)
+
+    async def _parse_page(
+        self, link: str, page_content: str, lastmods: dict = None, stats: CrawlStats = None
+    ) -> Tuple[Doc, DocumentMetadata, str, List[str]]:
+        if is_sitemap(page_content):
+            # sitemaps are only a source of links
+            urls, sitemap_lastmods = await run_parser(parse_sitemap, page_content)
+            if lastmods is not None:
+                lastmods.update(sitemap_lastmods)
+            return None, None, None, urls
+
+        if "<html" not in page_content:
+            logger.warning(f"Unknown content format on link: {link}")
+        title, content, page_content, urls = await run_parser(
+            parse_html, link, page_content, self.converter.ignore_links
+        )
+        urls = [normalize_url(url, keep_query=False) for url in urls]
 
-        if "redirecting" in title.lower():
+        if content is None:
             logger.warning(f"Redirecting page on {link}")
-            return None, None, None
+            if stats is not None:
+                stats.dropped["redirecting"] += 1
+            return None, None, None, urls
 
         # if not content:
         #     logger.error(f"Empty content on {link}")
         #     return None
 
-        return Doc(content=content), DocumentMetadata(id=link, title=title, url=link, project_to_en=False), page_content
+        return (
+            Doc(content=content),
+            DocumentMetadata(id=link, title=title, url=link, project_to_en=False),
+            page_content,
+            urls,
+        )
+
+    async def process_link(
+        self,
+        crawler: Crawler,
+        link: str,
+        allow_redirects: bool = True,
+        state: CrawlState = None,
+    ) -> Tuple[Doc, DocumentMetadata, str, List[str]]:
+        if state is None:
+            page = await self.get_page_content(crawler=crawler, link=link, allow_redirects=allow_redirects)
+            if page is None:
+                return None, None, None, []
+            return await self.parse_page(link, page.content, stats=crawler.stats)
+
+        # pages known from previous crawls are skipped before parsing if they did
+        # not change, the crawl follows links they had last time
+        if state.unchanged_in_sitemap(link):
+            crawler.stats.unchanged += 1
+            return None, None, None, await state.skip(link)
+        page = await self.get_page_content(
+            crawler=crawler, link=link, allow_redirects=allow_redirects, headers=state.conditional_headers(link)
+        )
+        if page is None:
+            return None, None, None, []
+        if page.not_modified or state.unchanged_content(link, hash_string(page.content)):
+            crawler.stats.unchanged += 1
+            state.update(link, etag=page.etag, last_modified=page.last_modified)
+            return None, None, None, await state.skip(link)
+
+        lastmods = {}
+        doc, metadata, content, urls = await self.parse_page(link, page.content, lastmods=lastmods, stats=crawler.stats)
+        state.sitemap_lastmods.update(lastmods)
+        state.update(
+            link,
+            etag=page.etag,
+            last_modified=page.last_modified,
+            content_hash=hash_string(page.content),
+            links=urls,
+            links_lastmods=[lastmods.get(url) for url in urls] if lastmods else None,
+        )
+        return doc, metadata, content, urls
+
+    async def process_sitemap(
+        self,
+        crawler: Crawler,
+        link: str,
+        follow: Callable[[List[str]], Awaitable[List]],
+        state: CrawlState = None,
+    ):
+        """
+        Streams a sitemap, gzipped or not, through an incremental parser. Its urls are
+        passed to `follow` in batches as they are parsed and whatever it returns is
+        enqueued into the crawl right away, so pages are crawled while a large sitemap
+        is still downloading. Sitemaps are never held in memory whole.
+        """
+        if state is not None and state.unchanged_in_sitemap(link):
+            # nested sitemap with the same <lastmod> in the sitemap index
+            crawler.stats.unchanged += 1
+            for item in await follow(await state.skip(link)):
+                crawler.enqueue(item)
+            return
+
+        urls, lastmods, content_hash = [], [], None
+
+        async def hand_over(entries: List[Tuple[str, str | None]]):
+            if len(entries) == 0:
+                return
+            batch = [url for url, _ in entries]
+            urls.extend(batch)
+            lastmods.extend(lastmod for _, lastmod in entries)
+            if state is not None:
+                # before the pages are enqueued, they are checked against it when visited
+                state.sitemap_lastmods.update({url: lastmod for url, lastmod in entries if lastmod is not None})
+            for item in await follow(batch):
+                crawler.enqueue(item)
+
+        async def read(response: ClientResponse) -> None:
+            nonlocal content_hash
+            urls.clear()
+            lastmods.clear()
+            parser = SitemapParser()
+            async for data in response.content.iter_any():
+                await hand_over(parser.feed(data))
+            await hand_over(parser.close())
+            content_hash = parser.content_hash
+
+        try:
+            page = await self.get_page_content(
+                crawler=crawler,
+                link=link,
+                headers=state.conditional_headers(link) if state is not None else None,
+                read=read,
+            )
+        except (ElementTree.ParseError, zlib.error, ValueError) as e:
+            logger.error(f"Error while parsing sitemap {link}: {e}")
+            crawler.stats.fail(link, e.__class__.__name__)
+            return
+        logger.info(f"Extracted {len(urls)} links from sitemap '{link}'")
+        if page is None or state is None:
+            return
+
+        if page.not_modified:
+            crawler.stats.unchanged += 1
+            state.update(link, etag=page.etag, last_modified=page.last_modified)
+            for item in await follow(await state.skip(link)):
+                crawler.enqueue(item)
+        elif state.unchanged_content(link, content_hash):
+            # its urls are already enqueued while it was parsed
+            crawler.stats.unchanged += 1
+            state.update(link, etag=page.etag, last_modified=page.last_modified)
+        else:
+            state.update(
+                link,
+                etag=page.etag,
+                last_modified=page.last_modified,
+                content_hash=content_hash,
+                links=urls,
+                links_lastmods=lastmods if any(lastmod is not None for lastmod in lastmods) else None,
+            )
 
     async def traverse_page(
-        self, root_link: str, max_depth: int = 50, max_total_docs: int = 500
+        self,
+        root_link: str,
+        frontier: Frontier,
+        max_depth: int = int(CONFIG["crawler"]["max_depth"]),
+        max_total_docs: int = int(CONFIG["crawler"]["max_pages"]),
+        state: CrawlState = None,
+        on_page: Callable[[Doc, DocumentMetadata, str], Awaitable] = None,
+        stats: CrawlStats = None,
     ) -> List[Tuple[Doc, DocumentMetadata, str]]:
+        """
+        Crawls pages under `root_link`. If `on_page` is given, each document is passed to it
+        as soon as it is parsed instead of being collected into the returned list.
+        Telemetry of the crawl is collected into `stats` if given.
+        """
         if root_link[-1] != "/":
             root_link += "/"
 
-        queue, visited, depth = deque([root_link]), set([root_link]), 0
-        docs = []
-
-        async with ClientSession() as session:
-            while queue and depth < max_depth and len(docs) < max_total_docs:
-                logger.info(
-                    f"Depth: {depth} / {max_depth}, total: {len(docs)} / {max_total_docs}, queue size: {len(queue)}, link: {root_link}"
-                )
-                tasks_process_link = []
-                tasks_extract_urls = []
-                for _ in range(len(queue)):
-                    url = queue.popleft()
-                    tasks_process_link.append(self.process_link(session=session, link=url))
-                    tasks_extract_urls.append(
-                        self.extract_urls(
-                            session=session,
-                            link=url,
-                            root_url=root_link,
-                            visited=visited,
-                        )
-                    )
-
-                processed_links = await asyncio.gather(*tasks_process_link)
-                extracted_urls = await asyncio.gather(*tasks_extract_urls)
+        root_url = normalize_url(root_link, keep_query=False)
+        await frontier.add([root_link])
+        docs, n_docs = [], 0
+
+        async def visit(item: Tuple[str, int]) -> List[Tuple[str, int]]:
+            nonlocal n_docs
+            url, depth = item
+            crawler.stats.depths[depth] += 1
+            if self.is_sitemap_url(url):
+                await self.process_sitemap(crawler, url, follow=lambda urls: follow(urls, depth), state=state)
+                return []
+            doc, metadata, content, urls = await self.process_link(crawler=crawler, link=url, state=state)
+            if doc is not None and n_docs >= max_total_docs:
+                crawler.stats.dropped["max_pages"] += 1
+                if state is not None:
+                    state.discard(url)
+            elif doc is not None:
+                n_docs += 1
+                frontier.crawled(url)
+                if n_docs % 50 == 0:
+                    logger.info(f"Depth: {depth} / {max_depth}, total: {n_docs} / {max_total_docs}, link: {root_link}")
+                if on_page is not None:
+                    await on_page(doc, metadata, content)
+                else:
+                    docs.append((doc, metadata, content))
+            return await follow(urls, depth)
+
+        async def follow(urls: List[str], depth: int) -> List[Tuple[str, int]]:
+            if depth + 1 >= max_depth:
+                crawler.stats.dropped["max_depth"] += len(urls)
+                return []
+            new_urls = await self.filter_urls(urls, frontier=frontier, root_url=root_url, stats=crawler.stats)
+            return [(url, depth + 1) for url in new_urls]
+
+        async with Crawler(stats=stats) as crawler:
+            # unchanged pages count towards the limit too, so that re-crawls cover the same pages
+            await crawler.crawl(
+                [(root_link, 0)],
+                visit,
+                stop=lambda: n_docs + crawler.stats.unchanged >= max_total_docs,
+                priority=lambda item: priority(*item),
+            )
 
-                docs.extend([link for link in processed_links if link[0] is not None])
-                queue.extend([url for extracted_urls_from_one in extracted_urls for url in extracted_urls_from_one])
-                depth += 1
+        logger.info(f"Found {n_docs} documents on {root_link}, crawl stats: {crawler.stats.summary()}")
+        return docs
 
-        logger.info(f"Found {len(docs)} documents on {root_link}")
-        return docs[:max_total_docs]
+    async def traverse_xml(
+        self,
+        link: str,
+        frontier: Frontier,
+        state: CrawlState = None,
+        on_page: Callable[[Doc, DocumentMetadata, str], Awaitable] = None,
+        stats: CrawlStats = None,
+    ) -> List[Tuple[Doc, DocumentMetadata, str]]:
+        await frontier.add([link])
+        docs, n_docs = [], 0
+
+        async def visit(url: str) -> List[str]:
+            nonlocal n_docs
+            if self.is_sitemap_url(url):
+                # only sitemaps are followed, links on the pages themselves are not
+                follow = lambda urls: self.filter_urls(urls, frontier=frontier, stats=crawler.stats)  # noqa: E731
+                await self.process_sitemap(crawler, url, follow=follow, state=state)
+                return []
+            doc, metadata, content, urls = await self.process_link(crawler=crawler, link=url, state=state)
+            if doc:
+                n_docs += 1
+                frontier.crawled(url)
+                if on_page is not None:
+                    await on_page(doc, metadata, content)
+                else:
+                    docs.append((doc, metadata, content))
+            return []
 
-    async def traverse_xml(self, link: str) -> List[Tuple[Doc, DocumentMetadata, str]]:
-        queue, visited, depth = deque([link]), set([link]), 0
-        docs = []
+        async with Crawler(stats=stats) as crawler:
+            await crawler.crawl([link], visit, priority=lambda url: priority(url, 0))
 
-        async with ClientSession() as session:
-            while queue:
-                logger.info(f"Depth: {depth}, total: {len(docs)}, queue size: {len(queue)}, link: {link}")
-                tasks_process_link = []
-                tasks_extract_urls = []
-                for _ in range(len(queue)):
-                    url = queue.popleft()
-                    if re.search(self.sitemap_pattern, url):
-                        logger.info(f"Extracting links from .xml '{url}'")
-                        tasks_extract_urls.append(
-                            self.extract_urls(
-                                session=session,
-                                link=url,
-                                visited=visited,
-                            )
-                        )
-                    else:
-                        tasks_process_link.append(self.process_link(session=session, link=url))
-
-                processed_links = await asyncio.gather(*tasks_process_link)
-                extracted_urls = await asyncio.gather(*tasks_extract_urls)
-
-                docs.extend([(doc, medatadata, content) for (doc, medatadata, content) in processed_links if doc])
-                queue.extend([url for extracted_urls_from_one in extracted_urls for url in extracted_urls_from_one])
-                depth += 1
-
-        logger.info(f"Found {len(docs)} documents on {link}")
+        logger.info(f"Found {n_docs} documents on {link}, crawl stats: {crawler.stats.summary()}")
         return docs
 
-    async def link_to_docs(
-        self, link: str, vendor: str, organization: str, collection: str, ignore_urls: bool = True
-    ) -> Tuple[List[Doc], List[DocumentMetadata]]:
+    async def crawl_link(
+        self,
+        link: str,
+        vendor: str,
+        organization: str,
+        collection: str,
+        emit: Callable[[Doc, DocumentMetadata], Awaitable],
+        ignore_urls: bool = True,
+        state: CrawlState = None,
+        frontier: Frontier = None,
+        stats: CrawlStats = None,
+    ):
+        """
+        Crawls a link and passes every document to `emit` once its page is parsed and saved
+        to GridFS, raw html is not kept around. Pages are saved in concurrent batches of
+        `save_batch_size`. Crawling waits for saving and `emit`, so a slow consumer
+        slows the crawl down.
+        """
+        if frontier is None:
+            frontier = Frontier(full_collection_name(vendor, organization, collection))
         default_ignore_links = self.converter.ignore_links
         self.converter.ignore_links = ignore_urls
 
-        # If we face sitemap, we will use links from it for extraction.
-        # Otherwise, we are recursively crawling page.
-        if re.search(self.sitemap_pattern, link):
-            results = await self.traverse_xml(link)
-        else:
-            results = await self.traverse_page(link)
+        pages = []
+
+        async def save_pages():
+            batch = pages[:]
+            pages.clear()
+            await save_to_gridfs(
+                [
+                    (
+                        full_collection_name(vendor, organization, collection) + "_" + metadata.id,
+                        content.encode(),
+                        "text/html",
+                    )
+                    for _, metadata, content in batch
+                ]
+            )
+            for doc, metadata, _ in batch:
+                await emit(doc, metadata)
+
+        async def on_page(doc: Doc, metadata: DocumentMetadata, content: str):
+            pages.append((doc, metadata, content))
+            if len(pages) >= int(CONFIG["crawler"]["save_batch_size"]):
+                await save_pages()
 
+        try:
+            # If we face sitemap, we will use links from it for extraction.
+            # Otherwise, we are recursively crawling page.
+            if re.search(self.sitemap_pattern, link):
+                await self.traverse_xml(link, frontier=frontier, state=state, on_page=on_page, stats=stats)
+            else:
+                await self.traverse_page(link, frontier=frontier, state=state, on_page=on_page, stats=stats)
+            await save_pages()
+        finally:
+            self.converter.ignore_links = default_ignore_links
+
+    async def link_to_docs(
+        self,
+        link: str,
+        vendor: str,
+        organization: str,
+        collection: str,
+        ignore_urls: bool = True,
+        state: CrawlState = None,
+    ) -> Tuple[List[Doc], List[DocumentMetadata]]:
         documents, documents_metadata = [], []
-        for doc, metadata, content in results:
+
+        async def emit(doc: Doc, metadata: DocumentMetadata):
             documents.append(doc)
             documents_metadata.append(metadata)
 
-            # Writing plain page content to GridFS
-            filename = full_collection_name(vendor, organization, collection) + "_" + metadata.id
-            res = GRIDFS.find_one({"filename": filename})
-            if res:
-                GRIDFS.delete(res._id)
-                logger.info(f"Deleted file {filename} from GridFS")
-            GRIDFS.put(
-                content.encode(),
-                filename=filename,
-                content_type="text/html",
-            )
-
-        self.converter.ignore_links = default_ignore_links
-
+        await self.crawl_link(link, vendor, organization, collection, emit, ignore_urls=ignore_urls, state=state)
         return documents, documents_metadata
 
     async def raw_to_doc(
         self, file: StarletteUploadFile, vendor: str, organization: str, collection: str, doc_id: str
-    ) -> Doc:
-        contents = await file.read()
-        name, format = osp.splitext(file.filename)
-        if format == ".pdf":
-            text = PDF_PARSER.stream2text(stream=contents)
-        elif format == ".docx":
-            text = DOCX_PARSER.stream2text(stream=contents)
-        elif format == ".md":
-            text = MD_PARSER.stream2text(stream=contents)
-        else:
-            msg = f"Uploading files of type {format} is not supported. Allowed types: pdf, docx, and md"
+    ) -> Doc | AsyncIterator[Doc]:
+        return (await self.raw_to_docs([file], vendor, organization, collection, [doc_id]))[0]
+
+    async def raw_to_docs(
+        self, files: List[StarletteUploadFile], vendor: str, organization: str, collection: str, doc_ids: List[str]
+    ) -> List[Doc | AsyncIterator[Doc]]:
+        """
+        Parses uploaded files and saves them to GridFS. A spreadsheet is not read whole, it
+        becomes an async iterator of documents of groups of its rows, read from the upload
+        as they are indexed, see `row_groups`.
+        """
+        docs = []
+        with ExitStack() as buffers:
+            to_save = []
+            for file, doc_id in zip(files, doc_ids):
+                buffer = buffers.enter_context(upload_buffer(file))
+                check_file_size(file.filename, len(buffer))
+                name, format = osp.splitext(file.filename)
+                if format == ".pdf":
+                    # pages of large PDFs are extracted by the parse pool, the loop is not blocked meanwhile
+                    text, page_starts = await asyncio.to_thread(PDF_PARSER.stream2pages, stream=buffer)
+                    docs.append(Doc(content=text, page_starts=page_starts))
+                elif format == ".docx":
+                    await file.seek(0)
+                    docs.append(Doc(content=DOCX_PARSER.stream2text(stream=file.file)))
+                elif format == ".md":
+                    docs.append(Doc(content=MD_PARSER.stream2text(stream=buffer)))
+                elif format in [".xlsx", ".csv"]:
+                    await file.seek(0)
+                    groups = SPREADSHEET_PARSER.stream2groups(
+                        file.file, format, rows_per_group=int(CONFIG["uploads"]["spreadsheet_rows_per_doc"])
+                    )
+                    # the first group is read right away, a file which can not be opened
+                    # fails the request before anything is written
+                    first = await self.next_row_group(groups, file.filename)
+                    docs.append(self.row_groups(first, groups, file.filename))
+                else:
+                    msg = f"Uploading files of type {format} is not supported. Allowed types: pdf, docx, md, xlsx, and csv"
+                    logger.error(msg)
+                    raise HTTPException(
+                        status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                        detail=msg,
+                    )
+                filename = full_collection_name(vendor, organization, collection) + "_" + doc_id
+                to_save.append((filename, buffer, file.content_type))
+
+            # all files are parsed before anything is written, an unsupported one fails the request as before
+            await save_to_gridfs(to_save)
+        return docs
+
+    async def next_row_group(self, groups: Iterator[str], filename: str) -> str | None:
+        # rows are read in a thread, large sheets do not block the loop
+        try:
+            return await asyncio.to_thread(next, groups, None)
+        except FileProcessingError as e:
+            msg = f"{filename}: {e.message}"
             logger.error(msg)
             raise HTTPException(
                 status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
                 detail=msg,
             )
 
-        doc = Doc(content=text)
-
-        filename = full_collection_name(vendor, organization, collection) + "_" + doc_id
-        res = GRIDFS.find_one({"filename": filename})
-        if res:
-            GRIDFS.delete(res._id)
-            logger.info(f"Deleted file {filename} from GridFS")
-        GRIDFS.put(
-            contents,
-            filename=filename,
-            content_type=file.content_type,
-        )
-        return doc
+    async def row_groups(self, first: str | None, groups: Iterator[str], filename: str) -> AsyncIterator[Doc]:
+        text = first
+        while text is not None:
+            yield Doc(content=text)
+            text = await self.next_row_group(groups, filename)
 
     def chat_to_chunks(self, text_lines: List[str]) -> List[str]:
-        return doc_to_chunks(content="---***---".join(text_lines), splitter="---***---", overlapping_lines=10)
+        return self.chats_to_chunks([text_lines])[0]
+
+    def chats_to_chunks(self, chats_lines: List[List[str]]) -> List[List[str]]:
+        return chats_to_chunks(chats_lines)
 
-    def process_document(self, document: Chat | Doc, metadata: DocumentMetadata) -> Tuple[List[str], dict]:
+    def prepare_document(self, document: Chat | Doc, metadata: DocumentMetadata) -> Tuple[dict, str, List[str]]:
         if isinstance(document, Doc):
             meta = {
                 "doc_id": metadata.id,
@@ -283,14 +531,24 @@ class DocumentsParser:
                 else 2**63 - 1,
                 "url": metadata.url if metadata.url else "",
                 "source_language": None,
+                "page_starts": sorted(document.page_starts) if document.page_starts else None,
             }
-            if metadata.project_to_en:
+            if metadata.project_to_en and meta["page_starts"] is not None:
+                # pages are translated as a list, which keeps their boundaries
+                ends = meta["page_starts"][1:] + [len(document.content)]
+                pages = [document.content[start:end] for start, end in zip(meta["page_starts"], ends)]
+                translation = AWS_TRANSLATE_CLIENT.translate_text(pages)
+                meta["source_language"] = translation["source_language"]
+                pages = [f"{page}\n" for page in translation["translation"]]
+                meta["page_starts"] = list(accumulate((len(page) for page in pages[:-1]), initial=0))
+                content = "".join(pages)
+            elif metadata.project_to_en:
                 translation = AWS_TRANSLATE_CLIENT.translate_text(text=document.content)
                 meta["source_language"] = translation["source_language"]
                 content = translation["translation"]
             else:
                 content = document.content
-            chunks = doc_to_chunks(content, meta["doc_title"], meta["doc_summary"])
+            return meta, content, None
 
         elif isinstance(document, Chat):
             meta = {
@@ -313,5 +571,34 @@ class DocumentsParser:
                 text_lines = [f"{ent[0].role}: {ent[1]}" for ent in zip(document.history, translation["translation"])]
                 meta["source_language"] = translation["source_language"]
             content = "\n".join(text_lines)
-            chunks = self.chat_to_chunks(text_lines)
-        return chunks, meta, content
+            return meta, content, text_lines
+
+    def process_document(self, document: Chat | Doc, metadata: DocumentMetadata) -> Tuple[List[str], dict, str]:
+        return self.process_documents([document], [metadata])[0]
+
+    def process_documents(
+        self, documents: List[Chat | Doc], metadata: List[DocumentMetadata]
+    ) -> List[Tuple[List[str], dict, str]]:
+        """
+        Returns chunks, meta and content of every document, meta of documents with pages
+        has `page_spans`, the first and last page of every chunk, numbered from 1.
+        """
+        # chunking is done for all documents at once so that
+        # their lines are tokenized in a single parallel batch
+        prepared = [self.prepare_document(document, meta) for document, meta in zip(documents, metadata)]
+        docs_ids = [i for i, (meta, _, text_lines) in enumerate(prepared) if meta is not None and text_lines is None]
+        chats_ids = [i for i, (meta, _, text_lines) in enumerate(prepared) if text_lines is not None]
+
+        results = [(None, None, None)] * len(documents)
+        line_spans = []
+        docs_chunks = docs_to_chunks([prepared[i][1] for i in docs_ids], line_spans=line_spans)
+        for i, spans in zip(docs_ids, line_spans):
+            meta, content, _ = prepared[i]
+            page_starts = meta.pop("page_starts")
+            if page_starts is not None:
+                meta["page_spans"] = spans_to_pages(content, page_starts, spans)
+        chats_chunks = self.chats_to_chunks([prepared[i][2] for i in chats_ids])
+        for i, chunks in zip(docs_ids + chats_ids, docs_chunks + chats_chunks):
+            meta, content, _ = prepared[i]
+            results[i] = (chunks, meta, content)
+        return results
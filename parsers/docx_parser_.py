@@ -1,14 +1,63 @@
 import os.path as osp
-from tempfile import TemporaryDirectory
-from typing import List, Tuple
+import posixpath
+import zipfile
+from typing import BinaryIO, List, Tuple
 
-import docx
-from simplify_docx import simplify
+from lxml import etree
 
 from parsers.general_parser import GeneralParser
 from utils.tokenize_ import doc_to_chunks
 
-# from docx_parser import DocumentParser
+W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+M = "{http://schemas.openxmlformats.org/officeDocument/2006/math}"
+OFFICE_DOCUMENT = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"
+
+# same normalization of text as simplify_docx did
+TEXT_TRANSLATION = str.maketrans(
+    {
+        **dict.fromkeys("\u2018\u2019\u201a\u201b", "'"),
+        **dict.fromkeys("\u201c\u201d", '"'),
+        **dict.fromkeys("\u2000\u2001\u2002\u2003\u2004\u2005\u2006\u2007\u2008\u2009\u200a", " "),
+        **dict.fromkeys("\u2010\u2011\u2012\u2013\u2014\u2015\u00a0", "-"),
+        **dict.fromkeys("\u200c\u200d", ""),
+    }
+)
+SPECIAL_CHARACTERS = {
+    f"{W}br": "\r",
+    f"{W}cr": "\r",
+    f"{W}tab": "\t",
+    f"{W}ptab": "\t",
+    f"{W}noBreakHyphen": "-",
+    f"{W}softHyphen": "-",
+}
+# objects without text, they still make a paragraph non-empty and stop stripping of its whitespace
+EMPTY_RUN_ELEMENTS = {
+    f"{W}{tag}"
+    for tag in [
+        "instrText",
+        "dayShort",
+        "monthShort",
+        "yearShort",
+        "dayLong",
+        "monthLong",
+        "yearLong",
+        "contentPart",
+        "annotationRef",
+        "footnoteRef",
+        "endnoteRef",
+        "footnoteReference",
+        "endnoteReference",
+        "commentReference",
+        "object",
+        "drawing",
+    ]
+}
+MATH = {f"{M}oMath", f"{M}oMathPara"}
+# containers of runs which are read through, tracked insertions are not (as simplify_docx did)
+RUN_CONTAINERS = {f"{W}hyperlink", f"{W}fldSimple"}
+REVISIONS = {f"{W}ins", f"{W}moveTo"}
+# a non-text part of a paragraph
+EMPTY = None
 
 
 class ListingDispatcher:
@@ -35,60 +84,228 @@ class ListingDispatcher:
         return f"{indent}{pref}"
 
 
+class Field:
+    """
+    Complex field between <w:fldChar> begin and end, possibly spanning paragraphs.
+    Field codes go before separate and are dropped, results go after it. Only results
+    of generic fields are text, a form field (checkbox, dropdown, text input) is a
+    non-text part of the paragraph.
+    """
+
+    def __init__(self, fld_char: etree._Element):
+        self.is_form = fld_char.find(f"{W}ffData") is not None
+        self.results = []
+        # nested fields, e.g. PAGEREF in a TOC, are kept on a stack, True once in results
+        self.stack = [False]
+
+    def update(self, fld_char: etree._Element) -> bool:
+        # returns True once the field is complete
+        kind = fld_char.get(f"{W}fldCharType")
+        if kind == "begin":
+            self.stack.append(False)
+        elif kind == "separate":
+            self.stack[-1] = True
+        elif kind == "end":
+            self.stack.pop()
+        return len(self.stack) == 0
+
+    def add(self, part: str | None):
+        if all(self.stack):
+            self.results.append(part)
+
+    def parts(self) -> List[str | None]:
+        return [EMPTY] if self.is_form else self.results
+
+
+class ParagraphText:
+    """
+    Collects text and non-text parts of a body paragraph. A paragraph which ends in the middle
+    of a field continues with the following one, like simplify_docx merged them.
+    """
+
+    def __init__(self, paragraph: etree._Element):
+        self.parts = []
+        self.field: Field | None = None
+        num_pr = paragraph.find(f"{W}pPr/{W}numPr")
+        self.ilvl, self.num_id = None, None
+        if num_pr is not None:
+            ilvl, num_id = num_pr.find(f"{W}ilvl"), num_pr.find(f"{W}numId")
+            self.ilvl = int(ilvl.get(f"{W}val")) if ilvl is not None else 0
+            self.num_id = int(num_id.get(f"{W}val")) if num_id is not None else None
+
+    @property
+    def is_list_item(self) -> bool:
+        return self.ilvl is not None
+
+    def add(self, part: str | None):
+        if self.field is not None:
+            self.field.add(part)
+        else:
+            self.parts.append(part)
+
+    def feed(self, paragraph: etree._Element):
+        stack = [iter(paragraph)]
+        while len(stack) > 0:
+            elem = next(stack[-1], None)
+            if elem is None:
+                stack.pop()
+                continue
+            tag = elem.tag
+            if tag == f"{W}r":
+                self.feed_run(elem)
+            elif tag in RUN_CONTAINERS:
+                stack.append(iter(elem))
+            elif tag in REVISIONS:
+                # only math and nested revisions are read from tracked insertions
+                stack.append(child for child in elem if child.tag in MATH or child.tag in REVISIONS)
+            elif tag in MATH or tag == f"{W}subDoc":
+                self.add(EMPTY)
+
+    def feed_run(self, run: etree._Element):
+        for elem in run:
+            tag = elem.tag
+            if tag == f"{W}t":
+                self.add((elem.text or "").translate(TEXT_TRANSLATION))
+            elif tag in SPECIAL_CHARACTERS:
+                self.add(SPECIAL_CHARACTERS[tag])
+            elif tag == f"{W}sym":
+                self.add(elem.get(f"{W}char"))
+            elif tag == f"{W}fldChar":
+                if self.field is None:
+                    self.field = Field(elem)
+                elif self.field.update(elem):
+                    field, self.field = self.field, None
+                    for part in field.parts():
+                        self.add(part)
+            elif tag in EMPTY_RUN_ELEMENTS or tag in MATH:
+                self.add(EMPTY)
+
+    def text(self) -> str | None:
+        """
+        Text of the paragraph with leading and trailing whitespace of its text parts stripped,
+        None if nothing is left of it.
+        """
+        parts = [part for part in self.parts if part != ""]
+        while len(parts) > 0 and parts[0] is not EMPTY and parts[0].lstrip() == "":
+            parts.pop(0)
+        if len(parts) > 0 and parts[0] is not EMPTY:
+            parts[0] = parts[0].lstrip()
+        while len(parts) > 0 and parts[-1] is not EMPTY and parts[-1].rstrip() == "":
+            parts.pop()
+        if len(parts) > 0 and parts[-1] is not EMPTY:
+            parts[-1] = parts[-1].rstrip()
+        if len(parts) == 0:
+            return None
+        return "".join(part for part in parts if part is not EMPTY)
+
+
+def _document_part(archive: zipfile.ZipFile) -> str:
+    # the main part is almost always word/document.xml, but the package relationships are the authority
+    try:
+        relationships = etree.fromstring(archive.read("_rels/.rels"))
+    except KeyError:
+        return "word/document.xml"
+    for relationship in relationships:
+        if relationship.get("Type") == OFFICE_DOCUMENT:
+            return posixpath.normpath(relationship.get("Target").lstrip("/"))
+    return "word/document.xml"
+
+
+def _is_body_level(elem: etree._Element) -> bool:
+    # paragraphs and tables are read from the body and from custom xml blocks in it
+    parent = elem.getparent()
+    while parent is not None and parent.tag == f"{W}customXml":
+        parent = parent.getparent()
+    return parent is not None and parent.tag == f"{W}body"
+
+
+def _render_table(table: etree._Element) -> str:
+    rows = []
+    for row in table.iterchildren(f"{W}tr"):
+        cells = []
+        for cell in row.iterchildren(f"{W}tc"):
+            texts = []
+            for paragraph in cell.iterchildren(f"{W}p"):
+                paragraph_text = ParagraphText(paragraph)
+                paragraph_text.feed(paragraph)
+                text = paragraph_text.text()
+                if text:
+                    texts.append(text)
+            cells.append(" ".join(texts))
+        rows.append(" | ".join(cells))
+    return "\n".join(rows)
+
+
 class DocxParser(GeneralParser):
-    def __init__(self, chunk_size: int):
+    def __init__(self, chunk_size: int, render_tables: bool = False):
         super().__init__(chunk_size)
-        self.ld = None
+        self.render_tables = render_tables
 
     def process_file(self, path, content_only=False) -> Tuple[List[str], str]:
         file_name = osp.splitext(osp.split(path)[1])[0]
         meta = {"doc_title": file_name}
-        contents = []
-        doc = docx.Document(path)
-        structure = simplify(doc)
-        body = None
-        for ent in structure["VALUE"]:
-            if ent["TYPE"] == "body":
-                body = ent["VALUE"]
-        assert body is not None, f"Body not found parsing {path}"
-        for p in body:
-            if p["TYPE"] == "paragraph":
-                paragraph_text = self.parse_paragraph(p)
-                contents.append(paragraph_text)
-        content = "\n".join(contents)
+        content = self.extract_content(path)
         if content_only:
             return content
         meta["security_groups"] = 2**63 - 1
         chunks = doc_to_chunks(content=content, title=file_name)
         return chunks, content, meta
 
-    def parse_paragraph(self, paragraph: dict):
-        text = ""
-        for item in paragraph["VALUE"]:
-            if item["TYPE"] == "text":
-                text += item["VALUE"]
-        if "style" in paragraph:
-            if "numPr" in paragraph["style"]:
-                # we faced a list item
-                if self.ld is None:
-                    self.ld = ListingDispatcher(numbered=(paragraph["style"]["numPr"]["numId"] in [0, 2]))
-                prefix = self.ld.get_prefix(paragraph["style"]["numPr"]["ilvl"])
-                text = f"{prefix}{text}"
-            else:
-                self.ld = None
-        else:
-            # resetting dispatcher
-            self.ld = None
-        return text
+    def extract_content(self, source: str | BinaryIO) -> str:
+        """
+        Reads text of body paragraphs of a .docx file straight from its document.xml. The xml is
+        parsed incrementally and every paragraph is dropped once read, so memory does not grow
+        with the size of the document. List items get their numbers from ListingDispatcher,
+        tables are rendered as rows of " | "-separated cells if `render_tables` is set.
+        """
+        contents = []
+        listing = None
+        paragraph_text: ParagraphText | None = None
 
-    def stream2text(self, stream: bytes) -> str:
-        with TemporaryDirectory() as tmp:
-            with open(osp.join(tmp, "document.docx"), "wb") as f:
-                f.write(stream)
-            return self.process_file(osp.join(tmp, "document.docx"), content_only=True)
+        def add_paragraph(paragraph_text: ParagraphText):
+            nonlocal listing
+            text = paragraph_text.text()
+            if text is None:
+                return
+            if not paragraph_text.is_list_item:
+                listing = None
+            else:
+                # we faced a list item
+                if listing is None:
+                    listing = ListingDispatcher(numbered=paragraph_text.num_id in [0, 2])
+                text = f"{listing.get_prefix(paragraph_text.ilvl)}{text}"
+            contents.append(text)
 
+        with zipfile.ZipFile(source) as archive, archive.open(_document_part(archive)) as document:
+            for _, elem in etree.iterparse(document, events=("end",), tag=(f"{W}p", f"{W}tbl")):
+                if not _is_body_level(elem):
+                    # paragraphs of tables are read with their table
+                    continue
+                if elem.tag == f"{W}p":
+                    if paragraph_text is None:
+                        paragraph_text = ParagraphText(elem)
+                    paragraph_text.feed(elem)
+                    if paragraph_text.field is None:
+                        add_paragraph(paragraph_text)
+                        paragraph_text = None
+                else:
+                    if paragraph_text is not None:
+                        # a field left open before a table is dropped
+                        paragraph_text.field = None
+                        add_paragraph(paragraph_text)
+                        paragraph_text = None
+                    if self.render_tables:
+                        contents.append(_render_table(elem))
+                        listing = None
+                # dropping what has been read, siblings before it included
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+        if paragraph_text is not None:
+            paragraph_text.field = None
+            add_paragraph(paragraph_text)
+        return "\n".join(contents)
 
-# my_doc = docx.Document(infile)
-# my_doc_as_json = simplify(my_doc)
-# with open('temp_doc2json.json','wt') as f:
-#     json.dump(my_doc_as_json, f, indent=4)
+    def stream2text(self, stream: BinaryIO) -> str:
+        # the zip container is read straight from a seekable file object
+        return self.extract_content(stream)
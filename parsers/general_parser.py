@@ -1,12 +1,7 @@
 import abc
 from typing import Any, List
 
-import nltk
-
-try:
-    nltk.data.find("tokenizers/punkt")
-except LookupError:
-    nltk.download("punkt")
+from utils.sentences import split_sentences
 
 
 class GeneralParser:
@@ -20,7 +15,7 @@ class GeneralParser:
 
     @staticmethod
     def text_to_sentences(text: str) -> List[str]:
-        return nltk.tokenize.sent_tokenize(text)
+        return split_sentences(text)
 
     @staticmethod
     def chunkise_sentences(sentences: List[str], chunk_size: int) -> List[str]:
@@ -1,12 +1,81 @@
 import abc
-import re
-from collections import deque
-from copy import deepcopy
 from typing import List, Tuple
 
 import htmltabletomd
 from bs4 import BeautifulSoup
-from bs4.element import NavigableString, Tag
+from bs4.element import NavigableString, PageElement, Tag
+
+from parsers.chunk_splitter import merge_texts, split_text
+
+# tags inside of other tags which are rendered as their text
+INLINE_TAGS = {
+    "span",
+    "code",
+    "em",
+    "strong",
+    "p",
+    "small",
+    "div",
+    "sub",
+    "sup",
+    "label",
+    "time",
+    "u",
+    "b",
+    "span2.",
+    "i",
+    "center",
+    "var",
+    "font",
+    "option",
+}
+# top level tags which are rendered as their text
+BLOCK_TAGS = {
+    "p",
+    "div",
+    "blockquote",
+    "strong",
+    "br",
+    "hr",
+    "span",
+    "b",
+    "font",
+    "u",
+    "i",
+    "center",
+    "em",
+    "option",
+    "sup",
+}
+# tags inside of other tags which are dropped
+SKIPPED_TAGS = {
+    "o:p",
+    'br=""',
+    "source",
+    "audio",
+    "video",
+    "input",
+    "picture",
+    "w:wrap",
+    "o:o:p",
+    "noscript",
+    "table",
+}
+# top level tags which are dropped
+IGNORED_TAGS = {
+    "style",
+    "meta",
+    "noscript",
+    "title",
+    "link",
+    "form",
+    "button",
+    "figure",
+    "header",
+    "video",
+    "script",
+    "database",
+}
 
 
 class TagPartsList(list):
@@ -35,63 +104,44 @@ class ChunksManager:
         for part in newparts:
             cur_text, type_ = part
             if type_ == "header":
-                if self.accumulated_text != "":
-                    chunk_text = (
-                        f"{self.current_header}\n{self.accumulated_text}"
-                        if self.current_header != ""
-                        else self.accumulated_text
-                    )
-                    self.accumulated_text = ""
-                    chunk = {"title": self.meta, "text": chunk_text}
-                    self.chunks.extend(self.opt_split_into_smaller_chunks(chunk))
-                self.current_header = cur_text
+                self.add_header(cur_text)
             elif type_ == "text":
-                if len(self.accumulated_text) + len(cur_text) > self.chunk_max_length:
-                    if self.accumulated_text != "":
-                        chunk_text = (
-                            f"{self.current_header}\n{self.accumulated_text}"
-                            if self.current_header != ""
-                            else self.accumulated_text
-                        )
-                        chunk = {"title": self.meta, "text": chunk_text}
-                        self.chunks.extend(self.opt_split_into_smaller_chunks(chunk))
-                    self.accumulated_text = cur_text
-                else:
-                    self.accumulated_text += f"\n{cur_text}"
+                self.add_text(cur_text)
             else:
                 assert False, f"Unknown type {type_}"
 
+    def add_header(self, text: str):
+        if self.accumulated_text != "":
+            chunk_text = (
+                f"{self.current_header}\n{self.accumulated_text}"
+                if self.current_header != ""
+                else self.accumulated_text
+            )
+            self.accumulated_text = ""
+            chunk = {"title": self.meta, "text": chunk_text}
+            self.chunks.extend(self.opt_split_into_smaller_chunks(chunk))
+        self.current_header = text
+
+    def add_text(self, text: str):
+        if len(self.accumulated_text) + len(text) > self.chunk_max_length:
+            if self.accumulated_text != "":
+                chunk_text = (
+                    f"{self.current_header}\n{self.accumulated_text}"
+                    if self.current_header != ""
+                    else self.accumulated_text
+                )
+                chunk = {"title": self.meta, "text": chunk_text}
+                self.chunks.extend(self.opt_split_into_smaller_chunks(chunk))
+            self.accumulated_text = text
+        else:
+            self.accumulated_text += f"\n{text}"
+
     def compress_chunks(self, chunks: list) -> list:
-        new_chunks = []
-        cur_chunk = chunks[0]
-        for chunk in chunks[1:]:
-            if len(cur_chunk["text"]) + len(chunk["text"]) < self.chunk_max_length:
-                cur_chunk["text"] += f"\n{chunk['text']}"
-            else:
-                new_chunks.append(deepcopy(cur_chunk))
-                cur_chunk = chunk
-        new_chunks.append(cur_chunk)
-        return new_chunks
+        texts = merge_texts([chunk["text"] for chunk in chunks], self.chunk_max_length)
+        return [{"title": self.meta, "text": text} for text in texts]
 
     def opt_split_into_smaller_chunks(self, chunk: dict) -> list[dict]:
-        # todo: index throw
-        if len(chunk["text"]) < 2000:
-            return [chunk]
-        txt = chunk["text"]
-        n_ids = []
-        for i in range(len(txt)):
-            if txt[i] == "\n":
-                n_ids.append(i)
-        if len(n_ids) == 0:
-            # no breaks at all
-            part = {"title": chunk["title"], "text": chunk["text"][:2000]}
-            remaining = {"title": chunk["title"], "text": chunk["text"][2000:]}
-            print(f"Hard split!")
-            return [part] + self.opt_split_into_smaller_chunks(remaining)
-        split_id = n_ids[len(n_ids) // 2]
-        part = {"title": chunk["title"], "text": chunk["text"][:split_id]}
-        remaining = {"title": chunk["title"], "text": chunk["text"][split_id + 1 :]}
-        return self.opt_split_into_smaller_chunks(part) + self.opt_split_into_smaller_chunks(remaining)
+        return [{"title": chunk["title"], "text": text} for text in split_text(chunk["text"])]
 
     def digest(self):
         if self.accumulated_text != "":
@@ -108,270 +158,268 @@ class ChunksManager:
         return chunks
 
 
-class HTMLParser:
-    def __init__(self, chunk_length=1024):
-        self.chunk_length = chunk_length
+class Header(str):
+    """
+    Text of an h1 or h2 met inside of another tag, it starts a new chunk.
+    """
 
-    def render_list(self, elem: Tag, depth=0):
-        # print(f"Rendering list {elem.name} with depth {depth}")
-        ordered = elem.name == "ol"
-        items = []
-        cnter = 1
-        for ch in elem.children:
-            if isinstance(ch, NavigableString):
-                continue
-            if ch.name in ["ol", "ul"]:
-                items.append(self.render_list(ch, depth=depth + 1))
-                continue
-            elif ch.name == "br":
-                continue
-            elif ch.name in ["p", "h1", "h2", "h3", "h4", "h5", "h6", "div"]:
-                # bruh what the fuck
-                items.append(self.render_text(ch))
-                continue
-            elif ch.name in ["img"]:
-                continue
-            assert ch.name in ["li", "option"], (ch.name, type(ch))
-            # print("rendering li")
-            pref = " " * (2 * depth) + (f"{cnter}. " if ordered else "* ")
-            # print(f"_______Pref: {pref}")
-            text_within = self.render_text(ch, list_depth=depth + 1)
-            # print(text_within.__repr__())
-            # exit(0)
-            items.append(f"{pref}{text_within}")
-            cnter += 1
-        return "\n".join(items)
 
-    def render_table(self, table: str) -> str:
-        return htmltabletomd.convert_table(table)
+class Rendered(list):
+    """
+    Rendered text with headers in it, a list of str and Header parts.
+    Adjacent text parts are merged and empty ones are dropped.
+    """
 
-    def render_link(self, elem: Tag) -> str:
-        if "href" not in elem.attrs:
-            return self.render_text(elem)
-        link = elem.attrs["href"]
-        if link.startswith("#"):
-            return self.render_text(elem)
+    def add(self, part: str):
+        if part == "":
+            return
+        if len(self) > 0 and not isinstance(part, Header) and not isinstance(self[-1], Header):
+            self[-1] += part
         else:
-            return f"{self.render_text(elem)} (link:{elem.attrs['href']})"
-
-    def render_code(self, elem: Tag) -> str:
-        return f"\n{self.render_text(elem)}\n"
-
-    def render_text(self, elem: Tag, list_depth=0):
-        parts = []
-        for ch in elem.children:
-            if ch.name is None:
-                rendered = ch
-            elif ch.name in ["ul", "ol"]:
-                rendered = self.render_list(ch, depth=list_depth)
-            elif ch.name == "pre":
-                rendered = "".join(ch.strings) + "\n"
-            elif ch.name == "a":
-                rendered = self.render_link(ch)
-            elif ch.name in [
-                "span",
-                "code",
-                "em",
-                "strong",
-                "p",
-                "small",
-                "div",
-                "sub",
-                "sup",
-                "label",
-                "time",
-                "u",
-                "b",
-                "span2.",
-                "i",
-                "center",
-                "var",
-                "font",
-                "option",
-            ]:
-                rendered = self.render_text(ch)
-            elif (
-                ch.name.startswith("st1:") or ch.name.startswith("mailto") or ch.name.startswith("http")
-            ):  # vivantio specificity
-                rendered = self.render_text(ch)
-            elif ch.name in ["br", "hr"]:
-                rendered = "\n"
-            elif ch.name in ["img", "iframe", "style"]:
-                continue
-            elif ch.name == "table":
-                rendered = ""
-                # rendered = self.render_table(str(ch))
-            elif ch.name in ["script"]:
-                rendered = self.render_code(ch)
-            elif ch.name in ["h1", "h2"]:
-                rendered = f"%%%%%{self.render_text(ch)}%%%%%"
-            elif ch.name in ["h3", "h4", "h5", "h6"]:
-                # ffs what kind of psycho puts headers in paragraphs
-                rendered = f"\n{self.render_text(ch)}"
-            elif ch.name in ["li"]:
-                # print(f"li outinside of the list!!!")
-                rendered = f"\n* {self.render_text(ch)}"
-            elif ch.name in [
-                "o:p",
-                'br=""',
-                "source",
-                "audio",
-                "video",
-                "input",
-                "picture",
-                "w:wrap",
-                "o:o:p",
-                "noscript",
-                "table",
-            ]:
-                continue
-            elif ch.name.startswith("v:"):  # vivantio specificity
-                continue
-            else:
-                assert False, f"Unknown tag parsing text: {ch.name}: {self.render_text(ch)}"
-            # print(f"Rendering {ch.name}, adding {rendered.__repr__()}")
-            parts.append(rendered)
-        return "".join(parts).strip()
+            self.append(part)
 
-    def render_tag(self, elem: Tag) -> str:
+    def strip(self) -> "Rendered":
+        # same as str.strip() of the text, headers are never blank so they stop it
+        parts = list(self)
+        while len(parts) > 0 and not isinstance(parts[0], Header) and parts[0].lstrip() == "":
+            parts.pop(0)
+        if len(parts) > 0 and not isinstance(parts[0], Header):
+            parts[0] = parts[0].lstrip()
+        while len(parts) > 0 and not isinstance(parts[-1], Header) and parts[-1].rstrip() == "":
+            parts.pop()
+        if len(parts) > 0 and not isinstance(parts[-1], Header):
+            parts[-1] = parts[-1].rstrip()
+        return Rendered(parts)
+
+
+def _concat(values: List[str | Rendered], separator: str = "") -> str | Rendered:
+    if not any(isinstance(value, Rendered) for value in values):
+        return separator.join(values)
+    concatenated = Rendered()
+    for i, value in enumerate(values):
+        if i > 0:
+            concatenated.add(separator)
+        for part in value if isinstance(value, Rendered) else [value]:
+            concatenated.add(part)
+    return concatenated
+
+
+def _flatten(value: str | Rendered) -> str:
+    return value if isinstance(value, str) else "".join(value)
+
+
+class _Frame:
+    """
+    Tag being rendered: an iterator over its children, parts rendered so far
+    and what to do with them once all children are rendered.
+    """
+
+    __slots__ = (
+        "children",
+        "parts",
+        "has_headers",
+        "is_list",
+        "ordered",
+        "depth",
+        "counter",
+        "prefix",
+        "suffix",
+        "header",
+    )
+
+    def __init__(
+        self, elem: Tag, is_list: bool = False, depth: int = 0, prefix: str = "", suffix: str = "", header=False
+    ):
+        self.children = iter(elem.children)
+        self.parts = []
+        self.has_headers = False
+        self.is_list = is_list
+        self.ordered = elem.name == "ol"
+        self.depth = depth
+        self.counter = 1
+        self.prefix = prefix
+        self.suffix = suffix
+        self.header = header
+
+    def finish(self) -> str | Rendered:
+        if not self.has_headers:
+            value = "\n".join(self.parts) if self.is_list else "".join(self.parts).strip()
+        elif self.is_list:
+            value = _concat(self.parts, "\n")
+        else:
+            value = _concat(self.parts).strip()
+        if self.header:
+            text = _flatten(value)
+            value = Rendered([Header(text)]) if text != "" else ""
+        if self.prefix != "" or self.suffix != "":
+            value = _concat([self.prefix, value, self.suffix])
+        return value
+
+
+class HTMLParser:
+    """
+    Renders html of knowledge-base articles into chunks. Tags are rendered with an explicit
+    stack instead of recursion, so nesting depth is not limited, and h1 and h2 met at any
+    depth come out as Header parts which go to ChunksManager as headers right away.
+    """
+
+    def __init__(self, chunk_length=1024):
+        self.chunk_length = chunk_length
+
+    def _render(self, frame: _Frame) -> str | Rendered:
+        stack = [frame]
+        while True:
+            frame = stack[-1]
+            ch = next(frame.children, None)
+            if ch is None:
+                value = frame.finish()
+                stack.pop()
+                if len(stack) == 0:
+                    return value
+                stack[-1].parts.append(value)
+                stack[-1].has_headers = stack[-1].has_headers or isinstance(value, Rendered)
+                continue
+            rendered = self._list_item(ch, frame) if frame.is_list else self._text_part(ch, frame.depth)
+            if isinstance(rendered, _Frame):
+                stack.append(rendered)
+            elif rendered is not None:
+                frame.parts.append(rendered)
+
+    def _list_item(self, ch: PageElement, frame: _Frame) -> str | _Frame | None:
+        if isinstance(ch, NavigableString):
+            return None
+        if ch.name in ["ol", "ul"]:
+            return _Frame(ch, is_list=True, depth=frame.depth + 1)
+        elif ch.name == "br":
+            return None
+        elif ch.name in ["p", "h1", "h2", "h3", "h4", "h5", "h6", "div"]:
+            # bruh what the fuck
+            return _Frame(ch)
+        elif ch.name in ["img"]:
+            return None
+        assert ch.name in ["li", "option"], (ch.name, type(ch))
+        prefix = " " * (2 * frame.depth) + (f"{frame.counter}. " if frame.ordered else "* ")
+        frame.counter += 1
+        return _Frame(ch, depth=frame.depth + 1, prefix=prefix)
+
+    def _link(self, elem: Tag) -> _Frame:
+        if "href" not in elem.attrs or elem.attrs["href"].startswith("#"):
+            return _Frame(elem)
+        return _Frame(elem, suffix=f" (link:{elem.attrs['href']})")
+
+    def _text_part(self, ch: PageElement, list_depth: int) -> str | _Frame | None:
+        if ch.name is None:
+            return str(ch)
+        elif ch.name in ["ul", "ol"]:
+            return _Frame(ch, is_list=True, depth=list_depth)
+        elif ch.name == "pre":
+            return "".join(ch.strings) + "\n"
+        elif ch.name == "a":
+            return self._link(ch)
+        elif ch.name in INLINE_TAGS:
+            return _Frame(ch)
+        elif ch.name.startswith("st1:") or ch.name.startswith("mailto") or ch.name.startswith("http"):
+            # vivantio specificity
+            return _Frame(ch)
+        elif ch.name in ["br", "hr"]:
+            return "\n"
+        elif ch.name in ["img", "iframe", "style"]:
+            return None
+        elif ch.name == "table":
+            # return self.render_table(str(ch))
+            return ""
+        elif ch.name in ["script"]:
+            return _Frame(ch, prefix="\n", suffix="\n")
+        elif ch.name in ["h1", "h2"]:
+            return _Frame(ch, header=True)
+        elif ch.name in ["h3", "h4", "h5", "h6"]:
+            # ffs what kind of psycho puts headers in paragraphs
+            return _Frame(ch, prefix="\n")
+        elif ch.name in ["li"]:
+            return _Frame(ch, prefix="\n* ")
+        elif ch.name in SKIPPED_TAGS or ch.name.startswith("v:"):  # vivantio specificity
+            return None
+        assert False, f"Unknown tag parsing text: {ch.name}: {''.join(ch.strings)}"
+
+    def _render_tag(self, elem: Tag) -> str | Rendered:
         if elem.name in ["ul", "ol", "select"]:
-            list_text = self.render_list(elem)
-            return list_text
+            return self._render(_Frame(elem, is_list=True))
         elif elem.name == "a":
-            link_text = self.render_link(elem)
-            return link_text
-        elif elem.name in ["p"]:
-            p_text = self.render_text(elem)
-            return p_text
-        elif elem.name in [
-            "div",
-            "blockquote",
-            "strong",
-            "br",
-            "hr",
-            "span",
-            "b",
-            "font",
-            "u",
-            "i",
-            "center",
-            "em",
-            "option",
-            "sup",
-        ]:
-            elem_text = self.render_text(elem)
-            return elem_text
+            return self._render(self._link(elem))
+        elif elem.name in BLOCK_TAGS:
+            return self._render(_Frame(elem))
         elif elem.name == "pre":
-            pre_text = "".join(elem.strings)
-            return pre_text
+            return "".join(elem.strings)
         elif elem.name == "table":
             # temporary because of vivantio
-            table_text = ""
-            # table_text =  self.render_table(str(elem))
-            return table_text
+            # return self.render_table(str(elem))
+            return ""
         elif elem.name == "li":
-            li_text = f"\n*{self.render_text(elem)}"
-            return li_text
-        elif elem.name in [
-            "style",
-            "meta",
-            "noscript",
-            "title",
-            "link",
-            "style",
-            "form",
-            "button",
-            "figure",
-            "header",
-            "video",
-            "script",
-            "database",
-        ]:
+            return self._render(_Frame(elem, prefix="\n*"))
+        elif elem.name in IGNORED_TAGS:
             return ""
         elif elem.name in ["code"]:
-            code_text = self.render_code(elem)
-            return code_text
+            return self._render(_Frame(elem, prefix="\n", suffix="\n"))
         elif elem.name.startswith("mailto"):  # vivantio
-            text = self.render_text(elem)
-            return text
+            return self._render(_Frame(elem))
         elif elem.name.startswith("w:") or elem.name.startswith("http"):  # vivantio
             return ""
         else:
-            # print(f"Unknown element with name {elem.name}!: {render_text(elem)}")
             print(f"Unknown tag with name {elem.name}!: {''.join(elem.strings)}")
             return "".join(elem.strings)
 
+    def render_list(self, elem: Tag, depth=0) -> str:
+        return _flatten(self._render(_Frame(elem, is_list=True, depth=depth)))
+
+    def render_table(self, table: str) -> str:
+        return htmltabletomd.convert_table(table)
+
+    def render_text(self, elem: Tag, list_depth=0) -> str:
+        return _flatten(self._render(_Frame(elem, depth=list_depth)))
+
+    def render_tag(self, elem: Tag) -> str:
+        return _flatten(self._render_tag(elem))
+
     @abc.abstractmethod
     def preprocess_document(self, article: dict) -> Tuple[str, str, dict]:
         pass
 
-    def _extract_headers(self, text: str):
-        # todo: more elegant idk
-        regex = re.compile(r"%%%%%(.+?)%%%%%")
-        start_poss, end_poss = [], []
-        for m in regex.finditer(text):
-            start_poss.append(m.start())
-            end_poss.append(m.end())
-        if len(start_poss) == 0:
-            return [[text, "text"]]
-        text_start_poss = [0]
-        text_end_poss = []
-        for s, e in zip(start_poss, end_poss):
-            text_end_poss.append(s)
-            text_start_poss.append(e)
-        text_end_poss.append(len(text))
-        assert len(text_start_poss) == len(text_end_poss)
-        parts = []
-
-        for i in range(len(start_poss)):
-            text_part = text[text_start_poss[i] : text_end_poss[i]]
-            if len(text_part) > 0:
-                parts.append([text_part, "text"])
-            header_part = text[start_poss[i] : end_poss[i]]
-            header_part = header_part[5:-5]
-            parts.append([header_part, "header"])
-        text_part = text[text_start_poss[-1] : text_end_poss[-1]]
-        if len(text_part) > 0:
-            parts.append([text_part, "text"])
-        return parts
-
     def process_document(self, article: dict, debug=False):
         meta, body, meta_info = self.preprocess_document(article)
 
         parsed = BeautifulSoup(body, features="html.parser")
         if debug:
             print(parsed)
-        # print("".join(parsed.strings))
-        queue = deque(parsed.children)
         chunks_manager = ChunksManager(meta)
-        while len(queue) > 0:
-            ch = queue.popleft()
-            if isinstance(ch, Tag):
-                if ch.name in ["div", "html", "body"]:
-                    queue.extendleft(list(ch.children)[::-1])
-                    continue
-                elif ch.name in ["h1", "h2"]:
-                    if debug:
-                        print(f"\n______________________\nrendering tag: {ch.name}")
-                    heading_text = self.render_text(ch)
-                    chunks_manager.update([[heading_text, "header"]])
-                    if debug:
-                        print(f"\nheader processed: {heading_text}\n___________________")
-                elif ch.name in ["h3", "h4", "h5", "h6"]:
-                    heading_text = f"\n\n{self.render_text(ch)}"
-                    chunks_manager.update([[heading_text, "text"]])
-                elif ch.name in ["iframe", "img", "head"]:
+        # containers are walked into with a stack of their children iterators
+        stack = [iter(parsed.children)]
+        while len(stack) > 0:
+            ch = next(stack[-1], None)
+            if ch is None:
+                stack.pop()
+                continue
+            if not isinstance(ch, Tag):
+                continue
+            if debug:
+                print(f"rendering tag: {ch.name}")
+            if ch.name in ["div", "html", "body"]:
+                stack.append(iter(ch.children))
+            elif ch.name in ["h1", "h2"]:
+                chunks_manager.add_header(self.render_text(ch))
+            elif ch.name in ["h3", "h4", "h5", "h6"]:
+                chunks_manager.add_text(f"\n\n{self.render_text(ch)}")
+            elif ch.name in ["iframe", "img", "head"]:
+                continue
+            else:
+                rendered = self._render_tag(ch)
+                if isinstance(rendered, str):
+                    chunks_manager.add_text(rendered)
                     continue
-                else:
-                    if debug:
-                        print(f"\n______________________\nrendering tag: {ch.name}")
-                    tag_text = self.render_tag(ch)
-                    parts = self._extract_headers(tag_text)
-                    chunks_manager.update(parts)
-
-                    # chunks_manager.update(tag_parts)
-                    # if debug:
-                    #     print(f"\ntag parts: {tag_parts}\n___________________")
+                for part in rendered:
+                    if isinstance(part, Header):
+                        chunks_manager.add_header(part)
+                    else:
+                        chunks_manager.add_text(part)
 
         chunks = chunks_manager.digest()
 
@@ -1,7 +1,4 @@
-import os.path as osp
 import re
-from copy import deepcopy
-from tempfile import TemporaryDirectory
 from typing import List, Tuple, Union
 
 import marko
@@ -10,15 +7,32 @@ from marko.block import List as MDList
 from marko.block import ListItem, Paragraph, Quote, ThematicBreak
 from marko.inline import Emphasis, InlineHTML, LineBreak, Link, Literal, RawText, StrongEmphasis
 
+from parsers.chunk_splitter import merge_texts, split_text
 from parsers.general_parser import GeneralParser
 
+# yaml front matter of Hugo and Jekyll pages, only at the very beginning of a document
+FRONT_MATTER = re.compile(r"\A\s*(?P<front_matter>---[ \t]*\n(?P<yaml>.*?)^---[ \t]*$)", re.DOTALL | re.MULTILINE)
+# {{% ol %}} and {{% ol start="3" %}} stand for numbers of list items, other shortcodes,
+# {#anchors} and {{< partials >}} are dropped. Alternatives share the leading "{",
+# so the scan jumps between braces instead of trying every alternative at every character
+PLACEHOLDERS = re.compile(r'{(?:(?P<ol>{% *ol *(?:start="(?P<start>\d+)" *)?%}})|{%.*?%}}|#.*?}|{<.*?>}})')
+ORDERED_LIST_STARTS = {str(i) for i in range(1, 20)}
+
+
+def _render_placeholder(match: re.Match) -> str:
+    if match.group("ol") is None:
+        return ""
+    start = match.group("start")
+    if start is None:
+        return "1. "
+    return f"{start}. " if start in ORDERED_LIST_STARTS else ""
+
 
 class MarkdownParser(GeneralParser):
-    def stream2text(self, stream: bytes) -> str:
-        with TemporaryDirectory() as tmp:
-            with open(osp.join(tmp, "document.md"), "wb") as f:
-                f.write(stream)
-            return self.get_text(osp.join(tmp, "document.md"))
+    def stream2text(self, stream: bytes | memoryview) -> str:
+        # decoding in place, newlines are normalized the same way text-mode open() does
+        text = str(stream, "utf-8")
+        return text.replace("\r\n", "\n").replace("\r", "\n")
 
     def get_text(self, path: str) -> str:
         with open(path, "rt") as f:
@@ -70,47 +84,23 @@ class MarkdownParser(GeneralParser):
         return ["\n".join([ch["title"], ch["text"]]) for ch in chunks], meta
 
     def opt_split_into_smaller_chunks(self, chunk: dict) -> list[dict]:
-        # todo: index throw
-        if len(chunk["text"]) < 2000:
-            return [chunk]
-        txt = chunk["text"]
-        n_ids = []
-        for i in range(len(txt)):
-            if txt[i] == "\n":
-                n_ids.append(i)
-        if len(n_ids) == 0:
-            # no breaks at all
-            part = {"title": chunk["title"], "text": chunk["text"][:2000]}
-            remaining = {"title": chunk["title"], "text": chunk["text"][2000:]}
-            print(f"Hard split!")
-            return [part] + self.opt_split_into_smaller_chunks(remaining)
-        split_id = n_ids[len(n_ids) // 2]
-        part = {"title": chunk["title"], "text": chunk["text"][:split_id]}
-        remaining = {"title": chunk["title"], "text": chunk["text"][split_id + 1 :]}
-        return self.opt_split_into_smaller_chunks(part) + self.opt_split_into_smaller_chunks(remaining)
-
-    def preprocess_text(self, text: str):
-        # removing placeholder tags
-        text = re.sub(r"{{% *ol *%}}", "1. ", text)
-        for i in range(1, 20):
-            text = re.sub(f'{{{{% *ol *start="{i}" *%}}}}', f"{i}. ", text)
-        text = re.sub(r"{{%.*?%}}", "", text)
-        text = re.sub(r"{#.*?}", "", text)
-        text = re.sub(r"{{<.*?>}}", "", text)
-
-        elem_meta_re = re.compile(r"---(.*)?---", re.DOTALL)
-        search = re.search(elem_meta_re, text)
+        return [{"title": chunk["title"], "text": text} for text in split_text(chunk["text"])]
+
+    def preprocess_text(self, text: str) -> Tuple[str, str]:
+        """
+        Drops the front matter of a document and Hugo/Jinja placeholder tags in one scan,
+        returns the text and the title from the front matter.
+        """
         meta = ""
-        if search:
-            matched = search.group(1).strip().split("\n")
-            for line in matched:
-                key, val = line.split(":", maxsplit=1)
+        front_matter = FRONT_MATTER.match(text)
+        if front_matter:
+            for line in front_matter.group("yaml").split("\n"):
+                key, _, val = line.partition(":")
                 if key.strip() == "title":
                     meta = val.strip()
                     break
-        elem_meta_re = re.compile(r"---.*---", re.DOTALL)
-        text = re.sub(elem_meta_re, "", text)
-        return text, meta
+            text = text[: front_matter.start("front_matter")] + text[front_matter.end() :]
+        return PLACEHOLDERS.sub(_render_placeholder, text), meta
 
     def preprocess_document(self, document: Document):
         new_children = [ch for ch in document.children if not isinstance(ch, (ThematicBreak, HTMLBlock))]
@@ -205,13 +195,7 @@ class MarkdownParser(GeneralParser):
         return rendered
 
     def compress_chunks(self, chunks: list):
-        new_chunks = []
-        cur_chunk = chunks[0]
-        for chunk in chunks[1:]:
-            if len(cur_chunk["text"]) + len(chunk["text"]) < 1024:
-                cur_chunk["text"] += f"\n{chunk['text']}"
-            else:
-                new_chunks.append(deepcopy(cur_chunk))
-                cur_chunk = chunk
-        new_chunks.append(cur_chunk)
-        return new_chunks
+        if len(chunks) == 0:
+            return []
+        texts = merge_texts([chunk["text"] for chunk in chunks], 1024)
+        return [{"title": chunks[0]["title"], "text": text} for text in texts]
@@ -0,0 +1,149 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import forkserver
+from typing import Callable, Dict, List, Tuple, TypeVar
+from urllib.parse import urljoin
+
+import html2text
+from bs4 import BeautifulSoup, SoupStrainer
+
+from utils import CONFIG
+
+try:
+    import lxml  # noqa: F401
+
+    HTML_PARSER, XML_PARSER = "lxml", "xml"
+except ImportError:
+    # html.parser keeps tag names of sitemaps as they are, so it reads them too
+    HTML_PARSER, XML_PARSER = "html.parser", "html.parser"
+
+T = TypeVar("T")
+
+SITEMAP_STRAINER = SoupStrainer(["loc", "lastmod"])
+CONVERTERS: Dict[bool, html2text.HTML2Text] = {}
+
+# created on first use, so every app worker gets its own pool of parsing processes,
+# it runs parsing of crawled pages and text extraction of large PDFs
+PARSE_POOL: ProcessPoolExecutor = None
+# imported once by the fork server, pool processes are forked with them: the main module,
+# which processes import anyway, and modules of the functions the pool runs
+PARSE_MODULES = ["__main__", "parsers.page_parser", "parsers.pdf_parser"]
+
+
+def get_converter(ignore_links: bool) -> html2text.HTML2Text:
+    if ignore_links not in CONVERTERS:
+        converter = html2text.HTML2Text()
+        converter.ignore_images = True
+        converter.ignore_links = ignore_links
+        CONVERTERS[ignore_links] = converter
+    return CONVERTERS[ignore_links]
+
+
+def is_sitemap(page_content: str) -> bool:
+    return "<html" not in page_content and "<?xml" in page_content
+
+
+def parse_sitemap(page_content: str) -> Tuple[List[str], Dict[str, str]]:
+    """
+    Returns urls of a sitemap and <lastmod> of those which have it.
+    Only <loc> and <lastmod> tags are built into the tree.
+    """
+    soup = BeautifulSoup(page_content, XML_PARSER, parse_only=SITEMAP_STRAINER)
+    urls, lastmods = [], {}
+    for tag in soup.find_all(["loc", "lastmod"]):
+        if tag.name == "loc":
+            urls.append(tag.text.strip())
+        elif len(urls) > 0:
+            # <lastmod> goes after <loc> of the same entry
+            lastmods[urls[-1]] = tag.text.strip()
+    return urls, lastmods
+
+
+def parse_html(
+    link: str, page_content: str, ignore_links: bool, parser: str = HTML_PARSER
+) -> Tuple[str, str | None, str | None, List[str]]:
+    """
+    Parses a page into its title, markdown content, cleaned html and absolute urls
+    of all links on it. Content is None for redirecting pages.
+    """
+    soup = BeautifulSoup(page_content, parser)
+    # links are collected before dropping header and footer, navigation there leads to other pages
+    urls = [urljoin(link, a["href"].strip()) for a in soup.find_all(href=True)] if "<html" in page_content else []
+
+    for each in ["header", "footer"]:
+        s = soup.find(each)
+        if s:
+            s.extract()
+    div_to_remove = soup.find_all("div", class_="kb-footer")
+    if div_to_remove:
+        div_to_remove[0].extract()
+
+    title = soup.find("title").text if (soup.find("title") and soup.find("title").text) else link
+    if "redirecting" in title.lower():
+        return title, None, None, urls
+
+    cleaned_html = str(soup)
+    return title, get_converter(ignore_links).handle(cleaned_html), cleaned_html, urls
+
+
+def start_fork_server() -> multiprocessing.context.BaseContext:
+    """
+    Pool processes are forked from a fork server instead of the app worker, whose grpc and
+    pymongo threads would be forked mid-flight. The server is started once per app worker
+    from a clean interpreter, it imports the parsers offline, parsing needs no databases.
+    """
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(PARSE_MODULES)
+    offline = os.environ.get("BACKEND_OFFLINE")
+    os.environ["BACKEND_OFFLINE"] = "1"
+    try:
+        forkserver.ensure_running()
+    finally:
+        if offline is None:
+            del os.environ["BACKEND_OFFLINE"]
+        else:
+            os.environ["BACKEND_OFFLINE"] = offline
+    return context
+
+
+def get_parse_pool() -> ProcessPoolExecutor | None:
+    """
+    Returns the pool of `parse_workers` processes, None if it is disabled with `parse_workers=0`.
+    """
+    global PARSE_POOL
+    workers = int(CONFIG["crawler"]["parse_workers"])
+    if workers == 0:
+        return None
+    if PARSE_POOL is None:
+        PARSE_POOL = ProcessPoolExecutor(max_workers=workers, mp_context=start_fork_server())
+    return PARSE_POOL
+
+
+def reset_parse_pool():
+    # a killed process breaks the whole pool, next parse starts a new one
+    global PARSE_POOL
+    PARSE_POOL = None
+
+
+def shutdown_parse_pool():
+    global PARSE_POOL
+    if PARSE_POOL is not None:
+        PARSE_POOL.shutdown(wait=True, cancel_futures=True)
+        PARSE_POOL = None
+
+
+async def run_parser(function: Callable[..., T], *args) -> T:
+    """
+    Runs a parsing function in the parse pool, or right away if the pool is disabled.
+    """
+    pool = get_parse_pool()
+    if pool is None:
+        return function(*args)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, function, *args)
+    except BrokenProcessPool:
+        reset_parse_pool()
+        raise
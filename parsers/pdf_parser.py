@@ -1,33 +1,85 @@
 import os.path as osp
 import re
+import threading
+from concurrent.futures.process import BrokenProcessPool
+from itertools import accumulate, repeat
 from typing import List, Tuple
 
 import fitz
 
 from parsers.general_parser import GeneralParser
-from utils.tokenize_ import doc_to_chunks
+from parsers.page_parser import get_parse_pool, reset_parse_pool
+from utils import CONFIG
+from utils.tokenize_ import pages_to_chunks
+
+# PyMuPDF is not thread-safe, documents are only opened in one thread of a process at a time
+FITZ_LOCK = threading.Lock()
+
+
+def open_pdf(source: str | bytes | memoryview) -> fitz.Document:
+    return fitz.open(source) if isinstance(source, str) else fitz.open(stream=source, filetype="pdf")
+
+
+def extract_page_range(source: str | bytes, start: int, stop: int) -> List[str]:
+    """
+    Extracts text of pages [start, stop) of a PDF given as a path or as its bytes.
+    Runs in parsing processes, every one of them opens the document on its own.
+    """
+    with FITZ_LOCK, open_pdf(source) as doc:
+        return [doc[i].get_text() for i in range(start, stop)]
 
 
 class PdfParser(GeneralParser):
     def __init__(self, chunk_size: int):
         super().__init__(chunk_size)
         self.ld = None
+        self.pages_per_task = int(CONFIG["uploads"]["pdf_pages_per_task"])
+
+    def extract_pages(self, source: str | bytes | memoryview) -> List[str]:
+        """
+        Returns text of every page of a PDF given as a path or as its bytes. Documents longer
+        than `pdf_pages_per_task` pages are split into page ranges which are extracted
+        in parallel by the parse pool, shorter ones are extracted right away.
+        """
+        with FITZ_LOCK, open_pdf(source) as doc:
+            n_pages = len(doc)
+            pool = get_parse_pool()
+            if pool is None or n_pages <= self.pages_per_task:
+                return [page.get_text() for page in doc]
+        if not isinstance(source, str):
+            # memoryviews can not be pickled, only documents sent to the pool are copied
+            source = bytes(source)
+        # pages are split evenly between workers, but ranges are not shorter than pages_per_task
+        step = max(self.pages_per_task, -(-n_pages // int(CONFIG["crawler"]["parse_workers"])))
+        starts = range(0, n_pages, step)
+        try:
+            ranges = pool.map(
+                extract_page_range, repeat(source), starts, [min(start + step, n_pages) for start in starts]
+            )
+            return [text for pages in ranges for text in pages]
+        except BrokenProcessPool:
+            reset_parse_pool()
+            raise
 
     def process_file(self, path) -> Tuple[List[str], str, dict]:
+        """
+        Returns chunks of a PDF, its text and meta, where `page_spans`
+        are the first and last page of every chunk, numbered from 1.
+        """
         file_name = osp.splitext(osp.split(path)[1])[0]
         meta = {"doc_title": file_name}
-        with fitz.open(path) as doc:
-            content = ""
-            for page in doc:
-                content += page.get_text()
-        content = re.sub(r"\.\.\.\.+", "...", content)
+        pages = [re.sub(r"\.\.\.\.+", "...", page) for page in self.extract_pages(path)]
+        content = "".join(pages)
         meta["security_groups"] = 2**63 - 1
-        chunks = doc_to_chunks(content=content, title=file_name)
+        chunks, meta["page_spans"] = pages_to_chunks(pages)
         return chunks, content, meta
 
-    def stream2text(self, stream: bytes) -> str:
-        with fitz.open(stream=stream, filetype="pdf") as fl:
-            text = ""
-            for page in fl:
-                text += page.get_text()
-        return text
+    def stream2text(self, stream: bytes | memoryview) -> str:
+        return "".join(self.extract_pages(stream))
+
+    def stream2pages(self, stream: bytes | memoryview) -> Tuple[str, List[int]]:
+        """
+        Returns text of a PDF, as stream2text does, and offsets in it where its pages start.
+        """
+        pages = self.extract_pages(stream)
+        return "".join(pages), list(accumulate((len(page) for page in pages[:-1]), initial=0))
@@ -0,0 +1,95 @@
+import hashlib
+import zlib
+from typing import List, Tuple
+from xml.etree import ElementTree
+
+from utils import CONFIG
+
+# limit of the sitemaps protocol, also guards against gzip bombs
+MAX_SITEMAP_SIZE = 50 * 2**20
+SITEMAP_NAMESPACE = "{http://www.sitemaps.org/schemas/sitemap/0.9}"
+GZIP_MAGIC = b"\x1f\x8b"
+# gzip inflates sitemaps by 20-50 times, they are parsed in pieces of this size
+DECOMPRESSED_CHUNK_SIZE = 2**16
+
+
+class SitemapParser:
+    """
+    Incremental parser of a sitemap or a sitemap index. Bytes are fed as they arrive
+    and (url, lastmod) entries come out as soon as their <url> or <sitemap> element is
+    closed, gzip-compressed sitemaps are decompressed on the fly. Parsed elements are
+    dropped right away, so memory does not grow with the size of the sitemap.
+
+        parser = SitemapParser()
+        async for data in response.content.iter_any():
+            entries = parser.feed(data)
+        entries = parser.close()
+    """
+
+    def __init__(self):
+        self.parser = ElementTree.XMLPullParser(events=("start", "end"))
+        self.decompressor = None
+        self.head = b""
+        self.size = 0
+        self.hash = hashlib.sha256()
+        self.root = None
+        self.loc, self.lastmod = None, None
+
+    @property
+    def content_hash(self) -> str:
+        # same as hash_string of the decoded sitemap
+        return self.hash.hexdigest()[: int(CONFIG["misc"]["hash_size"])]
+
+    def feed(self, data: bytes) -> List[Tuple[str, str | None]]:
+        if self.decompressor is None:
+            # gzipped sitemaps are recognized by content, servers often send them as plain
+            # application/octet-stream, and .gz urls are not always gzipped
+            self.head += data
+            if len(self.head) < len(GZIP_MAGIC):
+                return []
+            data, self.head = self.head, b""
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if data.startswith(GZIP_MAGIC) else False
+        if not self.decompressor:
+            return self._parse(data)
+        entries = []
+        while len(data) > 0:
+            entries += self._parse(self.decompressor.decompress(data, DECOMPRESSED_CHUNK_SIZE))
+            data = self.decompressor.unconsumed_tail
+        return entries
+
+    def close(self) -> List[Tuple[str, str | None]]:
+        entries = []
+        if self.decompressor is None:
+            entries = self._parse(self.head)
+        elif self.decompressor:
+            entries = self._parse(self.decompressor.flush())
+        self.parser.close()
+        return entries + self._entries()
+
+    def _parse(self, data: bytes) -> List[Tuple[str, str | None]]:
+        self.size += len(data)
+        if self.size > MAX_SITEMAP_SIZE:
+            raise ValueError(f"Sitemap is larger than {MAX_SITEMAP_SIZE // 2**20}MB")
+        self.hash.update(data)
+        self.parser.feed(data)
+        return self._entries()
+
+    def _entries(self) -> List[Tuple[str, str | None]]:
+        entries = []
+        for event, element in self.parser.read_events():
+            if event == "start":
+                if self.root is None:
+                    self.root = element
+                continue
+            # tags of other namespaces, e.g. <image:loc>, are not entries
+            tag = element.tag[len(SITEMAP_NAMESPACE) :] if element.tag.startswith(SITEMAP_NAMESPACE) else element.tag
+            if tag == "loc":
+                self.loc = (element.text or "").strip()
+            elif tag == "lastmod":
+                self.lastmod = (element.text or "").strip() or None
+            elif tag in ("url", "sitemap"):
+                if self.loc:
+                    entries.append((self.loc, self.lastmod))
+                self.loc, self.lastmod = None, None
+                self.root.clear()
+        return entries
@@ -0,0 +1,98 @@
+import csv
+import io
+import os.path as osp
+from typing import BinaryIO, Iterable, Iterator, List, Tuple
+
+import openpyxl
+
+from parsers.general_parser import GeneralParser
+from utils.errors import FileProcessingError
+from utils.tokenize_ import doc_to_chunks
+
+
+def _cell_text(value) -> str:
+    # a row is one line of the document, so line breaks inside of cells are flattened
+    if value is None:
+        return ""
+    return " ".join(str(value).split())
+
+
+def rows_to_lines(rows: Iterable[tuple], sheet: str = None) -> Iterator[str]:
+    """
+    Renders rows of a table as lines of "column: value" pairs, taking names of the columns from
+    its first non-empty row. Every line carries its header, so however the chunker groups lines,
+    chunks do not lose the context of their rows. Empty cells and rows are skipped.
+    """
+    header = None
+    for row in rows:
+        values = [_cell_text(value) for value in row]
+        if not any(values):
+            continue
+        if header is None:
+            header = [value or f"Column {i + 1}" for i, value in enumerate(values)]
+            continue
+        pairs = [
+            f"{header[i] if i < len(header) else f'Column {i + 1}'}: {value}" for i, value in enumerate(values) if value
+        ]
+        if sheet is not None:
+            pairs.insert(0, f"Sheet: {sheet}")
+        yield " | ".join(pairs)
+
+
+class SpreadsheetParser(GeneralParser):
+    """
+    Reads .xlsx and .csv files row by row, a workbook is opened in read-only mode,
+    which streams rows of its sheets instead of loading them, and a csv is decoded
+    lazily. Rows are returned in groups, so memory does not grow with the number of rows.
+    """
+
+    def xlsx_lines(self, stream: BinaryIO) -> Iterator[str]:
+        workbook = openpyxl.load_workbook(stream, read_only=True, data_only=True)
+        try:
+            # names of sheets are only needed to tell rows of several sheets apart
+            named = len(workbook.worksheets) > 1
+            for sheet in workbook.worksheets:
+                yield from rows_to_lines(sheet.iter_rows(values_only=True), sheet.title if named else None)
+        finally:
+            workbook.close()
+
+    def csv_lines(self, stream: BinaryIO) -> Iterator[str]:
+        text = io.TextIOWrapper(stream, encoding="utf-8-sig", errors="replace", newline="")
+        try:
+            yield from rows_to_lines(csv.reader(text))
+        finally:
+            # the upload stays open for saving to gridfs
+            text.detach()
+
+    def stream2groups(self, stream: BinaryIO, format: str, rows_per_group: int) -> Iterator[str]:
+        """
+        Yields rows of all sheets as texts of `rows_per_group` lines. Raises FileProcessingError if
+        the file is malformed, openpyxl fails on those with errors of zipfile, xml parsers and its own.
+        """
+        lines = self.xlsx_lines(stream) if format == ".xlsx" else self.csv_lines(stream)
+        try:
+            group = []
+            for line in lines:
+                group.append(line)
+                if len(group) == rows_per_group:
+                    yield "\n".join(group)
+                    group = []
+            if len(group) > 0:
+                yield "\n".join(group)
+        except Exception as e:
+            raise FileProcessingError(f"Can not read {format} file: {e.__class__.__name__}: {e}") from e
+
+    def stream2text(self, stream: BinaryIO, format: str) -> str:
+        """
+        Returns rows of all sheets as lines of one text.
+        """
+        return "\n".join(self.stream2groups(stream, format, rows_per_group=1000))
+
+    def process_file(self, path) -> Tuple[List[str], str, dict]:
+        name, format = osp.splitext(osp.split(path)[1])
+        meta = {"doc_title": name}
+        with open(path, "rb") as f:
+            content = self.stream2text(f, format)
+        meta["security_groups"] = 2**63 - 1
+        chunks = doc_to_chunks(content=content, title=name)
+        return chunks, content, meta
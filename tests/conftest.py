@@ -0,0 +1,5 @@
+import os
+import sys
+
+# unit tests import the app modules from the repository root, like the scripts do
+sys.path.insert(1, os.getcwd())
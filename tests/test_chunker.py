@@ -0,0 +1,65 @@
+import pytest
+
+from benchmarks import corpora
+from benchmarks.chunker import legacy_doc_to_chunks
+from utils import CONFIG
+from utils.tokenize_ import doc_to_chunks, docs_to_chunks, pages_to_chunks
+
+CHUNK_SIZES = [64, 256, int(CONFIG["handlers"]["chunk_size"])]
+EDGE_CASES = [
+    "",
+    "\n\n\n",
+    "   \n \t\n",
+    "one line without a newline",
+    "trailing spaces   \n   leading spaces\n",
+    "word " * 2000,
+    ("A long sentence of many words. " * 80 + "\n") * 3,
+    "short\n" + "Very long line without any sentence end " * 100 + "\nshort again\n",
+    "Ünïcödé — текст на русском. 中文句子。 emoji 🙂 here.\n" * 50,
+    "# Title\n\n" + "\n".join(f"{i}. item number {i}." for i in range(300)),
+    "1234567890" * 500,
+    "\n".join(["x" * 300, "", "y" * 5000, "z"] * 5),
+]
+
+
+def texts():
+    for seed in range(4):
+        for size in [300, 3000, 30000]:
+            yield f"markdown-{seed}-{size}", corpora.markdown_text(size, seed)
+            yield f"hugo-{seed}-{size}", corpora.hugo_markdown_text(size, seed)
+            yield f"sentences-{seed}-{size}", " ".join(corpora.gold_sentences(size, seed))
+    yield "pdf", corpora.pdf_text(20000)
+    for i, text in enumerate(EDGE_CASES):
+        yield f"edge-{i}", text
+
+
+TEXTS = dict(texts())
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+@pytest.mark.parametrize("name", list(TEXTS))
+def test_same_chunks_as_legacy(name: str, chunk_size: int):
+    # chunk hashes dedupe re-uploads, so the linear chunker must give exactly the chunks of the previous one
+    assert doc_to_chunks(TEXTS[name], chunk_size=chunk_size) == legacy_doc_to_chunks(TEXTS[name], chunk_size=chunk_size)
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_batch_same_as_single(chunk_size: int):
+    contents = list(TEXTS.values())
+    assert docs_to_chunks(contents, chunk_size=chunk_size) == [
+        doc_to_chunks(content, chunk_size=chunk_size) for content in contents
+    ]
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_page_spans(chunk_size: int):
+    lines = corpora.pdf_text(20000).splitlines(keepends=True)
+    pages = ["".join(lines[i : i + 40]) for i in range(0, len(lines), 40)]
+    chunks, spans = pages_to_chunks(pages, chunk_size=chunk_size)
+    assert chunks == doc_to_chunks("".join(pages), chunk_size=chunk_size)
+    assert len(spans) == len(chunks)
+    assert all(1 <= first <= last <= len(pages) for first, last in spans)
+    assert spans == sorted(spans)
+    for chunk, (_, last) in zip(chunks, spans):
+        # the last line of a chunk is on its last page, overlap lines join sentences of several lines with spaces
+        assert " ".join(chunk.splitlines()[-1].split()) in " ".join(pages[last - 1].split())
@@ -0,0 +1,60 @@
+import pytest
+
+from benchmarks import corpora
+from benchmarks.html_renderer import LegacyGrooveHTMLParser, LegacyVivantioHTMLParser
+from parsers.html_parser import GrooveHTMLParser, VivantioHTMLParser
+
+NESTED_HEADERS = [
+    "<p>a <h1>Head</h1> b</p><p>x</p>",
+    "<div><p>  <h2>H</h2>  tail</p></div>",
+    "<ul><li>one <h1>T</h1></li><li><ol><li>x</li></ol></li><p>para</p></ul>",
+    "<p><span> <h1>A</h1> </span>  x  <em><h2>B</h2></em></p>",
+    "<p><h1>a</h1><h2>b</h2></p>",
+    "<div><div><div><p>deep <h2>D</h2> x</p></div></div></div>",
+    "<h1>A</h1>text<h3>B</h3><p>c</p><h2>D</h2><p></p><blockquote>q <h1>Q</h1></blockquote>",
+    "<li>item <h2>LH</h2></li><strong><h1>S</h1>after</strong>",
+    "<p>" + "long sentence here. " * 200 + "<h1>X</h1>" + "y" * 3000 + "</p>",
+]
+# the previous renderer leaked its %%%%% header sentinels into chunks of these
+LEAKED_HEADERS = {
+    "<p>before<h1></h1>after</p>": ["T\n\nbeforeafter"],
+    "<p><h1>multi<br>line</h1> text</p>": ["T\nmulti\nline\n\n text"],
+    "<p><h1>outer <h2>inner</h2></h1> text</p>": ["T\nouter inner\n\n text"],
+}
+
+
+def groove(body: str) -> dict:
+    return {"title": "T", "tags": [], "related_titles": [], "slug": "s", "id": "1", "body": body}
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("size", [1000, 5000, 20000, 100000])
+@pytest.mark.parametrize(
+    "parsers, make_article",
+    [
+        ((LegacyGrooveHTMLParser, GrooveHTMLParser), corpora.groove_article),
+        ((LegacyVivantioHTMLParser, VivantioHTMLParser), corpora.vivantio_article),
+    ],
+    ids=["groove", "vivantio"],
+)
+def test_same_chunks_as_legacy(parsers, make_article, size: int, seed: int):
+    legacy, iterative = parsers
+    article = make_article(size, seed)
+    assert iterative().process_document(article) == legacy().process_document(article)
+
+
+@pytest.mark.parametrize("body", NESTED_HEADERS)
+def test_nested_headers(body: str):
+    assert GrooveHTMLParser().process_document(groove(body)) == LegacyGrooveHTMLParser().process_document(groove(body))
+
+
+@pytest.mark.parametrize("body", list(LEAKED_HEADERS))
+def test_no_leaked_sentinels(body: str):
+    assert "%%%%%" in LegacyGrooveHTMLParser().process_document(groove(body))[0][0]
+    assert GrooveHTMLParser().process_document(groove(body))[0] == LEAKED_HEADERS[body]
+
+
+def test_deep_nesting():
+    # the previous renderer recursed once per tag and hit the recursion limit on such html
+    body = "<div>" * 3000 + "<p>" + "<span>" * 3000 + "deep" + "</span>" * 3000 + "</p>" + "</div>" * 3000
+    assert GrooveHTMLParser().process_document(groove(body))[0] == ["T\n\ndeep"]
@@ -29,13 +29,41 @@ def get_collection_name(full_collection_name: str) -> str:
     return full_collection_name.split("_", maxsplit=3)[2]
 
 
+# spreadsheets are indexed as documents of groups of their rows, with ids of the file and number of the group
+ROWS_DOC_SEPARATOR = "#rows"
+
+
+def rows_doc_id(doc_id: str, group: int) -> str:
+    return f"{doc_id}{ROWS_DOC_SEPARATOR}{group}"
+
+
+def file_doc_id(doc_id: str) -> str:
+    # id of the uploaded file, which is the id the API knows the document by
+    return doc_id.split(ROWS_DOC_SEPARATOR, maxsplit=1)[0]
+
+
+########################################################
+#                     OFFLINE MODE                     #
+########################################################
+import os
+
+# Lets CPU-only tooling such as benchmarks import parsers
+# without Mongo, Milvus and AWS being reachable
+OFFLINE = os.environ.get("BACKEND_OFFLINE", "0") == "1"
+
+
 ########################################################
 #                       DATABASES                      #
 ########################################################
-from utils.db import DB, GRIDFS
-from utils.milvus_utils import CollectionsManager
+if OFFLINE:
+    DB, GRIDFS, MILVUS_DB = None, None, None
+else:
+    from utils.db import DB, GRIDFS
+    from utils.milvus_tenants import get_layout
+    from utils.milvus_utils import CollectionsManager, SharedCollectionsManager
 
-MILVUS_DB = CollectionsManager()
+    # per_collection keeps a Milvus collection per collection, shared keeps all of them in one
+    MILVUS_DB = SharedCollectionsManager() if get_layout() == "shared" else CollectionsManager()
 
 
 ########################################################
@@ -54,12 +82,14 @@ class ClientSessionWrapper:
 CLIENT_SESSION_WRAPPER = ClientSessionWrapper()
 
 
-import os
 from typing import List
 
 ########################################################
 #                    AWS TRANSLATE                     #
 ########################################################
-from utils.aws import AwsTranslateClient
+if OFFLINE:
+    AWS_TRANSLATE_CLIENT = None
+else:
+    from utils.aws import AwsTranslateClient
 
-AWS_TRANSLATE_CLIENT = AwsTranslateClient()
+    AWS_TRANSLATE_CLIENT = AwsTranslateClient()
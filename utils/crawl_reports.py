@@ -0,0 +1,46 @@
+from datetime import datetime, timezone
+from typing import List
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from loguru import logger
+
+from utils import CONFIG, DB
+from utils.crawler import CrawlStats
+
+if DB is not None:
+    CRAWL_REPORTS = DB[CONFIG["mongo"]["crawl_reports_collection"]]
+    CRAWL_REPORTS.create_index([("collection", 1), ("started_at", -1)])
+
+
+def save_crawl_report(
+    collection: str, links: List[str], stats: List[CrawlStats], status: str, n_docs: int, n_chunks: int
+) -> str | None:
+    # one report per upload of links, with telemetry of the crawl of every link in it. It is saved
+    # after failed crawls as well, so its own errors are only logged, not to hide the error of the crawl
+    try:
+        reports = [link_stats.report() for link_stats in stats]
+        result = CRAWL_REPORTS.insert_one(
+            {
+                "collection": collection,
+                "links": links,
+                "status": status,
+                "started_at": min((report["started_at"] for report in reports), default=datetime.now(timezone.utc)),
+                "finished_at": datetime.now(timezone.utc),
+                "n_docs": n_docs,
+                "n_chunks": n_chunks,
+                "crawls": reports,
+            }
+        )
+    except Exception as e:
+        logger.exception(f"Saving crawl report of {collection} failed: {e.__class__.__name__}: {e}")
+        return None
+    return str(result.inserted_id)
+
+
+def get_crawl_report(collection: str, crawl_id: str) -> dict | None:
+    try:
+        crawl_id = ObjectId(crawl_id)
+    except InvalidId:
+        return None
+    return CRAWL_REPORTS.find_one({"_id": crawl_id, "collection": collection})
@@ -0,0 +1,101 @@
+import asyncio
+from typing import Dict, List
+
+from loguru import logger
+from pymongo import UpdateOne
+
+from utils import CONFIG, DB
+
+if DB is not None:
+    CRAWL_STATE = DB[CONFIG["mongo"]["crawl_state_collection"]]
+    CRAWL_STATE.create_index([("collection", 1), ("url", 1)], unique=True)
+
+# fields of pages kept in memory for the whole crawl, links are read only for pages which are skipped
+VALIDATORS = ["etag", "last_modified", "content_hash", "lastmod"]
+
+
+class CrawlState:
+    """
+    Validators of the pages crawled into a collection: ETag, Last-Modified, hash of the
+    content, sitemap <lastmod> and links found on the page. Re-crawls send conditional
+    requests with them and skip pages which did not change, links of a skipped page are
+    taken from here so the crawl goes on beyond it.
+
+    Updates are kept in memory until `save`, which should be called once the crawled
+    documents are indexed, otherwise a failed upload would leave pages marked as known.
+    Only validators of pages are loaded, links are read from Mongo when a page is skipped.
+    """
+
+    def __init__(self, collection: str):
+        self.collection = collection
+        projection = {"_id": False, "url": True, **{field: True for field in VALIDATORS}}
+        self.pages: Dict[str, dict] = {
+            page.pop("url"): page for page in CRAWL_STATE.find({"collection": collection}, projection)
+        }
+        self.updates: Dict[str, dict] = {}
+        self.sitemap_lastmods: Dict[str, str] = {}
+
+    def conditional_headers(self, url: str) -> dict:
+        page = self.pages.get(url, {})
+        headers = {}
+        if page.get("etag"):
+            headers["If-None-Match"] = page["etag"]
+        if page.get("last_modified"):
+            headers["If-Modified-Since"] = page["last_modified"]
+        return headers
+
+    def unchanged_in_sitemap(self, url: str) -> bool:
+        lastmod = self.sitemap_lastmods.get(url)
+        return lastmod is not None and url in self.pages and self.pages[url].get("lastmod") == lastmod
+
+    def unchanged_content(self, url: str, content_hash: str) -> bool:
+        return url in self.pages and self.pages[url].get("content_hash") == content_hash
+
+    async def skip(self, url: str) -> List[str]:
+        # links of an unchanged page are the same as last time, as well as
+        # <lastmod> of the entries if it is a sitemap
+        page = await asyncio.to_thread(
+            CRAWL_STATE.find_one,
+            {"collection": self.collection, "url": url},
+            {"_id": False, "links": True, "links_lastmods": True},
+        )
+        page = page or {}
+        links = page.get("links") or []
+        for link, lastmod in zip(links, page.get("links_lastmods") or []):
+            if lastmod is not None:
+                self.sitemap_lastmods[link] = lastmod
+        return links
+
+    def update(self, url: str, **fields):
+        # servers do not always repeat validators, e.g. in 304 responses
+        fields = {key: value for key, value in fields.items() if value is not None}
+        if url in self.sitemap_lastmods:
+            fields["lastmod"] = self.sitemap_lastmods[url]
+        self.updates.setdefault(url, {}).update(fields)
+
+    def discard(self, url: str):
+        # a page which was crawled but not indexed, e.g. over the page limit, has to be crawled in full next time
+        self.updates.pop(url, None)
+
+    def save(self):
+        if len(self.updates) == 0:
+            return
+        CRAWL_STATE.bulk_write(
+            [
+                UpdateOne({"collection": self.collection, "url": url}, {"$set": fields}, upsert=True)
+                for url, fields in self.updates.items()
+            ],
+            ordered=False,
+        )
+        logger.info(f"Saved crawl state of {len(self.updates)} pages of {self.collection}")
+        for url, fields in self.updates.items():
+            self.pages.setdefault(url, {}).update({key: fields[key] for key in VALIDATORS if key in fields})
+        self.updates = {}
+
+
+def forget_pages(collection: str, urls: List[str] = None):
+    # pages which are deleted from the collection have to be crawled in full next time
+    query = {"collection": collection}
+    if urls is not None:
+        query["url"] = {"$in": urls}
+    CRAWL_STATE.delete_many(query)
@@ -0,0 +1,374 @@
+import asyncio
+import itertools
+import random
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Dict, List, Mapping, Tuple, TypeVar
+from urllib.parse import urlsplit
+
+from aiohttp import ClientError, ClientResponse, ClientSession, ClientTimeout, TCPConnector
+from loguru import logger
+
+from utils import CONFIG
+from utils.errors import PageParsingError
+from utils.http_cache import HTTP_CACHE, HttpCache
+
+T = TypeVar("T")
+
+USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36"
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def percentiles(values: List[float], quantiles: Tuple[float, ...] = (0.5, 0.9, 0.99)) -> Dict[str, float]:
+    if len(values) == 0:
+        return {}
+    values = sorted(values)
+    result = {f"p{round(q * 100)}": values[min(len(values) - 1, int(q * len(values)))] for q in quantiles}
+    result["max"] = values[-1]
+    return result
+
+
+class CrawlStats:
+    """
+    Telemetry of a crawl. Besides outcomes of requests it tells where the time goes:
+    fetch latency and bytes point at the network, parse time at the CPU and waiting
+    for host limiters at politeness throttling. Redirects and failed urls are counted,
+    but only the first `max_urls` of them are kept, the report has to fit in a Mongo document.
+    """
+
+    def __init__(self, link: str = None, max_urls: int = int(CONFIG["crawler"]["report_max_urls"])):
+        self.link = link
+        self.max_urls = max_urls
+        self.started_at = time.time()
+        self.finished_at = None
+        self.requests = 0
+        self.fetched = 0
+        self.not_modified = 0
+        self.unchanged = 0
+        self.retries = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
+        self.bytes_downloaded = 0
+        self.fetch_latencies = []
+        self.parse_times = []
+        self.throttle_waits = []
+        self.statuses = Counter()
+        self.depths = Counter()
+        self.dropped = Counter()
+        self.n_redirects = 0
+        self.redirects = []
+        self.errors = Counter()
+        self.n_failed = 0
+        self.failed_urls = []
+
+    def redirect(self, url: str, location: str):
+        self.n_redirects += 1
+        if len(self.redirects) < self.max_urls:
+            self.redirects.append({"url": url, "location": location})
+
+    def fail(self, url: str, reason: str):
+        self.errors[reason] += 1
+        self.n_failed += 1
+        if len(self.failed_urls) < self.max_urls:
+            self.failed_urls.append(url)
+
+    def finish(self):
+        self.finished_at = time.time()
+
+    def summary(self) -> str:
+        errors = ", ".join(f"{reason}: {count}" for reason, count in self.errors.most_common())
+        return (
+            f"{self.requests} requests, {self.fetched} fetched, {self.unchanged} unchanged, {self.retries} retries, "
+            f"{self.cache_hits} cache hits, {self.cache_misses} cache misses, {self.cache_evictions} cache evictions, "
+            f"{self.n_failed} failed" + (f" ({errors})" if errors else "")
+        )
+
+    def report(self) -> dict:
+        duration = (self.finished_at or time.time()) - self.started_at
+        return {
+            "link": self.link,
+            "started_at": datetime.fromtimestamp(self.started_at, timezone.utc),
+            "duration_seconds": duration,
+            "pages_per_second": (self.fetched + self.cache_hits) / duration if duration > 0 else 0.0,
+            "bytes_downloaded": self.bytes_downloaded,
+            "requests": self.requests,
+            "fetched": self.fetched,
+            "not_modified": self.not_modified,
+            "unchanged": self.unchanged,
+            "retries": self.retries,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "cache_evictions": self.cache_evictions,
+            "fetch_latency_seconds": percentiles(self.fetch_latencies),
+            "parse_seconds": percentiles(self.parse_times)
+            | ({"mean": sum(self.parse_times) / len(self.parse_times)} if self.parse_times else {}),
+            "throttle_wait_seconds": percentiles(self.throttle_waits),
+            # Mongo keys have to be strings
+            "statuses": {str(code): count for code, count in sorted(self.statuses.items())},
+            "depths": {str(depth): count for depth, count in sorted(self.depths.items())},
+            "dropped": dict(self.dropped),
+            "n_redirects": self.n_redirects,
+            "redirects": self.redirects,
+            "failed": self.n_failed,
+            "errors": dict(self.errors),
+            "failed_urls": self.failed_urls,
+        }
+
+
+class Page:
+    def __init__(self, url: str, content: str | None, headers: Mapping[str, str], not_modified: bool = False):
+        self.url = url
+        self.content = content
+        self.etag = headers.get("ETag")
+        self.last_modified = headers.get("Last-Modified")
+        self.not_modified = not_modified
+
+
+class HostLimiter:
+    """
+    Politeness towards a single host: at most `concurrency` requests in flight
+    and at most `rps` requests started per second. A Retry-After from the host
+    pauses all requests to it, not only the one which got it.
+    """
+
+    def __init__(self, concurrency: int, rps: float):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.interval = 1 / rps if rps > 0 else 0
+        self.next_start = 0
+        self.lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        async with self.lock:
+            now = asyncio.get_running_loop().time()
+            delay = self.next_start - now
+            self.next_start = max(now, self.next_start) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def __aexit__(self, *args):
+        self.semaphore.release()
+
+    def pause(self, seconds: float):
+        self.next_start = max(self.next_start, asyncio.get_running_loop().time() + seconds)
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class Crawler:
+    """
+    Fetches pages through one keep-alive session with a bounded pool of workers,
+    per-host limits and retries. Failed pages are accounted in `stats` instead of
+    silently disappearing.
+
+        async with Crawler() as crawler:
+            await crawler.crawl(seeds, visit, stop)
+    """
+
+    def __init__(
+        self,
+        concurrency: int = int(CONFIG["crawler"]["concurrency"]),
+        per_host_concurrency: int = int(CONFIG["crawler"]["per_host_concurrency"]),
+        per_host_rps: float = float(CONFIG["crawler"]["per_host_rps"]),
+        max_retries: int = int(CONFIG["crawler"]["max_retries"]),
+        max_backoff: float = float(CONFIG["crawler"]["max_backoff"]),
+        timeout: float = float(CONFIG["crawler"]["timeout"]),
+        cache: HttpCache = HTTP_CACHE,
+        stats: CrawlStats = None,
+    ):
+        self.concurrency = concurrency
+        self.per_host_concurrency = per_host_concurrency
+        self.per_host_rps = per_host_rps
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.cache = cache
+        self.hosts: Dict[str, HostLimiter] = {}
+        self.stats = stats if stats is not None else CrawlStats()
+        self.session: ClientSession = None
+        self.enqueue: Callable[[T], None] = None
+
+    async def __aenter__(self) -> "Crawler":
+        connector = TCPConnector(
+            limit=self.concurrency,
+            limit_per_host=self.per_host_concurrency,
+            ttl_dns_cache=int(CONFIG["crawler"]["dns_cache_ttl"]),
+            keepalive_timeout=float(CONFIG["crawler"]["keepalive_timeout"]),
+        )
+        self.session = ClientSession(
+            connector=connector,
+            headers={"User-Agent": USER_AGENT},
+            timeout=ClientTimeout(total=self.timeout),
+        )
+        return self
+
+    async def __aexit__(self, *args):
+        self.stats.finish()
+        await self.session.close()
+
+    def host_limiter(self, url: str) -> HostLimiter:
+        host = urlsplit(url).netloc
+        if host not in self.hosts:
+            self.hosts[host] = HostLimiter(self.per_host_concurrency, self.per_host_rps)
+        return self.hosts[host]
+
+    def backoff(self, attempt: int) -> float:
+        return min(self.max_backoff, 2**attempt + random.uniform(0, 1))
+
+    async def fetch(self, url: str, allow_redirects: bool = True) -> str | None:
+        page = await self.fetch_page(url, allow_redirects=allow_redirects)
+        return page.content if page is not None else None
+
+    async def fetch_page(
+        self,
+        url: str,
+        allow_redirects: bool = True,
+        headers: dict = None,
+        read: Callable[[ClientResponse], Awaitable[str | None]] = None,
+    ) -> Page | None:
+        """
+        Downloads a page, retrying transient failures. Returns None if the page
+        could not be downloaded, and a page without content if `headers` made
+        the request conditional and the server answered 304 Not Modified.
+        `read` consumes the body instead of reading it whole as text, it is
+        called again from scratch if the download is retried.
+        Pages read whole go through the disk cache, if there is one.
+        """
+        use_cache = self.cache is not None and read is None
+        if use_cache:
+            cached = await self.cache.get(url)
+            if cached is not None:
+                self.stats.cache_hits += 1
+                return Page(url, cached.content, cached.headers)
+            self.stats.cache_misses += 1
+
+        limiter = self.host_limiter(url)
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            waiting_since = time.perf_counter()
+            async with limiter:
+                self.stats.throttle_waits.append(time.perf_counter() - waiting_since)
+                self.stats.requests += 1
+                started = time.perf_counter()
+                try:
+                    async with self.session.get(url, allow_redirects=allow_redirects, headers=headers) as response:
+                        self.stats.statuses[response.status] += 1
+                        if len(response.history) > 0:
+                            self.stats.redirect(url, str(response.url))
+                        if response.status == 304:
+                            self.stats.not_modified += 1
+                            return Page(url, None, response.headers, not_modified=True)
+                        if response.status < 400:
+                            page_content = await (read(response) if read is not None else response.text())
+                            self.stats.fetch_latencies.append(time.perf_counter() - started)
+                            self.stats.bytes_downloaded += response.content.total_bytes
+                            self.stats.fetched += 1
+                            if use_cache:
+                                self.stats.cache_evictions += await self.cache.put(
+                                    url,
+                                    page_content,
+                                    response.headers.get("ETag"),
+                                    response.headers.get("Last-Modified"),
+                                )
+                            return Page(url, page_content, response.headers)
+                        reason = f"HTTP {response.status}"
+                        if response.status not in RETRY_STATUSES:
+                            logger.error(f"Error while downloading {url}: {reason}")
+                            self.stats.fail(url, reason)
+                            return None
+                        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                except (ClientError, asyncio.TimeoutError) as e:
+                    reason = e.__class__.__name__
+                except UnicodeDecodeError as e:
+                    logger.error(f"Error while decoding {url}: {e}")
+                    self.stats.fail(url, e.__class__.__name__)
+                    return None
+
+            if attempt == self.max_retries:
+                break
+            delay = min(self.max_backoff, retry_after) if retry_after is not None else self.backoff(attempt)
+            if retry_after is not None:
+                limiter.pause(delay)
+            self.stats.retries += 1
+            logger.warning(f"{reason} on {url}, retrying in {delay:.1f}s ({attempt + 1}/{self.max_retries})")
+            await asyncio.sleep(delay)
+
+        logger.error(f"Error while downloading {url}: {reason} after {self.max_retries + 1} attempts")
+        self.stats.fail(url, reason)
+        return None
+
+    async def crawl(
+        self,
+        seeds: List[T],
+        visit: Callable[[T], Awaitable[List[T]]],
+        stop: Callable[[], bool] = lambda: False,
+        priority: Callable[[T], tuple] = None,
+    ):
+        """
+        Runs `visit` over the seeds and everything they lead to with `concurrency` workers.
+        `visit` returns new items to be visited, once `stop` is true the rest are dropped.
+        Items with lower `priority` are visited first, in order of discovery by default.
+        While the crawl runs, `enqueue` adds items right away, without waiting for `visit` to return.
+        Pages which fail to parse are skipped, any other error of `visit`, e.g. one of storing
+        a page, stops the crawl and is raised once the workers are cancelled.
+        """
+        queue = asyncio.PriorityQueue()
+        counter = itertools.count()
+
+        def put(item: T):
+            # the counter keeps discovery order among equal priorities and items themselves out of comparison
+            queue.put_nowait((priority(item) if priority is not None else (), next(counter), item))
+
+        self.enqueue = put
+        for seed in seeds:
+            put(seed)
+
+        failures = []
+        done = asyncio.Event()
+
+        async def worker():
+            while True:
+                _, _, item = await queue.get()
+                try:
+                    if stop():
+                        self.stats.dropped["max_pages"] += 1
+                    else:
+                        for new_item in await visit(item):
+                            put(new_item)
+                except PageParsingError as e:
+                    # counted in the stats by the parser
+                    logger.error(f"Error while parsing {e.message}")
+                except Exception as e:
+                    logger.error(f"Stopping the crawl, error while visiting {item}: {e.__class__.__name__}: {e}")
+                    failures.append(e)
+                    done.set()
+                finally:
+                    queue.task_done()
+
+        async def join():
+            await queue.join()
+            done.set()
+
+        tasks = [asyncio.create_task(join())] + [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            await done.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        if failures:
+            raise failures[0]
@@ -0,0 +1,57 @@
+import asyncio
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import List
+
+from pymongo.errors import DuplicateKeyError
+
+from utils import CONFIG, DB, file_doc_id
+
+if DB is not None:
+    DOCUMENT_LOCKS = DB[CONFIG["mongo"]["document_locks_collection"]]
+
+POLL_INTERVAL = 0.5
+
+
+def _claim(keys: List[str], owner: str) -> List[str]:
+    # a lock older than `document_lock_timeout` was left by a worker which died holding it and is taken over
+    claimed, now = [], time.time()
+    for key in keys:
+        try:
+            DOCUMENT_LOCKS.update_one(
+                {"_id": key, "since": {"$lt": now - float(CONFIG["uploads"]["document_lock_timeout"])}},
+                {"$set": {"since": now, "owner": owner}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # held by someone else, the upsert could not insert it again
+            break
+        claimed.append(key)
+    return claimed
+
+
+def _release(keys: List[str], owner: str):
+    DOCUMENT_LOCKS.delete_many({"_id": {"$in": keys}, "owner": owner})
+
+
+@asynccontextmanager
+async def document_locks(collection_name: str, doc_ids: List[str]):
+    """
+    Holds locks of documents of a collection across all workers, for writes which read chunks of
+    a document and then replace them: uploads and summary backfills. Milvus can not update rows,
+    two such writes of the same document interleaved would leave chunks of both. Documents are
+    locked in order of their ids, so that writes of overlapping sets of documents do not deadlock.
+    Documents of groups of rows of a spreadsheet are locked with their file.
+    """
+    keys = sorted({f"{collection_name}/{file_doc_id(doc_id)}" for doc_id in doc_ids})
+    owner, held = uuid.uuid4().hex, 0
+    try:
+        while held < len(keys):
+            held += len(await asyncio.to_thread(_claim, keys[held:], owner))
+            if held < len(keys):
+                await asyncio.sleep(POLL_INTERVAL)
+        yield
+    finally:
+        if held > 0:
+            await asyncio.to_thread(_release, keys[:held], owner)
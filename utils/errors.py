@@ -54,3 +54,8 @@ class FileProcessingError(BasicError):
 class TranslationError(BasicError):
     def __init__(self, message: str = "Translation error"):
         self.message = message
+
+
+class PageParsingError(BasicError):
+    def __init__(self, message: str = "Crawled page parsing error"):
+        self.message = message
@@ -0,0 +1,199 @@
+import asyncio
+import hashlib
+import math
+import posixpath
+import re
+import time
+from typing import Dict, List, Set
+from urllib.parse import quote, urlsplit, urlunsplit
+
+from pymongo import UpdateOne
+
+from utils import CONFIG, DB
+
+if DB is not None:
+    FRONTIER = DB[CONFIG["mongo"]["crawl_frontier_collection"]]
+    FRONTIER.create_index([("collection", 1), ("key", 1)], unique=True)
+    FRONTIER.create_index([("collection", 1), ("crawled_at", 1)])
+
+DEFAULT_PORTS = {"http": ":80", "https": ":443"}
+
+
+def normalize_url(url: str, keep_query: bool = True) -> str:
+    """
+    Canonical form of a crawled url: lowercase scheme and host, no default port,
+    no dot segments or repeated slashes, uppercase percent escapes. The query is
+    kept, pages like ?id=1 and ?id=2 are different, and so are hashbang fragments,
+    which address pages of ajax sites such as ClickHelp (articles/#!page). Other
+    fragments only point within a page and are dropped. Links found on pages are
+    normalized without the query and the fragment, as they always were, so that
+    tracking and sorting parameters do not multiply the same page.
+    """
+    url = url.strip().split(" ")[0]
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if scheme in DEFAULT_PORTS and netloc.endswith(DEFAULT_PORTS[scheme]):
+        netloc = netloc[: -len(DEFAULT_PORTS[scheme])]
+
+    path = re.sub(r"/{2,}", "/", parts.path)
+    if path:
+        normalized = posixpath.normpath(path)
+        # normpath drops trailing slash, which is significant for relative links
+        path = normalized + "/" if path.endswith("/") and normalized != "/" else normalized
+    path = quote(path or "/", safe="/%:@!$&'()*+,;=-._~")
+    path = re.sub(r"%[0-9a-f]{2}", lambda m: m.group().upper(), path)
+    if not keep_query:
+        return urlunsplit((scheme, netloc, path, "", ""))
+    fragment = parts.fragment if parts.fragment.startswith("!") else ""
+    return urlunsplit((scheme, netloc, path, parts.query, fragment))
+
+
+def url_key(url: str) -> str:
+    # url with and without a trailing slash is the same page
+    parts = urlsplit(normalize_url(url))
+    canonical = urlunsplit(parts._replace(path=parts.path.rstrip("/")))
+    return hashlib.blake2b(canonical.encode(), digest_size=12).hexdigest()
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.n_hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray(math.ceil(self.size / 8))
+
+    def _positions(self, key: str) -> List[int]:
+        # double hashing, k positions out of two 64-bit hashes
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little")
+        return [(h1 + i * h2) % self.size for i in range(self.n_hashes)]
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class Frontier:
+    """
+    Seen-set of a crawl into a collection. Urls are deduplicated by their normalized form,
+    a Bloom filter in memory answers for urls which certainly were not seen, and only
+    the rest are looked up in the exact store in Mongo. Memory stays at about a byte
+    per url for crawls of any size.
+
+    The store keeps every url ever crawled into the collection with the start of the
+    last crawl which enqueued it and the time its page was last indexed. A url counts
+    as seen if this crawl enqueued it already, or if a page of it was indexed by any
+    crawl since this one started, so overlapping crawls of a site do not fetch the same
+    pages twice. `frontier_recrawl_after` extends the latter to pages indexed that many
+    seconds before, it is 0 so that a re-crawl fetches every page and finds changed ones,
+    unchanged pages are skipped by crawl state. Pages are marked as indexed by `crawled`
+    and only stored by `save`, once they are indexed, like crawl state.
+
+    Mongo is queried in threads, off the event loop, and urls are added one batch at a
+    time, so that concurrent batches do not both take the same url as new.
+    """
+
+    def __init__(
+        self,
+        collection: str,
+        capacity: int = int(CONFIG["crawler"]["frontier_capacity"]),
+        error_rate: float = float(CONFIG["crawler"]["frontier_error_rate"]),
+        recrawl_after: float = float(CONFIG["crawler"]["frontier_recrawl_after"]),
+    ):
+        self.collection = collection
+        self.started = time.time()
+        self.crawled_since = self.started - recrawl_after
+        self.bloom = BloomFilter(capacity, error_rate)
+        self.crawled_keys: List[str] = []
+        self.loaded = False
+        self.lock = asyncio.Lock()
+
+    def load(self):
+        # recently indexed pages of earlier crawls, only their keys are read
+        for hit in FRONTIER.find(
+            {"collection": self.collection, "crawled_at": {"$gte": self.crawled_since}}, {"key": True, "_id": False}
+        ):
+            self.bloom.add(hit["key"])
+        self.loaded = True
+
+    async def add(self, urls: List[str]) -> List[str]:
+        """
+        Marks urls as seen, returns those which were not seen before.
+        """
+        keys: Dict[str, str] = {}
+        for url in urls:
+            keys.setdefault(url_key(url), url)
+
+        async with self.lock:
+            if not self.loaded:
+                await asyncio.to_thread(self.load)
+            maybe_seen = [key for key in keys if key in self.bloom]
+            seen = await asyncio.to_thread(self.find_seen, maybe_seen) if len(maybe_seen) > 0 else set()
+            new_keys = [key for key in keys if key not in seen]
+            if len(new_keys) == 0:
+                return []
+            for key in new_keys:
+                self.bloom.add(key)
+            await asyncio.to_thread(self.store_seen, {key: keys[key] for key in new_keys})
+        return [keys[key] for key in new_keys]
+
+    def find_seen(self, keys: List[str]) -> Set[str]:
+        return {
+            hit["key"]
+            for hit in FRONTIER.find(
+                {
+                    "collection": self.collection,
+                    "key": {"$in": keys},
+                    "$or": [{"seen_at": {"$gte": self.started}}, {"crawled_at": {"$gte": self.crawled_since}}],
+                },
+                {"key": True},
+            )
+        }
+
+    def store_seen(self, urls: Dict[str, str]):
+        FRONTIER.bulk_write(
+            [
+                UpdateOne(
+                    {"collection": self.collection, "key": key},
+                    {"$set": {"url": normalize_url(url), "seen_at": self.started}},
+                    upsert=True,
+                )
+                for key, url in urls.items()
+            ],
+            ordered=False,
+        )
+
+    def crawled(self, url: str):
+        self.crawled_keys.append(url_key(url))
+
+    def save(self):
+        if len(self.crawled_keys) == 0:
+            return
+        now = time.time()
+        FRONTIER.bulk_write(
+            [
+                UpdateOne({"collection": self.collection, "key": key}, {"$set": {"crawled_at": now}})
+                for key in self.crawled_keys
+            ],
+            ordered=False,
+        )
+        self.crawled_keys = []
+
+
+def priority(url: str, depth: int) -> tuple:
+    # breadth first, and within a level shallow paths first, they are usually
+    # section pages linking to the rest, sitemaps go before everything
+    if url.endswith((".xml", ".xml.gz")):
+        return (-1, 0)
+    return (depth, urlsplit(url).path.rstrip("/").count("/"))
+
+
+def forget_urls(collection: str, urls: List[str] = None):
+    # deleted pages are crawled again by the next crawl
+    query = {"collection": collection}
+    if urls is not None:
+        query["key"] = {"$in": [url_key(url) for url in urls]}
+    FRONTIER.delete_many(query)
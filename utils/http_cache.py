@@ -0,0 +1,118 @@
+import asyncio
+import os
+import os.path as osp
+import sqlite3
+import threading
+import time
+import zlib
+
+from loguru import logger
+
+from utils import CONFIG
+
+EVICTION_INTERVAL = 100
+
+
+class CachedResponse:
+    def __init__(self, content: str, etag: str | None, last_modified: str | None):
+        self.content = content
+        self.headers = {key: value for key, value in (("ETag", etag), ("Last-Modified", last_modified)) if value}
+
+
+class HttpCache:
+    """
+    Disk cache of crawled pages in a SQLite file shared by all workers on the machine.
+    Pages are keyed by their full url, as requested, expire after `ttl` seconds and are
+    stored zlib-compressed. Once the stored bodies exceed `max_size_mb`, least recently
+    used pages are evicted. Repeated crawls of a site within `ttl` do not download it
+    again, and neither see changes made to it meanwhile, so the cache is meant for tuning
+    parsers against a site and is off unless `cache_ttl` is set.
+
+    SQLite calls block, they run in a thread off the event loop, one at a time per worker.
+    """
+
+    def __init__(self, path: str, ttl: float, max_size_mb: float):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = int(max_size_mb * 2**20)
+        self.puts = 0
+        self.connection: sqlite3.Connection = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        # connections do not survive a fork, every worker process opens its own
+        if self.connection is None or self.pid != os.getpid():
+            os.makedirs(osp.dirname(osp.abspath(self.path)), exist_ok=True)
+            self.connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, stored_at REAL, accessed_at REAL, "
+                "size INTEGER, etag TEXT, last_modified TEXT, body BLOB)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+            self.pid = os.getpid()
+        return self.connection
+
+    async def get(self, url: str) -> CachedResponse | None:
+        return await asyncio.to_thread(self._get, url)
+
+    async def put(self, url: str, content: str, etag: str | None, last_modified: str | None) -> int:
+        # returns the number of pages evicted to make room, hits and misses are counted by the crawler
+        return await asyncio.to_thread(self._put, url, content, etag, last_modified)
+
+    def _get(self, url: str) -> CachedResponse | None:
+        with self.lock:
+            connection, now = self.connect(), time.time()
+            row = connection.execute(
+                "SELECT etag, last_modified, body FROM responses WHERE key = ? AND stored_at > ?",
+                (url, now - self.ttl),
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, url))
+        etag, last_modified, body = row
+        return CachedResponse(zlib.decompress(body).decode(), etag, last_modified)
+
+    def _put(self, url: str, content: str, etag: str | None, last_modified: str | None) -> int:
+        body = zlib.compress(content.encode())
+        with self.lock:
+            connection, now = self.connect(), time.time()
+            connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, now, now, len(body), etag, last_modified, body),
+            )
+            # summing sizes scans the table, so the cap is checked every EVICTION_INTERVAL pages
+            self.puts += 1
+            if self.puts % EVICTION_INTERVAL == 0:
+                return self.evict()
+            return 0
+
+    def evict(self) -> int:
+        connection = self.connect()
+        connection.execute("DELETE FROM responses WHERE stored_at <= ?", (time.time() - self.ttl,))
+        size = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if size <= self.max_size:
+            return 0
+        # evicting down to 90% of the cap, so that every following put does not evict again
+        excess = size - int(self.max_size * 0.9)
+        keys = []
+        for key, entry_size in connection.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+            keys.append(key)
+            excess -= entry_size
+            if excess <= 0:
+                break
+        connection.executemany("DELETE FROM responses WHERE key = ?", [(key,) for key in keys])
+        logger.info(f"Evicted {len(keys)} pages from the crawl cache, it was {size / 2**20:.1f}MB")
+        return len(keys)
+
+
+HTTP_CACHE = (
+    HttpCache(
+        CONFIG["crawler"]["cache_path"],
+        ttl=float(CONFIG["crawler"]["cache_ttl"]),
+        max_size_mb=float(CONFIG["crawler"]["cache_max_size_mb"]),
+    )
+    if float(CONFIG["crawler"]["cache_ttl"]) > 0
+    else None
+)
@@ -0,0 +1,124 @@
+import re
+import time
+from typing import Dict, List, Tuple
+
+from pymongo import ReturnDocument
+
+from utils import CONFIG, DB
+
+if DB is not None:
+    MILVUS_TENANTS = DB[CONFIG["mongo"]["milvus_tenants_collection"]]
+
+# the same names Milvus accepts for collections, they are quoted in filter expressions of the shared layout
+TENANT_NAME = re.compile(r"[A-Za-z_][A-Za-z0-9_]{0,254}")
+# records of the registry which are not collections, their ids are not valid collection names
+PKS_ID = "#pks"
+MIGRATION_ID = "#migration"
+# primary keys of the shared layout start above auto ids of Milvus, a millisecond timestamp shifted
+# by 18 bits, so they never meet keys of rows copied from the per-collection layout
+FIRST_PK = 2**62
+# the migration record as last read by the worker, cached for `migration_cache_ttl` seconds
+MIGRATION_CACHE: Dict[str, Tuple[float, dict | None]] = {}
+
+
+def register_tenant(name: str, canned: bool, migrated: bool = False):
+    """
+    Records a collection of the shared layout. Rows of collections copied by the
+    migration tool are counted by it, a new collection starts with none.
+    """
+    MILVUS_TENANTS.update_one(
+        {"_id": name},
+        {"$setOnInsert": {"canned": canned, "n_entities": 0, "migrated": migrated}},
+        upsert=True,
+    )
+
+
+def get_tenant(name: str) -> dict | None:
+    return MILVUS_TENANTS.find_one({"_id": name})
+
+
+def list_tenants(prefix: str) -> List[dict]:
+    return list(MILVUS_TENANTS.find({"_id": {"$regex": f"^{re.escape(prefix)}"}}).sort("_id", 1))
+
+
+def count_entities(name: str, delta: int):
+    MILVUS_TENANTS.update_one({"_id": name}, {"$inc": {"n_entities": delta}})
+
+
+def set_entities(name: str, n_entities: int, **fields):
+    MILVUS_TENANTS.update_one({"_id": name}, {"$set": {"n_entities": n_entities, **fields}})
+
+
+def forget_tenant(name: str):
+    MILVUS_TENANTS.delete_one({"_id": name})
+
+
+def allocate_pks(n: int) -> List[int]:
+    counter = MILVUS_TENANTS.find_one_and_update(
+        {"_id": PKS_ID}, {"$inc": {"n_allocated": n}}, upsert=True, return_document=ReturnDocument.AFTER
+    )
+    end = FIRST_PK + counter["n_allocated"]
+    return list(range(end - n, end))
+
+
+def update_tenant(name: str, **fields):
+    MILVUS_TENANTS.update_one({"_id": name}, {"$set": fields})
+
+
+def touch_tenant(name: str):
+    # collections written to while they are being copied are caught up by the switch
+    update_tenant(name, touched=time.time())
+
+
+def start_migration() -> dict:
+    """
+    Records that collections are being moved to the shared layout, see CollectionsManager.check_writable.
+    Workers of the per-collection layout record writes to collections once their cache of it expires.
+    """
+    return MILVUS_TENANTS.find_one_and_update(
+        {"_id": MIGRATION_ID},
+        {"$setOnInsert": {"started": time.time()}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def end_migration():
+    # an abandoned migration, a switched one is kept
+    MILVUS_TENANTS.delete_one({"_id": MIGRATION_ID, "switched": {"$exists": False}})
+
+
+def freeze_writes():
+    # workers of the per-collection layout refuse writes from then on
+    MILVUS_TENANTS.update_one({"_id": MIGRATION_ID}, {"$set": {"frozen": time.time()}}, upsert=True)
+
+
+def unfreeze_writes():
+    MILVUS_TENANTS.update_one({"_id": MIGRATION_ID, "switched": {"$exists": False}}, {"$unset": {"frozen": ""}})
+
+
+def get_migration() -> dict | None:
+    return MILVUS_TENANTS.find_one({"_id": MIGRATION_ID})
+
+
+def cached_migration() -> dict | None:
+    # checked before every write, the migration tool waits out the cache before it relies on workers seeing changes
+    cached = MIGRATION_CACHE.get(MIGRATION_ID)
+    if cached is None or time.monotonic() - cached[0] > float(CONFIG["milvus"]["migration_cache_ttl"]):
+        cached = MIGRATION_CACHE[MIGRATION_ID] = (time.monotonic(), get_migration())
+    return cached[1]
+
+
+def mark_switched():
+    MILVUS_TENANTS.update_one({"_id": MIGRATION_ID}, {"$set": {"switched": time.time()}})
+
+
+def get_layout() -> str:
+    """
+    Layout of Milvus collections: shared once utils/scripts/migrate_to_shared.py switched layouts,
+    so that every worker uses it from its next start, else the one of `layout` in config.ini.
+    """
+    migration = get_migration()
+    if migration is not None and "switched" in migration:
+        return "shared"
+    return CONFIG["milvus"]["layout"]
@@ -7,9 +7,34 @@ from fastapi import HTTPException, status
 from loguru import logger
 from pymilvus import Collection, CollectionSchema, DataType, FieldSchema, MilvusException, connections, utility
 
-from utils import CONFIG, full_collection_name, get_collection_name
+from utils import CONFIG, file_doc_id, full_collection_name, get_collection_name
 from utils.errors import DatabaseError
+from utils.milvus_tenants import (
+    TENANT_NAME,
+    allocate_pks,
+    cached_migration,
+    count_entities,
+    forget_tenant,
+    get_tenant,
+    list_tenants,
+    register_tenant,
+    touch_tenant,
+)
 from utils.schemas import MilvusSchema
+from utils.vector_index import (
+    choose_index,
+    claim_rebuild,
+    delete_index,
+    get_index,
+    get_search_params,
+    is_rebuilding,
+    mark_rebuild_due,
+    needs_rebuild,
+    refresh_search_params,
+    release_rebuild,
+    save_index,
+    wait_for_rebuild,
+)
 
 manager = Manager()
 lock = manager.Lock()
@@ -66,16 +91,65 @@ class CollectionsManager:
             raise DatabaseError(f"Colletion {collection_name} not found!")
 
         m_collection = Collection(collection_name)
-        if collection_state == "NotLoad":
+        # a collection is released while its index is rebuilt, loading it would make the rebuild fail
+        if collection_state == "NotLoad" and not is_rebuilding(get_index(collection_name)):
             m_collection.load()
         return m_collection
 
     def delete_collection(self, collection_name: str):
+        self.check_writable(collection_name)
         utility.drop_collection(collection_name, timeout=10)
+        delete_index(collection_name)
+
+    def check_writable(self, collection_name: str):
+        """
+        Called right before every write to a collection. While utils/scripts/migrate_to_shared.py
+        copies collections to the shared layout, records that the collection was written to, so
+        that the switch catches it up. Raises 503 once the switch froze writes to the per-collection
+        layout, rows written after it caught up would be missing from the shared layout. The switch
+        waits for writes which passed the check to land. The migration record is cached for
+        `migration_cache_ttl` seconds, so writes cost no extra round trip unless a migration runs.
+        """
+        migration = cached_migration()
+        if migration is None:
+            return
+        if "frozen" in migration:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Collections are being moved to another storage layout, try again in a few minutes",
+            )
+        touch_tenant(collection_name)
 
     def collection_status(self, collection_name: str):
         return utility.load_state(collection_name)._name_
 
+    def index_name(self, collection: Collection) -> str:
+        # name of the Milvus collection whose index the collection is searched with
+        return collection.name
+
+    def search_params(self, collection: Collection, top_k: int) -> dict:
+        return get_search_params(self.index_name(collection), top_k)
+
+    def search(self, collection: Collection, vec: np.ndarray, top_k: int, limit: int, **kwargs):
+        """
+        Searches embeddings of a collection with search params of its index. Workers cache them, so
+        a search right after the index was rebuilt by another process fails, and is retried once
+        with the params of the new index. A search while the index is rebuilt waits for it, up to
+        `index_rebuild_wait` seconds.
+        """
+        try:
+            return collection.search([vec], "emb_v1", self.search_params(collection, top_k), limit=limit, **kwargs)
+        except MilvusException:
+            name = self.index_name(collection)
+            if wait_for_rebuild(name, float(CONFIG["milvus"]["index_rebuild_wait"])):
+                logger.info(f"Waited for the index of {collection.name} to be rebuilt, searching it again")
+                refresh_search_params(name)
+            elif not refresh_search_params(name):
+                raise
+            else:
+                logger.info(f"Index of {collection.name} was rebuilt, searching it with its new params")
+            return collection.search([vec], "emb_v1", self.search_params(collection, top_k), limit=limit, **kwargs)
+
     def __getitem__(self, name: str) -> Collection:
         return self.get_collection(name)
 
@@ -91,19 +165,9 @@ class CollectionsManager:
         if len(search_collections) == 0:
             return None
 
-        search_params = {
-            "metric_type": "IP",
-            "params": {"nprobe": 10},
-        }
         for collection in search_collections:
-            results = collection.search(
-                [vec],
-                f"emb_v1",
-                # f"emb_{api_version}",
-                search_params,
-                offset=0,
-                limit=1,
-                output_fields=["pk", "question", "answer"],
+            results = self.search(
+                collection, vec, top_k=1, limit=1, offset=0, output_fields=["pk", "question", "answer"]
             )[0]
             # returning first hit found
             if results.distances[0] >= float(CONFIG["milvus"]["canned_answer_similarity_threshold"]):
@@ -142,36 +206,33 @@ class CollectionsManager:
                     detail=msg,
                 )
 
-        search_params = {
-            "metric_type": "IP",
-            "params": {"nprobe": 10},
-        }
         all_chunks = []
         all_similarities = []
         all_titles = []
         all_ids = []
         all_summaries = []
         all_collections = []
+        limit = int(CONFIG["misc"]["collections_search_limit"])
         for i in range(1 + int(CONFIG["misc"]["collections_search_retries"])):
             for collection in search_collections:
-                results = collection.search(
-                    [vec],
-                    f"emb_v1",
-                    # f"emb_{api_version}",
-                    search_params,
-                    offset=i * int(CONFIG["misc"]["collections_search_limit"]),
-                    limit=int(CONFIG["misc"]["collections_search_limit"]),
+                results = self.search(
+                    collection,
+                    vec,
+                    top_k=(i + 1) * limit,
+                    limit=limit,
+                    offset=i * limit,
                     output_fields=["chunk", "doc_title", "doc_id", "doc_summary", "security_groups"],
                 )[0]
                 for dist, hit in zip(results.distances, results):
                     if (
-                        hit.entity.get("doc_id") != document_id_to_exclude
+                        file_doc_id(hit.entity.get("doc_id")) != document_id_to_exclude
                         or document_collection != collection.name.split("_")[-1]
                     ) and (hit.entity.get("security_groups") & security_code):
                         all_similarities.append(dist)
                         all_chunks.append(hit.entity.get("chunk"))
                         all_titles.append(hit.entity.get("doc_title"))
-                        all_ids.append(hit.entity.get("doc_id"))
+                        # sources are the uploaded files, not groups of rows of spreadsheets
+                        all_ids.append(file_doc_id(hit.entity.get("doc_id")))
                         all_summaries.append(hit.entity.get("doc_summary"))
                         all_collections.append(collection.name)
             if len(all_chunks) >= n_top:
@@ -187,7 +248,7 @@ class CollectionsManager:
             np.array(all_collections)[top_hits].tolist(),
         )  # todo
 
-    def __get_collection_w_schema(self, collection_name: str, schema: MilvusSchema):
+    def _get_collection_w_schema(self, collection_name: str, schema: MilvusSchema, tenant_key: bool = False):
         if schema == MilvusSchema.V0:
             fields = [
                 FieldSchema(name="pk", dtype=DataType.INT64, is_primary=True, auto_id=True),
@@ -206,7 +267,7 @@ class CollectionsManager:
                 FieldSchema(name="timestamp", dtype=DataType.INT64),
                 FieldSchema(name="security_groups", dtype=DataType.INT64),
             ]
-        elif schema == MilvusSchema.V1:
+        elif schema in [MilvusSchema.V1, MilvusSchema.V2]:
             fields = [
                 FieldSchema(name="pk", dtype=DataType.INT64, is_primary=True, auto_id=True),
                 FieldSchema(
@@ -225,6 +286,10 @@ class CollectionsManager:
                 FieldSchema(name="security_groups", dtype=DataType.INT64),
                 FieldSchema(name="url", dtype=DataType.VARCHAR, max_length=1024),
             ]
+            if schema == MilvusSchema.V2:
+                # first and last page of chunks of documents with pages, 0 for other documents
+                fields.append(FieldSchema(name="page_start", dtype=DataType.INT64))
+                fields.append(FieldSchema(name="page_end", dtype=DataType.INT64))
         elif schema == MilvusSchema.CANNED_V0:
             fields = [
                 FieldSchema(name="pk", dtype=DataType.INT64, is_primary=True, auto_id=True),
@@ -234,15 +299,19 @@ class CollectionsManager:
                 FieldSchema(name="timestamp", dtype=DataType.INT64),
                 FieldSchema(name="security_groups", dtype=DataType.INT64),
             ]
+        if tenant_key:
+            # collections of the shared layout keep rows of every collection of every organization,
+            # told apart by the partition key, it goes last so inserted columns only get one more.
+            # Their primary keys are given on insert, rows moved from the per-collection layout keep theirs
+            fields[0] = FieldSchema(name="pk", dtype=DataType.INT64, is_primary=True, auto_id=False)
+            fields.append(FieldSchema(name="tenant", dtype=DataType.VARCHAR, max_length=1024, is_partition_key=True))
         collection_schema = CollectionSchema(fields, enable_dynamic_field=True)
         m_collection = Collection(collection_name, collection_schema)
-        index_params = {
-            "metric_type": "IP",
-            "index_type": "IVF_FLAT",
-            "params": {"nlist": 1024},
-        }
+        # a new collection is empty, its index is rebuilt by update_index as it grows
+        index_params, search_params = choose_index(0)
         m_collection.create_index(field_name="emb_v1", index_params=index_params)
-        if schema == MilvusSchema.V0.value or schema == MilvusSchema.V1.value:
+        save_index(collection_name, index_params, search_params, n_entities=0)
+        if schema in [MilvusSchema.V0, MilvusSchema.V1, MilvusSchema.V2]:
             m_collection.create_index(
                 field_name="doc_id",
                 index_name="scalar_index",
@@ -251,9 +320,194 @@ class CollectionsManager:
         m_collection.load()
         return m_collection
 
-    def get_or_create_collection(self, collection_name: str, schema: MilvusSchema = MilvusSchema.V1) -> Collection:
+    def check_index(self, collection: Collection) -> bool:
+        """
+        Marks the index of embeddings of a collection to be rebuilt if its size calls for another one,
+        see `choose_index`, without rebuilding it. Entities are counted without a flush, rows of growing
+        segments are counted once Milvus seals them. Returns True if the index was marked.
+        """
+        n_entities = collection.num_entities
+        index = get_index(collection.name)
+        if "rebuild_due" in index or not needs_rebuild(index["index_params"], n_entities):
+            return False
+        if not mark_rebuild_due(collection.name, n_entities):
+            return False
+        logger.warning(
+            f"{index['index_params']['index_type']} index of {collection.name} with {n_entities} entities "
+            f"is due to be rebuilt as {choose_index(n_entities)[0]['index_type']}, run utils/scripts/rebuild_indexes.py --due"
+        )
+        return True
+
+    def update_index(self, collection: Collection) -> bool:
+        """
+        Rebuilds the index of embeddings of a collection if its size calls for another one, see
+        `choose_index`. Run in the background after uploads, one worker rebuilds it at a time. The
+        collection is released while the index is rebuilt, its searches wait for it meanwhile, see
+        `search`. Returns True if the index was rebuilt.
+        """
+        index = get_index(collection.name)
+        # flushing seals growing segments of the collection, so it is only done for a collection
+        # which is due to be rebuilt by its count without them
+        if "rebuild_due" not in index and not needs_rebuild(index["index_params"], collection.num_entities):
+            return False
+        collection.flush()
+        n_entities = collection.num_entities
+        if not needs_rebuild(index["index_params"], n_entities) or not claim_rebuild(collection.name):
+            return False
+        index_params, search_params = choose_index(n_entities)
+        logger.info(
+            f"Rebuilding {index['index_params']['index_type']} index of {collection.name} "
+            f"with {n_entities} entities as {index_params['index_type']} {index_params['params']}"
+        )
+        try:
+            index_name = next(field.index_name for field in collection.indexes if field.field_name == "emb_v1")
+            collection.release()
+            collection.drop_index(index_name=index_name)
+            collection.create_index(field_name="emb_v1", index_params=index_params, index_name=index_name)
+            utility.wait_for_index_building_complete(collection.name, index_name=index_name)
+        except BaseException:
+            release_rebuild(collection.name)
+            raise
+        finally:
+            collection.load()
+        save_index(collection.name, index_params, search_params, n_entities)
+        return True
+
+    def get_or_create_collection(self, collection_name: str, schema: MilvusSchema = MilvusSchema.V2) -> Collection:
         with lock:
             collection_state = utility.load_state(collection_name)._name_
             if collection_state == "NotExist":
-                return self.__get_collection_w_schema(collection_name, schema)
+                self.check_writable(collection_name)
+                return self._get_collection_w_schema(collection_name, schema)
             return self[collection_name]
+
+
+class TenantCollection:
+    """
+    A collection of the shared layout: rows of a shared Milvus collection with its name in the
+    `tenant` partition key. Has the part of the Collection API used by handlers, queries,
+    searches and deletes only see its rows and inserted rows get its name and primary keys from
+    the tenants registry. The number of its rows is kept there as well, Milvus can not count
+    rows of a partition key.
+    """
+
+    def __init__(self, collection: Collection, name: str):
+        self.collection = collection
+        self.name = name
+
+    def _expr(self, expr: str | None) -> str:
+        tenant = f'tenant == "{self.name}"'
+        return tenant if not expr else f"{tenant} && ({expr})"
+
+    def query(self, expr: str, **kwargs) -> List[dict]:
+        return self.collection.query(self._expr(expr), **kwargs)
+
+    def search(self, data, anns_field: str, param: dict, limit: int, expr: str = None, **kwargs):
+        return self.collection.search(data, anns_field, param, limit, self._expr(expr), **kwargs)
+
+    def insert(self, data: List[list], pks: List[int] = None, **kwargs):
+        n_rows = len(data[0]) if len(data) > 0 else 0
+        if pks is None:
+            pks = allocate_pks(n_rows)
+        result = self.collection.insert([pks] + data + [[self.name] * n_rows], **kwargs)
+        count_entities(self.name, n_rows)
+        return result
+
+    def pks(self, expr: str = None) -> List[int]:
+        return [hit["pk"] for hit in self.query(expr, output_fields=["pk"], consistency_level="Strong")]
+
+    def delete(self, expr: str, **kwargs):
+        # Milvus deletes by primary keys only, so keys of other collections are filtered out first
+        pks = self.pks(expr)
+        if len(pks) == 0:
+            return None
+        result = self.collection.delete(f"pk in [{','.join(map(str, pks))}]", **kwargs)
+        count_entities(self.name, -len(pks))
+        return result
+
+    def flush(self):
+        self.collection.flush()
+
+    @property
+    def schema(self) -> CollectionSchema:
+        return self.collection.schema
+
+    @property
+    def num_entities(self) -> int:
+        tenant = get_tenant(self.name)
+        return tenant["n_entities"] if tenant is not None else 0
+
+    def load(self):
+        # the shared collection stays loaded
+        pass
+
+    def release(self):
+        pass
+
+
+class SharedCollectionsManager(CollectionsManager):
+    """
+    Keeps all collections in two shared Milvus collections, one for chunks and one for canned
+    answers, with names of collections in the partition key, instead of a Milvus collection per
+    collection. Which collections exist is kept in the tenants registry in Mongo. Collections are
+    created and looked up by the same names as in the per-collection layout.
+    """
+
+    def __init__(self):
+        self.shared_collections: Dict[str, Collection] = {}
+
+    def shared_collection(self, canned: bool) -> Collection:
+        name = CONFIG["milvus"]["shared_canned_collection" if canned else "shared_collection"]
+        if name not in self.shared_collections:
+            with lock:
+                if utility.load_state(name)._name_ == "NotExist":
+                    schema = MilvusSchema.CANNED_V0 if canned else MilvusSchema.V2
+                    self.shared_collections[name] = self._get_collection_w_schema(name, schema, tenant_key=True)
+                else:
+                    self.shared_collections[name] = super().get_collection(name)
+        return self.shared_collections[name]
+
+    def get_collections(self, vendor: str, organization: str) -> List[Dict[str, int]]:
+        return [
+            {"name": get_collection_name(tenant["_id"]), "n_chunks": tenant["n_entities"]}
+            for tenant in list_tenants(full_collection_name(vendor, organization, ""))
+            if not tenant["canned"]
+        ]
+
+    def get_collection(self, collection_name: str) -> TenantCollection:
+        tenant = get_tenant(collection_name)
+        if tenant is None:
+            raise DatabaseError(f"Colletion {collection_name} not found!")
+        return TenantCollection(self.shared_collection(tenant["canned"]), collection_name)
+
+    def delete_collection(self, collection_name: str):
+        collection = self.get_collection(collection_name)
+        pks = collection.pks()
+        for i in range(0, len(pks), 10000):
+            collection.collection.delete(f"pk in [{','.join(map(str, pks[i : i + 10000]))}]")
+        forget_tenant(collection_name)
+
+    def collection_status(self, collection_name: str):
+        return "NotExist" if get_tenant(collection_name) is None else "Loaded"
+
+    def check_writable(self, collection_name: str):
+        # the migration only concerns the per-collection layout
+        pass
+
+    def index_name(self, collection: TenantCollection) -> str:
+        return collection.collection.name
+
+    def update_index(self, collection: TenantCollection) -> bool:
+        # the index is the one of the shared collection, rebuilding it makes searches of all collections
+        # wait, so it is only marked to be rebuilt by utils/scripts/rebuild_indexes.py --shared
+        self.check_index(collection.collection)
+        return False
+
+    def get_or_create_collection(
+        self, collection_name: str, schema: MilvusSchema = MilvusSchema.V2
+    ) -> TenantCollection:
+        if TENANT_NAME.fullmatch(collection_name) is None:
+            raise DatabaseError(f"Invalid collection name {collection_name}")
+        canned = schema == MilvusSchema.CANNED_V0
+        register_tenant(collection_name, canned=canned)
+        return TenantCollection(self.shared_collection(canned), collection_name)
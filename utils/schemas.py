@@ -1,6 +1,6 @@
 from datetime import datetime
 from enum import Enum
-from typing import List
+from typing import Any, Dict, List
 
 from fastapi import status
 from pydantic import BaseModel, Field
@@ -68,6 +68,12 @@ class Chat(BaseModel):
 
 class Doc(BaseModel):
     content: str = Field(description="Content of the document", example="")
+    page_starts: List[int] | None = Field(
+        default=None,
+        description="Offsets in the content where pages of the document start, chunks of documents with them "
+        "keep their first and last page",
+        example=[0, 1830, 3721],
+    )
 
 
 class GetCollectionsResponse(BaseModel):
@@ -260,6 +266,27 @@ class UploadDocumentResponse(BaseModel):
 
 class CollectionDocumentsResponse(BaseModel):
     n_chunks: str = Field(description="Number of chunks successfully uploaded / deleted", example="5")
+    crawl_id: str | None = Field(
+        None,
+        description="ID of the crawl report for uploaded links. "
+        "Get it via `GET /{api_version}/collections/{collection}/crawls/{crawl_id}`",
+        example="64b7f0c2e4b0a1d2c3e4f5a6",
+    )
+
+
+class GetCrawlReportResponse(BaseModel):
+    id: str = Field(description="ID of the crawl report", example="64b7f0c2e4b0a1d2c3e4f5a6")
+    links: List[str] = Field(description="Links which were crawled", example=["https://docs.askguru.ai/"])
+    status: str = Field(description="`completed` or `failed`", example="completed")
+    started_at: datetime
+    finished_at: datetime
+    n_docs: int = Field(description="Number of indexed documents", example=120)
+    n_chunks: int = Field(description="Number of indexed chunks", example=950)
+    crawls: List[Dict[str, Any]] = Field(
+        description="Telemetry of the crawl of every link: pages per second, bytes downloaded, percentiles of "
+        "fetch latency, parse time and waits for per-host limits, status codes, depths, dropped links, "
+        "counts of redirects and errors with the first of the redirected and failed urls"
+    )
 
 
 class LikeStatus(str, Enum):
@@ -409,4 +436,5 @@ class CannedAnswersCollection(BaseModel):
 class MilvusSchema(str, Enum):
     V0 = "SCHEMA_V0"
     V1 = "SCHEMA_V1"  # schema with link field
+    V2 = "SCHEMA_V2"  # schema with first and last page of chunks
     CANNED_V0 = "CANNED_V0"
@@ -0,0 +1,274 @@
+"""
+Moves collections from the per-collection Milvus layout to the shared one while the backend keeps
+serving from the per-collection layout.
+
+    python utils/scripts/migrate_to_shared.py copy [--prefix vendor_org_]
+    python utils/scripts/migrate_to_shared.py verify [--prefix ...] [--sample 100]
+    python utils/scripts/migrate_to_shared.py switch [--drain 60]
+    python utils/scripts/migrate_to_shared.py drop-sources --yes
+    python utils/scripts/migrate_to_shared.py abort
+
+Rows keep their primary keys, so ids of canned answers and chunks do not change. `copy` can be
+repeated while the backend serves, every run copies rows added to a source since the previous one
+and deletes copied rows and collections which were deleted from the sources since. From the first
+run on, workers record which collections they write to in the tenants registry. `verify` compares
+keys and columns of all rows of every collection, and embeddings of a sample of them.
+
+`switch` needs every collection verified since it was last copied. It freezes writes: workers of
+the per-collection layout answer them with 503 once their cache of the migration record expires,
+after `migration_cache_ttl` seconds. It waits `--drain` seconds for writes which were already let
+through, then only catches up collections written to since they were copied and checks that they
+have as many rows as their sources, so writes are frozen for about as long as those take. It
+records the switch in the tenants registry, workers use the shared layout from their next start,
+whatever `layout` their config.ini has. Until a worker is restarted it
+serves reads from the frozen sources, which hold the same rows as the shared layout at the switch.
+If a collection does not match, writes are unfrozen and nothing is switched. Once switched `copy`
+refuses to run, it would bring back rows deleted in the shared layout, and `drop-sources` drops
+the per-collection collections. `abort` stops workers recording writes of a migration which is
+given up before the switch.
+"""
+import os
+import random
+import sys
+import time
+from argparse import ArgumentParser
+from typing import List, Tuple
+
+sys.path.insert(1, os.getcwd())
+
+import numpy as np
+from loguru import logger
+from pymilvus import Collection, utility
+from tqdm import tqdm
+
+from utils import CONFIG
+from utils.milvus_tenants import (
+    TENANT_NAME,
+    end_migration,
+    freeze_writes,
+    get_migration,
+    get_tenant,
+    list_tenants,
+    mark_switched,
+    register_tenant,
+    set_entities,
+    start_migration,
+    unfreeze_writes,
+    update_tenant,
+)
+from utils.milvus_utils import SharedCollectionsManager, TenantCollection
+
+# columns which collections of earlier schemas lack
+DEFAULTS = {"url": "", "page_start": 0, "page_end": 0}
+
+
+def source_collections(prefix: str) -> List[str]:
+    shared_names = {CONFIG["milvus"]["shared_collection"], CONFIG["milvus"]["shared_canned_collection"]}
+    return sorted(
+        name
+        for name in utility.list_collections()
+        if name.startswith(prefix) and name not in shared_names and TENANT_NAME.fullmatch(name) is not None
+    )
+
+
+def is_canned(name: str) -> bool:
+    return name.endswith(CONFIG["milvus"]["canned_answer_table_name_suffix"])
+
+
+def source_pks(source: Collection) -> List[int]:
+    return sorted(hit["pk"] for hit in source.query(expr="pk >= 0", output_fields=["pk"], consistency_level="Strong"))
+
+
+def batches(pks: List[int], batch_size: int):
+    for i in range(0, len(pks), batch_size):
+        yield f"pk in [{','.join(map(str, pks[i : i + batch_size]))}]"
+
+
+def query_rows(collection: Collection | TenantCollection, expr: str, fields: List[str]) -> dict:
+    return {row["pk"]: row for row in collection.query(expr, output_fields=fields, consistency_level="Strong")}
+
+
+def copy_collection(manager: SharedCollectionsManager, name: str, batch_size: int) -> Tuple[int, int]:
+    """
+    Makes rows of a collection in the shared layout those of its source: copies rows the shared
+    layout lacks and deletes rows which are no longer in the source. Returns numbers of both.
+    """
+    started = time.time()
+    register_tenant(name, canned=is_canned(name), migrated=True)
+    source = Collection(name)
+    source.load()
+    source_fields = {field.name for field in source.schema.fields}
+
+    target = manager.get_collection(name)
+    # inserted columns are those of the shared collection, but the primary key and the tenant
+    fields = [field.name for field in target.schema.fields if not field.is_primary and field.name != "tenant"]
+    pks = source_pks(source)
+    copied = set(target.pks())
+    # e.g. outdated chunks of documents uploaded again since the previous run
+    deleted = sorted(copied.difference(pks))
+    for expr in batches(deleted, batch_size):
+        target.delete(expr)
+    added = [pk for pk in pks if pk not in copied]
+    for expr in batches(added, batch_size):
+        rows = list(query_rows(source, expr, [field for field in fields if field in source_fields]).values())
+        columns = [[row.get(field, DEFAULTS.get(field)) for row in rows] for field in fields]
+        target.insert(columns, pks=[row["pk"] for row in rows])
+    update_tenant(name, copied=started)
+    return len(added), len(deleted)
+
+
+def verify_collection(manager: SharedCollectionsManager, name: str, batch_size: int, sample: int) -> bool:
+    started = time.time()
+    if get_tenant(name) is None:
+        logger.error(f"{name}: not copied")
+        return False
+    source = Collection(name)
+    source.load()
+    target = manager.get_collection(name)
+    pks, copied = source_pks(source), sorted(target.pks())
+    # the registry count is what the shared layout reports for the collection
+    set_entities(name, len(copied))
+    if pks != copied:
+        missing, extra = set(pks).difference(copied), set(copied).difference(pks)
+        logger.error(f"{name}: {len(missing)} rows of the source are missing, {len(extra)} deleted rows are not")
+        return False
+
+    source_fields = {field.name for field in source.schema.fields}
+    fields = [field.name for field in target.schema.fields if field.name in source_fields and field.name != "emb_v1"]
+    for expr in batches(pks, batch_size):
+        source_rows, target_rows = query_rows(source, expr, fields), query_rows(target, expr, fields)
+        if source_rows != target_rows:
+            pk = next(pk for pk in source_rows if source_rows[pk] != target_rows.get(pk))
+            differ = [field for field in fields if source_rows[pk].get(field) != target_rows.get(pk, {}).get(field)]
+            logger.error(f"{name}: row {pk} differs from the source in {', '.join(differ)}")
+            return False
+    # embeddings are most of the data, only a sample of them is compared
+    sampled = random.sample(pks, min(sample, len(pks)))
+    for expr in batches(sampled, batch_size):
+        source_rows, target_rows = query_rows(source, expr, ["emb_v1"]), query_rows(target, expr, ["emb_v1"])
+        for pk, row in source_rows.items():
+            if pk not in target_rows or not np.allclose(row["emb_v1"], target_rows[pk]["emb_v1"]):
+                logger.error(f"{name}: embedding of row {pk} differs")
+                return False
+    update_tenant(name, verified=started)
+    return True
+
+
+def count_collection(manager: SharedCollectionsManager, name: str) -> bool:
+    # rows of a collection caught up by the switch, a cheap check instead of comparing them all
+    source = Collection(name)
+    source.load()
+    n_rows, n_copied = len(source_pks(source)), len(manager.get_collection(name).pks())
+    set_entities(name, n_copied)
+    if n_rows != n_copied:
+        logger.error(f"{name}: {n_copied} rows were copied, the source has {n_rows}")
+        return False
+    return True
+
+
+def is_verified(tenant: dict | None) -> bool:
+    return tenant is not None and "copied" in tenant and tenant.get("verified", 0) >= tenant["copied"]
+
+
+def is_touched(tenant: dict | None, drain: int) -> bool:
+    # writes checked before the copy of a collection started may have landed during it, within `drain`
+    return tenant is None or "copied" not in tenant or tenant.get("touched", 0) >= tenant["copied"] - drain
+
+
+def delete_gone(manager: SharedCollectionsManager, prefix: str, names: List[str]):
+    for tenant in list_tenants(prefix):
+        # collections deleted from the per-collection layout since they were copied
+        if tenant.get("migrated") and tenant["_id"] not in names:
+            manager.delete_collection(tenant["_id"])
+            logger.info(f"Deleted {tenant['_id']}, it is no longer in the per-collection layout")
+
+
+def copy_all(manager: SharedCollectionsManager, names: List[str], batch_size: int):
+    n_added, n_deleted = 0, 0
+    for name in tqdm(names):
+        added, deleted = copy_collection(manager, name, batch_size)
+        n_added, n_deleted = n_added + added, n_deleted + deleted
+    manager.shared_collection(canned=False).flush()
+    manager.shared_collection(canned=True).flush()
+    logger.info(f"Copied {n_added} rows and deleted {n_deleted} rows of {len(names)} collections")
+
+
+def verify_all(manager: SharedCollectionsManager, names: List[str], batch_size: int, sample: int) -> bool:
+    verified = [name for name in tqdm(names) if verify_collection(manager, name, batch_size, sample)]
+    logger.info(f"{len(verified)} of {len(names)} collections match")
+    return len(verified) == len(names)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("command", choices=["copy", "verify", "switch", "drop-sources", "abort"])
+    parser.add_argument("--prefix", type=str, default="", help="Only collections whose names start with it")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--sample", type=int, default=100, help="Rows of every collection to compare embeddings of")
+    parser.add_argument(
+        "--drain", type=int, default=60, help="Seconds to wait for writes let through before the freeze"
+    )
+    parser.add_argument("--yes", action="store_true", help="Confirms dropping of the per-collection collections")
+    args = parser.parse_args()
+
+    manager = SharedCollectionsManager()
+    migration = get_migration()
+    switched = migration is not None and "switched" in migration
+    if args.command == "switch" and args.prefix:
+        logger.error("Switching moves every collection, it does not take --prefix")
+        sys.exit(1)
+    if args.command == "switch" and args.drain <= float(CONFIG["milvus"]["migration_cache_ttl"]):
+        logger.error("--drain has to be longer than migration_cache_ttl, workers see the freeze that late")
+        sys.exit(1)
+    if args.command in ["copy", "switch"] and switched:
+        logger.error("Layouts were switched already, copying would bring back rows deleted in the shared layout")
+        sys.exit(1)
+    if args.command == "abort" and switched:
+        logger.error("Layouts were switched already, there is no migration to abort")
+        sys.exit(1)
+    if args.command == "drop-sources" and not switched:
+        logger.error("Sources are dropped after switch only")
+        sys.exit(1)
+    names = source_collections(args.prefix)
+
+    if args.command == "copy":
+        # before any collection is copied, workers record writes to it
+        started = start_migration()["started"]
+        time.sleep(max(0.0, started + float(CONFIG["milvus"]["migration_cache_ttl"]) - time.time()))
+        delete_gone(manager, args.prefix, names)
+        copy_all(manager, names, args.batch_size)
+    elif args.command == "verify":
+        if not verify_all(manager, names, args.batch_size, args.sample):
+            sys.exit(1)
+    elif args.command == "switch":
+        tenants = {tenant["_id"]: tenant for tenant in list_tenants("")}
+        unverified = [name for name in names if not is_verified(tenants.get(name))]
+        if len(unverified) > 0:
+            logger.error(f"Not switching, {len(unverified)} collections were not verified since copied, run verify")
+            sys.exit(1)
+        freeze_writes()
+        logger.info(f"Froze writes to the per-collection layout, waiting {args.drain}s for writes let through")
+        time.sleep(args.drain)
+        # collections created before the freeze are in the list now
+        names = source_collections(args.prefix)
+        tenants = {tenant["_id"]: tenant for tenant in list_tenants("")}
+        touched = [name for name in names if is_touched(tenants.get(name), args.drain)]
+        logger.info(f"Catching up {len(touched)} collections written to since they were copied")
+        delete_gone(manager, args.prefix, names)
+        copy_all(manager, touched, args.batch_size)
+        if not all([count_collection(manager, name) for name in touched]):
+            unfreeze_writes()
+            logger.error("Not switching, some collections do not match, writes are unfrozen")
+            sys.exit(1)
+        mark_switched()
+        logger.info("Switched to the shared layout, restart workers, until then they refuse writes")
+    elif args.command == "drop-sources":
+        if not args.yes:
+            logger.error("Dropping needs --yes")
+            sys.exit(1)
+        for name in names:
+            utility.drop_collection(name)
+            logger.info(f"Dropped {name}")
+    elif args.command == "abort":
+        end_migration()
+        logger.info("Workers no longer record writes to collections, copies in the shared layout are kept")
@@ -0,0 +1,53 @@
+"""
+Applies the size-based index policy to existing collections, e.g. to the ones created with
+IVF_FLAT of 1024 lists before indexes were chosen by size. The backend rebuilds indexes of
+collections which grew after uploads to them, but the shared collections of the shared layout
+hold all collections and are only marked as due, they are rebuilt here with --shared. Searches
+of a collection wait while its index is rebuilt, run it when they can.
+
+    python utils/scripts/rebuild_indexes.py --prefix askgurupublic_ --dry-run
+    python utils/scripts/rebuild_indexes.py --due
+    python utils/scripts/rebuild_indexes.py --due --shared
+"""
+import os
+import sys
+from argparse import ArgumentParser
+
+sys.path.insert(1, os.getcwd())
+
+from loguru import logger
+from pymilvus import Collection, utility
+
+from utils import CONFIG
+from utils.milvus_utils import CollectionsManager
+from utils.vector_index import choose_index, get_index, list_due_rebuilds, needs_rebuild
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--prefix", type=str, default="", help="Only collections whose names start with it")
+    parser.add_argument("--due", action="store_true", help="Only collections marked as due to be rebuilt")
+    parser.add_argument("--shared", action="store_true", help="Rebuild the shared collections as well")
+    parser.add_argument("--dry-run", action="store_true", help="Only print which indexes would be rebuilt")
+    args = parser.parse_args()
+
+    shared_names = {CONFIG["milvus"]["shared_collection"], CONFIG["milvus"]["shared_canned_collection"]}
+    names = list_due_rebuilds() if args.due else utility.list_collections()
+    for collection_name in sorted(names):
+        if not collection_name.startswith(args.prefix):
+            continue
+        if collection_name in shared_names and not args.shared:
+            logger.info(f"{collection_name}: skipped, searches of all collections fail while it is rebuilt")
+            continue
+        # Milvus collections, in the shared layout as well, indexes are kept per Milvus collection
+        collection = Collection(collection_name)
+        if args.dry_run:
+            collection.flush()
+            n_entities = collection.num_entities
+            current = get_index(collection_name)["index_params"]
+            if needs_rebuild(current, n_entities):
+                target, _ = choose_index(n_entities)
+                logger.info(f"{collection_name}: {n_entities} entities, {current} -> {target}")
+            continue
+        # rebuilds Milvus collections directly, in the shared layout MILVUS_DB would only mark them
+        if CollectionsManager().update_index(collection):
+            logger.info(f"{collection_name}: index rebuilt")
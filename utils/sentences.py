@@ -0,0 +1,124 @@
+import re
+from typing import Callable, Dict, List
+
+import nltk
+
+from utils import CONFIG
+
+# words which end with a period but rarely end a sentence, lowercased and without the last period
+ABBREVIATIONS = {
+    "approx",
+    "apr",
+    "aug",
+    "ca",
+    "cf",
+    "co",
+    "corp",
+    "dec",
+    "dept",
+    "dr",
+    "e.g",
+    "eg",
+    "est",
+    "etc",
+    "feb",
+    "fig",
+    "i.e",
+    "ie",
+    "inc",
+    "jan",
+    "jr",
+    "jul",
+    "jun",
+    "ltd",
+    "mar",
+    "max",
+    "min",
+    "mr",
+    "mrs",
+    "ms",
+    "no",
+    "nov",
+    "oct",
+    "p",
+    "pp",
+    "prof",
+    "sep",
+    "sept",
+    "sr",
+    "st",
+    "vol",
+    "vs",
+}
+# terminal punctuation with closing quotes and brackets, followed by whitespace and more text
+SENTENCE_END = re.compile(r"[.!?…]+[\"'”’)\]]*(?=\s+(?P<next>\S))")
+# initials and dotted acronyms, J. or U.S. or e.g.
+INITIALS = re.compile(r"(?:[^\W\d_]\.)*[^\W\d_]")
+OPENING_PUNCTUATION = "\"'“‘(["
+
+
+def _ends_sentence(text: str, match: re.Match) -> bool:
+    start = match.start()
+    if match.group().rstrip("\"'”’)]").strip(".") != "":
+        # ! and ? always end a sentence
+        return True
+    if match.group("next").islower():
+        return False
+    # only the last few characters are looked at, so this is constant per candidate
+    token = text[max(0, start - 32) : start].rsplit(None, 1)
+    if len(token) == 0:
+        return True
+    token = token[-1].lstrip(OPENING_PUNCTUATION).lower()
+    return token not in ABBREVIATIONS and INITIALS.fullmatch(token) is None
+
+
+def regex_split(text: str) -> List[str]:
+    """
+    Splits text into sentences at terminal punctuation followed by whitespace. A period does not
+    end a sentence after a known abbreviation or an initial, nor before a lowercase letter.
+    Sentences are stripped of surrounding whitespace, like those of Punkt.
+    """
+    sentences, start = [], 0
+    for match in SENTENCE_END.finditer(text):
+        if _ends_sentence(text, match):
+            sentence = text[start : match.end()].strip()
+            if sentence != "":
+                sentences.append(sentence)
+            start = match.end()
+    sentence = text[start:].strip()
+    if sentence != "":
+        sentences.append(sentence)
+    return sentences
+
+
+PUNKT_LOADED = False
+# nltk 3.8.2 and later load the Punkt model from punkt_tab
+PUNKT_RESOURCE = "punkt_tab" if hasattr(nltk.tokenize.punkt, "PunktTokenizer") else "punkt"
+
+
+def punkt_split(text: str) -> List[str]:
+    """
+    Splits text into sentences with the Punkt model of nltk, which is
+    downloaded if missing on first use and then reused by nltk.
+    """
+    global PUNKT_LOADED
+    if not PUNKT_LOADED:
+        try:
+            nltk.data.find(f"tokenizers/{PUNKT_RESOURCE}")
+        except LookupError:
+            nltk.download(PUNKT_RESOURCE)
+        PUNKT_LOADED = True
+    return nltk.tokenize.sent_tokenize(text)
+
+
+SENTENCE_SPLITTERS: Dict[str, Callable[[str], List[str]]] = {"regex": regex_split, "punkt": punkt_split}
+
+
+def get_sentence_splitter(name: str = CONFIG["handlers"]["sentence_splitter"]) -> Callable[[str], List[str]]:
+    if name not in SENTENCE_SPLITTERS:
+        raise ValueError(f"Unknown sentence splitter {name}, available: {', '.join(SENTENCE_SPLITTERS)}")
+    return SENTENCE_SPLITTERS[name]
+
+
+def split_sentences(text: str) -> List[str]:
+    return get_sentence_splitter()(text)
@@ -0,0 +1,65 @@
+import asyncio
+from typing import List
+
+from loguru import logger
+
+from utils import AWS_TRANSLATE_CLIENT, CONFIG, DB, hash_string, ml_requests
+
+# shared by all requests of a worker, so concurrent uploads do not multiply the load on coreml
+SUMMARIZATION_SEMAPHORE = asyncio.Semaphore(int(CONFIG["coreml"]["summarization_concurrency"]))
+
+if DB is not None:
+    SUMMARIES = DB[CONFIG["mongo"]["summaries_collection"]]
+    SUMMARIES.create_index([("content_hash", 1), ("summary_length", 1), ("api_version", 1)], unique=True)
+
+
+async def summarize(content: str, source_language: str | None, key: tuple) -> str:
+    content_hash, summary_length, api_version = key
+    async with SUMMARIZATION_SEMAPHORE:
+        summary = await ml_requests.get_summary(info=content, max_tokens=summary_length, api_version=api_version)
+        if source_language is not None and source_language != "en":
+            # boto3 is blocking, so translating in a thread to keep other summaries going
+            translation = await asyncio.to_thread(
+                AWS_TRANSLATE_CLIENT.translate_text, text=summary, source_language=source_language, target_language="en"
+            )
+            summary = translation["translation"]
+    # caching right away, so summaries done before a failure are not lost
+    SUMMARIES.update_one(
+        {"content_hash": content_hash, "summary_length": summary_length, "api_version": api_version},
+        {"$set": {"summary": summary}},
+        upsert=True,
+    )
+    return summary
+
+
+async def get_summaries(
+    contents: List[str], source_languages: List[str | None], summary_lengths: List[int], api_version: str
+) -> List[str]:
+    """
+    Summarizes documents concurrently, at most `summarization_concurrency` coreml calls at a time per worker.
+    Summaries are cached by (content hash, summary length, api version), so an unchanged
+    document which is uploaded again gets its summary without calling coreml.
+    """
+    if len(contents) == 0:
+        return []
+    keys = [
+        (hash_string(content), summary_length, api_version)
+        for content, summary_length in zip(contents, summary_lengths)
+    ]
+    cached = {
+        (hit["content_hash"], hit["summary_length"], hit["api_version"]): hit["summary"]
+        for hit in SUMMARIES.find({"content_hash": {"$in": list({key[0] for key in keys})}, "api_version": api_version})
+    }
+
+    # identical documents in one request are summarized once
+    missing = {}
+    for key, content, source_language in zip(keys, contents, source_languages):
+        if key not in cached and key not in missing:
+            missing[key] = (content, source_language)
+    if len(missing) > 0:
+        logger.info(f"Summarizing {len(missing)} of {len(keys)} documents, the rest are cached or repeated")
+        summaries = await asyncio.gather(
+            *[summarize(content, source_language, key) for key, (content, source_language) in missing.items()]
+        )
+        cached.update(zip(missing, summaries))
+    return [cached[key] for key in keys]
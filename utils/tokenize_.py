@@ -1,12 +1,16 @@
+from bisect import bisect_right
 from collections import deque
-from typing import List
+from itertools import accumulate
+from typing import List, Tuple
 
-import nltk
+import regex
 import tiktoken
 
-from utils import CONFIG
+from utils import CONFIG, OFFLINE
+from utils.sentences import split_sentences
 
 TOKEIZERS = {}
+PRETOKENIZERS = {}
 
 
 def get_tokenizer(tokenizer_name: str):
@@ -15,53 +19,309 @@ def get_tokenizer(tokenizer_name: str):
     return TOKEIZERS[tokenizer_name]
 
 
-def doc_to_chunks(
-    content: str,
-    title: str = "",
-    summary: str = "",
-    tokenizer_name: str = CONFIG["handlers"]["tokenizer_name"],
-    chunk_size: int = int(CONFIG["handlers"]["chunk_size"]),
-    overlapping_lines: int = 5,
-    splitter="\n",
+def get_pretokenizer(tokenizer_name: str) -> regex.Pattern:
+    if tokenizer_name not in PRETOKENIZERS:
+        PRETOKENIZERS[tokenizer_name] = regex.compile(get_tokenizer(tokenizer_name)._pat_str)
+    return PRETOKENIZERS[tokenizer_name]
+
+
+class TokenCounter:
+    """
+    Keeps the token count of a growing string without re-encoding it.
+
+    BPE never merges across pretoken boundaries, so the string is kept as a counted
+    stable prefix plus a short tail starting at its last non-whitespace pretoken.
+    That boundary can not move whatever is appended, hence
+    len(encode(text + suffix)) == stable + len(encode(tail + suffix)).
+    """
+
+    def __init__(self, encoder: tiktoken.Encoding, pretokenizer: regex.Pattern):
+        self.encoder = encoder
+        self.pretokenizer = pretokenizer
+        self.stable = 0
+        self.tail = ""
+
+    def reset(self, text: str):
+        self.stable = 0
+        self.tail = ""
+        self.append(text)
+
+    def count_with(self, suffix: str) -> int:
+        return self.stable + len(self.encoder.encode(self.tail + suffix))
+
+    def append(self, suffix: str, total: int = None):
+        text = self.tail + suffix
+        # walking back over trailing whitespace to the last non-whitespace pretoken
+        boundary = len(text)
+        for piece in reversed(self.pretokenizer.findall(text)):
+            boundary -= len(piece)
+            if not piece.isspace():
+                break
+        if boundary == 0:
+            self.tail = text
+            return
+        if total is None:
+            total = self.stable + len(self.encoder.encode(text))
+        self.tail = text[boundary:]
+        self.stable = total - len(self.encoder.encode(self.tail))
+
+
+def _flush_overlap(olap: deque, pending: deque):
+    # sentences are only needed for the overlap, so short lines are
+    # split lazily, and only the last few of them, when a chunk is cut
+    collected = []
+    while pending and len(collected) < olap.maxlen:
+        collected[:0] = split_sentences(pending.pop())[-olap.maxlen :]
+    pending.clear()
+    olap.extend(collected)
+
+
+def _lines_to_chunks(
+    lines: List[str],
+    line_lengths: List[int],
+    counter: TokenCounter,
+    chunk_size: int,
+    overlapping_lines: int,
+    spans: List[Tuple[int, int]] = None,
 ) -> List[str]:
     chunks = []
-    encoder = get_tokenizer(tokenizer_name)
     olap = deque([], overlapping_lines)
-
-    current_content, part = "", 0
+    pending = deque()
     maxlen = int(CONFIG["milvus"]["chunk_max_symbols"])
+
+    parts, has_content = [], False
+    counter.reset("")
+    # first and last line of the current chunk, the overlap is not counted in
+    index, first, last = 0, None, None
+
+    def cut(start: str):
+        nonlocal parts, has_content, first, last
+        chunks.append("".join(parts).strip()[:maxlen])
+        if spans is not None:
+            spans.append((first, last))
+        parts = [start]
+        has_content = start.strip() != ""
+        first, last = index, index
+        counter.reset(start)
+
+    def add(text: str, total: int = None):
+        nonlocal has_content, first, last
+        parts.append(text)
+        if text.strip() != "":
+            has_content = True
+            first = index if first is None else first
+            last = index
+        counter.append(text, total)
+
     # TODO: split by lines which are bolded (in case of cars)
     # because they are the titles of the sections
-    for line in content.split(splitter):
-        if len(encoder.encode(current_content + line + "\n")) > chunk_size and current_content.strip() != "":
-            chunks.append(current_content.strip()[:maxlen])
-            current_content = f"{' '.join(olap)}\n"
-            part += 1
+    for index, (line, line_length) in enumerate(zip(lines, line_lengths)):
+        total = counter.count_with(line + "\n")
+        if total > chunk_size and has_content:
+            _flush_overlap(olap, pending)
+            cut(f"{' '.join(olap)}\n")
+            total = None
 
-        if len(encoder.encode(line)) > chunk_size:
+        if line_length > chunk_size:
             # splitting paragraph into sentences
-            sentences = nltk.tokenize.sent_tokenize(line)
+            _flush_overlap(olap, pending)
+            sentences = split_sentences(line)
             for sent in sentences:
-                if len(encoder.encode(current_content + f" {sent}")) > chunk_size and current_content.strip() != "":
-                    chunks.append(current_content.strip()[:maxlen])
-                    current_content = f"{'. '.join(olap)}\n{sent}"
+                sent_total = counter.count_with(f" {sent}")
+                if sent_total > chunk_size and has_content:
+                    cut(f"{'. '.join(olap)}\n{sent}")
                 else:
-                    current_content += f" {sent}"
+                    add(f" {sent}", sent_total)
                 olap.append(sent)
 
             # should reapply the paragraph split
-            current_content += "\n"
+            add("\n")
 
         else:
-            current_content += line + "\n"
-            # now need to append a few last sentences to our deque
-            sentences = nltk.tokenize.sent_tokenize(line)
-            olap.extend(sentences[-overlapping_lines:])
+            add(line + "\n", total)
+            # a few last sentences of this line will refill the overlap deque
+            pending.append(line)
 
-    if current_content.strip() != "":
-        chunks.append(current_content.strip()[:maxlen])
+    if has_content:
+        chunks.append("".join(parts).strip()[:maxlen])
+        if spans is not None:
+            spans.append((first, last))
     return chunks
 
 
-# preload config tokenizer
-TOKEIZERS[CONFIG["handlers"]["tokenizer_name"]] = get_tokenizer(CONFIG["handlers"]["tokenizer_name"])
+def docs_to_chunks(
+    contents: List[str],
+    tokenizer_name: str = CONFIG["handlers"]["tokenizer_name"],
+    chunk_size: int = int(CONFIG["handlers"]["chunk_size"]),
+    overlapping_lines: int = 5,
+    splitter="\n",
+    line_spans: List[List[Tuple[int, int]]] = None,
+) -> List[List[str]]:
+    """
+    Splits each document into overlapping chunks of at most `chunk_size` tokens.
+    Every line is tokenized once, long lines of all documents in one parallel batch.
+    If `line_spans` is given, indices of the first and last line of every chunk
+    are added to it, one list per document.
+    """
+    encoder = get_tokenizer(tokenizer_name)
+    counter = TokenCounter(encoder, get_pretokenizer(tokenizer_name))
+
+    docs_lines = [content.split(splitter) for content in contents]
+    all_lines = [line for lines in docs_lines for line in lines]
+    # a line can not have more tokens than utf-8 bytes, so only
+    # lines longer than a chunk have to be counted precisely
+    all_lengths = [0] * len(all_lines)
+    long_ids = [i for i, line in enumerate(all_lines) if len(line.encode()) > chunk_size]
+    for i, tokens in zip(long_ids, encoder.encode_batch([all_lines[i] for i in long_ids])):
+        all_lengths[i] = len(tokens)
+
+    chunks, offset = [], 0
+    for lines in docs_lines:
+        line_lengths = all_lengths[offset : offset + len(lines)]
+        offset += len(lines)
+        spans = None
+        if line_spans is not None:
+            spans = []
+            line_spans.append(spans)
+        chunks.append(_lines_to_chunks(lines, line_lengths, counter, chunk_size, overlapping_lines, spans))
+    return chunks
+
+
+def doc_to_chunks(
+    content: str,
+    title: str = "",
+    summary: str = "",
+    tokenizer_name: str = CONFIG["handlers"]["tokenizer_name"],
+    chunk_size: int = int(CONFIG["handlers"]["chunk_size"]),
+    overlapping_lines: int = 5,
+    splitter="\n",
+) -> List[str]:
+    return docs_to_chunks(
+        [content],
+        tokenizer_name=tokenizer_name,
+        chunk_size=chunk_size,
+        overlapping_lines=overlapping_lines,
+        splitter=splitter,
+    )[0]
+
+
+def spans_to_pages(
+    content: str, page_starts: List[int], line_spans: List[Tuple[int, int]], splitter: str = "\n"
+) -> List[Tuple[int, int]]:
+    """
+    Maps the first and last line of every chunk of `content`, as found by docs_to_chunks, to
+    the first and last page, numbered from 1. `page_starts` are offsets in `content` where pages start.
+    """
+    # a page of every line is the one its first character is on
+    line_pages, offset = [], 0
+    for line in content.split(splitter):
+        line_pages.append(bisect_right(page_starts, offset))
+        offset += len(line) + len(splitter)
+    return [(line_pages[first], line_pages[last]) for first, last in line_spans]
+
+
+def pages_to_chunks(
+    pages: List[str],
+    tokenizer_name: str = CONFIG["handlers"]["tokenizer_name"],
+    chunk_size: int = int(CONFIG["handlers"]["chunk_size"]),
+    overlapping_lines: int = 5,
+) -> Tuple[List[str], List[Tuple[int, int]]]:
+    """
+    Chunks a document given as a list of pages, e.g. a PDF, the same way as
+    doc_to_chunks chunks the joined pages. Returns the chunks and the first
+    and last page of each of them, pages are numbered from 1.
+    """
+    line_spans = []
+    content = "".join(pages)
+    chunks = docs_to_chunks(
+        [content],
+        tokenizer_name=tokenizer_name,
+        chunk_size=chunk_size,
+        overlapping_lines=overlapping_lines,
+        line_spans=line_spans,
+    )[0]
+    page_starts = list(accumulate((len(page) for page in pages[:-1]), initial=0))
+    return chunks, spans_to_pages(content, page_starts, line_spans[0])
+
+
+def _split_long_message(message: str, encoder: tiktoken.Encoding, chunk_size: int) -> Tuple[List[str], List[int]]:
+    # sentences of a message longer than a chunk are merged back into parts
+    # shorter than a chunk, sentences longer than a chunk are cut by tokens
+    parts, lengths = [], []
+    for sentence in split_sentences(message):
+        tokens = encoder.encode(sentence)
+        for start in range(0, len(tokens), chunk_size):
+            piece = tokens[start : start + chunk_size]
+            text = sentence if len(piece) == len(tokens) else encoder.decode(piece)
+            if len(parts) > 0 and lengths[-1] + 1 + len(piece) <= chunk_size:
+                parts[-1] += f" {text}"
+                lengths[-1] += 1 + len(piece)
+            else:
+                parts.append(text)
+                lengths.append(len(piece))
+    return parts, lengths
+
+
+def chats_to_chunks(
+    chats_lines: List[List[str]],
+    tokenizer_name: str = CONFIG["handlers"]["tokenizer_name"],
+    chunk_size: int = int(CONFIG["handlers"]["chunk_size"]),
+    overlapping_messages: int = 10,
+) -> List[List[str]]:
+    """
+    Splits chats, given as a line per message, into windows of whole messages of at most
+    `chunk_size` tokens. A window starts with up to `overlapping_messages` last messages of
+    the previous one, as long as they take at most half of a chunk. Messages of all chats are
+    tokenized once in a parallel batch, windows are found with running sums of their lengths,
+    so chunking is linear in the number of messages. Messages longer than a chunk are split
+    into parts at sentence boundaries.
+    """
+    encoder = get_tokenizer(tokenizer_name)
+    maxlen = int(CONFIG["milvus"]["chunk_max_symbols"])
+    all_lines = [line for lines in chats_lines for line in lines]
+    # every message is followed by a newline in a chunk, which is counted as one more token
+    all_lengths = iter([len(tokens) + 1 for tokens in encoder.encode_batch(all_lines)])
+
+    chats_chunks = []
+    for lines in chats_lines:
+        messages, lengths = [], []
+        for line, length in zip(lines, all_lengths):
+            if length > chunk_size:
+                parts, parts_lengths = _split_long_message(line, encoder, chunk_size - 1)
+                messages.extend(parts)
+                lengths.extend(part_length + 1 for part_length in parts_lengths)
+            else:
+                messages.append(line)
+                lengths.append(length)
+        # tokens of messages before the i-th one
+        offsets = list(accumulate(lengths, initial=0))
+
+        chunks, start, end = [], 0, 0
+        while start < len(messages):
+            # the overlap gives way to at least one new message
+            while start < end < len(messages) and offsets[end + 1] - offsets[start] > chunk_size:
+                start += 1
+            end = max(end, start + 1)
+            while end < len(messages) and offsets[end + 1] - offsets[start] <= chunk_size:
+                end += 1
+            chunk = "\n".join(messages[start:end]).strip()
+            if chunk != "":
+                chunks.append(chunk[:maxlen])
+            if end == len(messages):
+                break
+            # the next window goes back by the overlap, but always moves forward
+            next_start = end
+            while (
+                next_start > start + 1
+                and end - next_start < overlapping_messages
+                and offsets[end] - offsets[next_start - 1] <= chunk_size // 2
+            ):
+                next_start -= 1
+            start = next_start
+        chats_chunks.append(chunks)
+    return chats_chunks
+
+
+# preload config tokenizer, offline processes such as parse pool workers do not tokenize or load it when needed
+if not OFFLINE:
+    TOKEIZERS[CONFIG["handlers"]["tokenizer_name"]] = get_tokenizer(CONFIG["handlers"]["tokenizer_name"])
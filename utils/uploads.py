@@ -0,0 +1,163 @@
+import asyncio
+import hashlib
+import io
+import mmap
+import os
+from contextlib import contextmanager
+from typing import Iterator, List, Tuple
+
+from fastapi import HTTPException, UploadFile, status
+from loguru import logger
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from utils import CONFIG, GRIDFS
+
+MAX_FILE_SIZE = int(CONFIG["uploads"]["max_file_size_mb"]) * 1024 * 1024
+MAX_REQUEST_SIZE = int(CONFIG["uploads"]["max_request_size_mb"]) * 1024 * 1024
+READ_CHUNK_SIZE = int(CONFIG["uploads"]["read_chunk_size"])
+# shared by all requests of a worker, every write holds a thread of the default executor
+GRIDFS_WRITE_SEMAPHORE = asyncio.Semaphore(int(CONFIG["uploads"]["gridfs_write_concurrency"]))
+
+
+def check_file_size(filename: str, size: int):
+    if size > MAX_FILE_SIZE:
+        msg = f"File {filename} is {size} bytes, which exceeds the limit of {MAX_FILE_SIZE} bytes per file"
+        logger.error(msg)
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=msg)
+
+
+def upload_size(file: UploadFile) -> int:
+    # UploadFile.size is filled by the multipart parser, files it did not spool are measured by seeking
+    if file.size is not None:
+        return file.size
+    size = file.file.seek(0, os.SEEK_END)
+    file.file.seek(0)
+    return size
+
+
+def check_upload_sizes(files: List[UploadFile]):
+    # the request as a whole is limited by RequestSizeLimitMiddleware while it is received,
+    # sizes of single files are known once the multipart parser spooled them
+    total = 0
+    for file in files:
+        size = upload_size(file)
+        check_file_size(file.filename, size)
+        total += size
+    if total > MAX_REQUEST_SIZE:
+        msg = f"Uploaded files total {total} bytes, which exceeds the limit of {MAX_REQUEST_SIZE} bytes per request"
+        logger.error(msg)
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=msg)
+
+
+class RequestSizeLimitMiddleware:
+    """
+    Rejects requests with bodies over `max_request_size_mb` with 413 before Starlette spools
+    them: right away if their Content-Length says so, otherwise as soon as that many bytes
+    were received, e.g. of chunked uploads.
+    """
+
+    def __init__(self, app: ASGIApp, max_size: int = MAX_REQUEST_SIZE):
+        self.app = app
+        self.max_size = max_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        msg = f"Request body exceeds the limit of {self.max_size} bytes per request"
+        length = Headers(scope=scope).get("content-length")
+        if length is not None and length.isdigit() and int(length) > self.max_size:
+            logger.error(f"{msg}, Content-Length is {length}")
+            response = JSONResponse({"detail": msg}, status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_size:
+                    logger.error(msg)
+                    # raised into reading of the body by the endpoint, FastAPI answers with it
+                    raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=msg)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+@contextmanager
+def upload_buffer(file: UploadFile) -> Iterator[memoryview]:
+    """
+    Zero-copy view over the contents of an uploaded file. Starlette spools uploads
+    into a SpooledTemporaryFile, so we either expose the in-memory BytesIO buffer
+    or mmap the file it was rolled over to.
+    """
+    raw = getattr(file.file, "_file", file.file)
+    if isinstance(raw, io.BytesIO):
+        view = raw.getbuffer()
+        try:
+            yield view
+        finally:
+            view.release()
+        return
+
+    raw.flush()
+    if os.fstat(raw.fileno()).st_size == 0:
+        yield memoryview(b"")
+        return
+    with mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        view = memoryview(mapped)
+        try:
+            yield view
+        finally:
+            view.release()
+
+
+def _write_file(filename: str, data: bytes | memoryview, content_type: str, content_hash: str, previous: List):
+    with GRIDFS.new_file(filename=filename, content_type=content_type, content_hash=content_hash) as grid_in:
+        # slices of at most a chunk are copied, uploads are not duplicated in memory whole
+        for start in range(0, len(data), READ_CHUNK_SIZE):
+            grid_in.write(bytes(data[start : start + READ_CHUNK_SIZE]))
+    # previous versions are deleted only once the new one is written
+    for file_id in previous:
+        GRIDFS.delete(file_id)
+
+
+async def save_to_gridfs(files: List[Tuple[str, bytes | memoryview, str]]) -> int:
+    """
+    Writes (filename, data, content type) files to GridFS, replacing previous versions
+    with the same name. Stored sha256 of the content is looked up for all files in one
+    query and unchanged files are not written again. The rest are written concurrently
+    in threads, at most `gridfs_write_concurrency` at a time. Returns the number of written files.
+    """
+    # the last file with a name wins, same as when they were written one by one
+    files = list({filename: (filename, data, content_type) for filename, data, content_type in files}.values())
+    if len(files) == 0:
+        return 0
+    hashes = await asyncio.to_thread(lambda: [hashlib.sha256(data).hexdigest() for _, data, _ in files])
+
+    stored_hashes, previous = {}, {}
+    for grid_out in GRIDFS.find(
+        {"filename": {"$in": [filename for filename, _, _ in files]}}, sort=[("uploadDate", 1)]
+    ):
+        stored_hashes[grid_out.filename] = getattr(grid_out, "content_hash", None)
+        previous.setdefault(grid_out.filename, []).append(grid_out._id)
+
+    async def write(filename: str, data: bytes | memoryview, content_type: str, content_hash: str):
+        async with GRIDFS_WRITE_SEMAPHORE:
+            await asyncio.to_thread(_write_file, filename, data, content_type, content_hash, previous.get(filename, []))
+
+    changed = [
+        (filename, data, content_type, content_hash)
+        for (filename, data, content_type), content_hash in zip(files, hashes)
+        # a name stored more than once is rewritten to leave a single version
+        if stored_hashes.get(filename) != content_hash or len(previous[filename]) > 1
+    ]
+    await asyncio.gather(*[write(*file) for file in changed])
+    logger.info(f"Saved {len(changed)} of {len(files)} files to GridFS, the rest are unchanged")
+    return len(changed)
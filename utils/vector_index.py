@@ -0,0 +1,181 @@
+import time
+from math import ceil, sqrt
+from typing import Dict, List, Tuple
+
+from pymongo import ReturnDocument
+
+from utils import CONFIG, DB
+
+if DB is not None:
+    VECTOR_INDEXES = DB[CONFIG["mongo"]["vector_indexes_collection"]]
+
+FLAT_MAX_ENTITIES = int(CONFIG["milvus"]["flat_max_entities"])
+HNSW_MIN_ENTITIES = int(CONFIG["milvus"]["hnsw_min_entities"])
+# index types from the smallest collections to the largest ones
+INDEX_TYPES = ["FLAT", "IVF_FLAT", "HNSW"]
+# collections created before indexes were chosen by size all have this one
+LEGACY_INDEX = {
+    "index_params": {"metric_type": "IP", "index_type": "IVF_FLAT", "params": {"nlist": 1024}},
+    "search_params": {"metric_type": "IP", "params": {"nprobe": 10}},
+}
+# search params of collections with the version of their index, cached in the worker for
+# `index_params_cache_ttl` seconds, or until a search with them fails after a rebuild
+SEARCH_PARAMS_CACHE: Dict[str, Tuple[float, int, dict]] = {}
+
+
+def choose_index(n_entities: int) -> Tuple[dict, dict]:
+    """
+    Returns params of the index of embeddings of a collection of `n_entities` chunks and params
+    to search it with. Small collections are searched exhaustively, mid-sized ones get IVF with
+    the number of lists growing as the square root of their size and large ones get HNSW.
+    """
+    if n_entities < FLAT_MAX_ENTITIES:
+        return {"metric_type": "IP", "index_type": "FLAT", "params": {}}, {"metric_type": "IP", "params": {}}
+    if n_entities < HNSW_MIN_ENTITIES:
+        nlist = min(65536, max(1, round(float(CONFIG["milvus"]["ivf_nlist_factor"]) * sqrt(n_entities))))
+        nprobe = min(nlist, max(16, ceil(nlist * float(CONFIG["milvus"]["ivf_nprobe_fraction"]))))
+        return (
+            {"metric_type": "IP", "index_type": "IVF_FLAT", "params": {"nlist": nlist}},
+            {"metric_type": "IP", "params": {"nprobe": nprobe}},
+        )
+    return (
+        {
+            "metric_type": "IP",
+            "index_type": "HNSW",
+            "params": {
+                "M": int(CONFIG["milvus"]["hnsw_m"]),
+                "efConstruction": int(CONFIG["milvus"]["hnsw_ef_construction"]),
+            },
+        },
+        {"metric_type": "IP", "params": {"ef": int(CONFIG["milvus"]["hnsw_ef"])}},
+    )
+
+
+def needs_rebuild(index_params: dict, n_entities: int) -> bool:
+    """
+    Whether the index should be rebuilt for a collection which grew or shrank to `n_entities`.
+    Collections rebuild to a smaller index type only once they are half the threshold, and IVF
+    indexes only once the number of lists is off by a factor of two, so collections hovering
+    around a threshold are not rebuilt over and over.
+    """
+    target, _ = choose_index(n_entities)
+    current_rank, target_rank = INDEX_TYPES.index(index_params["index_type"]), INDEX_TYPES.index(target["index_type"])
+    if target_rank > current_rank:
+        return True
+    if target_rank < current_rank:
+        return choose_index(n_entities * 2)[0]["index_type"] == target["index_type"]
+    if target["index_type"] == "IVF_FLAT":
+        ratio = target["params"]["nlist"] / index_params["params"]["nlist"]
+        return ratio >= 2 or ratio <= 0.5
+    return False
+
+
+def get_index(collection_name: str) -> dict:
+    return VECTOR_INDEXES.find_one({"_id": collection_name}) or {"_id": collection_name, **LEGACY_INDEX}
+
+
+def save_index(collection_name: str, index_params: dict, search_params: dict, n_entities: int):
+    # every saved index gets a new version, workers tell by it that their cached search params are stale
+    index = VECTOR_INDEXES.find_one_and_update(
+        {"_id": collection_name},
+        {
+            "$set": {"index_params": index_params, "search_params": search_params, "n_entities": n_entities},
+            "$unset": {"rebuilding_since": "", "rebuild_due": ""},
+            "$inc": {"version": 1},
+        },
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    SEARCH_PARAMS_CACHE[collection_name] = (time.monotonic(), index["version"], search_params)
+
+
+def delete_index(collection_name: str):
+    VECTOR_INDEXES.delete_one({"_id": collection_name})
+    SEARCH_PARAMS_CACHE.pop(collection_name, None)
+
+
+def claim_rebuild(collection_name: str) -> bool:
+    """
+    Marks the index of a collection as being rebuilt, returns False if another worker
+    is rebuilding it already. A claim older than `index_rebuild_timeout` is taken over.
+    """
+    VECTOR_INDEXES.update_one({"_id": collection_name}, {"$setOnInsert": LEGACY_INDEX}, upsert=True)
+    now = time.time()
+    result = VECTOR_INDEXES.update_one(
+        {
+            "_id": collection_name,
+            "$or": [
+                {"rebuilding_since": {"$exists": False}},
+                {"rebuilding_since": {"$lt": now - float(CONFIG["milvus"]["index_rebuild_timeout"])}},
+            ],
+        },
+        {"$set": {"rebuilding_since": now}},
+    )
+    return result.modified_count == 1
+
+
+def is_rebuilding(index: dict) -> bool:
+    # claims older than `index_rebuild_timeout` were left by workers which died while rebuilding
+    since = index.get("rebuilding_since")
+    return since is not None and since >= time.time() - float(CONFIG["milvus"]["index_rebuild_timeout"])
+
+
+def wait_for_rebuild(collection_name: str, timeout: float) -> bool:
+    """
+    Waits up to `timeout` seconds for a rebuild of the index of a collection by any worker to
+    finish, returns False if it did not, or if the index is not being rebuilt.
+    """
+    if not is_rebuilding(get_index(collection_name)):
+        return False
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        time.sleep(1)
+        if not is_rebuilding(get_index(collection_name)):
+            return True
+    return False
+
+
+def release_rebuild(collection_name: str):
+    VECTOR_INDEXES.update_one({"_id": collection_name}, {"$unset": {"rebuilding_since": ""}})
+
+
+def mark_rebuild_due(collection_name: str, n_entities: int) -> bool:
+    """
+    Marks the index of a collection to be rebuilt by the next upload to it or by
+    utils/scripts/rebuild_indexes.py, returns False if it is marked already.
+    """
+    VECTOR_INDEXES.update_one({"_id": collection_name}, {"$setOnInsert": LEGACY_INDEX}, upsert=True)
+    result = VECTOR_INDEXES.update_one(
+        {"_id": collection_name, "rebuild_due": {"$exists": False}}, {"$set": {"rebuild_due": n_entities}}
+    )
+    return result.modified_count == 1
+
+
+def list_due_rebuilds() -> List[str]:
+    return [index["_id"] for index in VECTOR_INDEXES.find({"rebuild_due": {"$exists": True}}, {"_id": 1})]
+
+
+def get_search_params(collection_name: str, top_k: int) -> dict:
+    """
+    Search params stored for the index of a collection. HNSW has to look
+    at least at as many candidates as are requested, `ef` is raised to `top_k`.
+    """
+    cached = SEARCH_PARAMS_CACHE.get(collection_name)
+    if cached is None or time.monotonic() - cached[0] > float(CONFIG["milvus"]["index_params_cache_ttl"]):
+        refresh_search_params(collection_name)
+        cached = SEARCH_PARAMS_CACHE[collection_name]
+    search_params = cached[2]
+    if "ef" in search_params["params"]:
+        return {**search_params, "params": {"ef": max(search_params["params"]["ef"], top_k)}}
+    return search_params
+
+
+def refresh_search_params(collection_name: str) -> bool:
+    """
+    Reads search params of a collection into the cache of the worker. Returns True if their
+    version differs from the cached one, i.e. the index was rebuilt by another process since.
+    """
+    cached = SEARCH_PARAMS_CACHE.get(collection_name)
+    index = get_index(collection_name)
+    SEARCH_PARAMS_CACHE[collection_name] = (time.monotonic(), index.get("version", 0), index["search_params"])
+    return cached is not None and cached[1] != index.get("version", 0)